@@ -0,0 +1,128 @@
+import contextlib, importlib, json, platform, random, shutil, subprocess, sys, tempfile, time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+import chunkfile
+
+# the package exports classes under the names of their modules
+_cfmodule = importlib.import_module('chunkfile.ChunkFile')
+
+# Benchmarks for chunkfile, each timed against the same I/O on a plain file
+# in the same directory. Run with
+#
+#   python -m bench [--dir DIR] [--chunk-size N] [--size N] [--output FILE]
+#
+# Every result holds the best of *repeat* runs for the ChunkFile and for the
+# plain file, and their ratio; the whole report is JSON, for comparing runs
+# of different versions.
+
+KiB = 1024
+MiB = 1024 * KiB
+
+REQUEST_SIZES = [4 * KiB, 64 * KiB, 1 * MiB]
+
+@contextlib.contextmanager
+def chunk_size(nbytes):
+    # Volumes made inside have chunks of nbytes (header included), so that
+    # cases with many chunks fit on a laptop. They keep that size when
+    # opened again outside.
+    if nbytes <= _cfmodule.HEADERSIZE:
+        raise ValueError('chunk size must be more than the {0} byte header'.format(_cfmodule.HEADERSIZE))
+
+    saved = _cfmodule.CHUNKSIZE, _cfmodule.CHUNKDATASIZE
+    _cfmodule.CHUNKSIZE = nbytes
+    _cfmodule.CHUNKDATASIZE = nbytes - _cfmodule.HEADERSIZE
+    try:
+        yield
+    finally:
+        _cfmodule.CHUNKSIZE, _cfmodule.CHUNKDATASIZE = saved
+
+class Bench(object):
+    # Scratch space and timing for the cases
+
+    def __init__(self, dirpath, size, repeat, seed=0):
+        self.dirpath = Path(dirpath)
+        self.size = size
+        self.repeat = repeat
+        self.random = random.Random(seed)
+        self.results = []
+
+    def scratch(self, name):
+        path = self.dirpath / name
+        if path.is_dir():
+            shutil.rmtree(str(path))
+        elif path.exists():
+            path.unlink()
+        return path
+
+    def time(self, func, setup=None):
+        # best of self.repeat runs of func(); setup() runs, untimed, first
+        best = None
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    def record(self, name, params, chunkfile_s, baseline_s, nbytes=None, ops=None):
+        result = {'name': name, 'params': params,
+                  'chunkfile_s': chunkfile_s, 'baseline_s': baseline_s,
+                  'overhead': chunkfile_s / baseline_s if baseline_s else None}
+        if nbytes:
+            result['chunkfile_mb_s'] = nbytes / MiB / chunkfile_s if chunkfile_s else None
+            result['baseline_mb_s'] = nbytes / MiB / baseline_s if baseline_s else None
+        if ops:
+            result['chunkfile_us_per_op'] = chunkfile_s / ops * 1e6
+            result['baseline_us_per_op'] = baseline_s / ops * 1e6
+        self.results.append(result)
+        return result
+
+def _revision():
+    # git commit of the chunkfile being measured, if it's in a checkout
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                      cwd=str(Path(chunkfile.__file__).parent))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+def run(dirpath=None, chunksize=None, size=64 * MiB, repeat=3, only=None, seed=0, log=None):
+    # Run the cases (all, or those named in *only*) and return the report
+    from . import cases
+
+    if chunksize is None:
+        chunksize = _cfmodule.CHUNKSIZE
+    tmpdir = tempfile.mkdtemp(prefix='chunkfile-bench-', dir=None if dirpath is None else str(dirpath))
+    bench = Bench(tmpdir, size, repeat, seed)
+
+    try:
+        with chunk_size(chunksize):
+            for name, case in cases.CASES:
+                if only and name not in only:
+                    continue
+                if log is not None:
+                    log('{0}...'.format(name))
+                case(bench)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'dir': str(Path(tmpdir).parent),
+        'chunksize': chunksize,
+        'size': size,
+        'repeat': repeat,
+        'seed': seed,
+        'results': bench.results,
+    }
+
+def dump(report, f):
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.write('\n')
@@ -0,0 +1,39 @@
+import argparse, sys
+
+from . import MiB, dump, run
+from .cases import CASES
+
+def _size(text):
+    # 4096, 64K, 16M, 1G
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench',
+                                     description='Time chunkfile I/O against a plain file.')
+    parser.add_argument('--dir', help='filesystem to run on (default: the temp directory)')
+    parser.add_argument('--chunk-size', type=_size, default=None,
+                        help='chunk size, header included, e.g. 1M (default: the library\'s)')
+    parser.add_argument('--size', type=_size, default=64 * MiB, help='bytes per case (default: 64M)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing; the best counts (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for random offsets')
+    parser.add_argument('--only', action='append', choices=[name for name, _ in CASES],
+                        help='run just this case; may be repeated')
+    parser.add_argument('--output', '-o', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    def log(msg):
+        sys.stderr.write(msg + '\n')
+
+    report = run(args.dir, args.chunk_size, args.size, args.repeat, args.only, args.seed, log)
+    if args.output:
+        with open(args.output, 'w') as f:
+            dump(report, f)
+    else:
+        dump(report, sys.stdout)
+
+if __name__ == '__main__':
+    main()
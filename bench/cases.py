@@ -0,0 +1,257 @@
+import os, time
+
+from chunkfile import ChunkFile
+
+from . import MiB, REQUEST_SIZES, _cfmodule
+
+# Each case times an operation on a ChunkFile and the same operation on a
+# plain file, and records the pair with Bench.record(). Sizes come from the
+# Bench; chunk counts from the chunk size in effect.
+
+def _chunkdatasize():
+    return _cfmodule.CHUNKDATASIZE
+
+def _fill(bench, name, nbytes):
+    # a volume and a plain file of nbytes of random-ish data
+    voldir = bench.scratch(name + '.vol')
+    plain = bench.scratch(name + '.dat')
+    block = os.urandom(MiB)
+
+    with ChunkFile.open(voldir, 'wb') as f, plain.open('wb') as g:
+        pos = 0
+        while pos < nbytes:
+            piece = block[:min(MiB, nbytes - pos)]
+            f.write(piece)
+            g.write(piece)
+            pos += len(piece)
+    return voldir, plain
+
+def _sparse(bench, name, nbytes):
+    # same, but holes: for cases that only care about the chunk count
+    voldir = bench.scratch(name + '.vol')
+    plain = bench.scratch(name + '.dat')
+    with ChunkFile.open(voldir, 'wb') as f:
+        f.truncate(nbytes)
+    with plain.open('wb') as g:
+        g.truncate(nbytes)
+    return voldir, plain
+
+def _chunk_counts(bench):
+    # up to what bench.size holds, and at least a few
+    most = max(4, bench.size // _chunkdatasize())
+    counts = []
+    n = 1
+    while n < most:
+        counts.append(n)
+        n *= 4
+    return counts + [most]
+
+def sequential(bench):
+    data = os.urandom(max(REQUEST_SIZES))
+    for reqsize in REQUEST_SIZES:
+        nreqs = max(1, bench.size // reqsize)
+        piece = data[:reqsize]
+
+        voldir = bench.scratch('seq.vol')
+        plain = bench.scratch('seq.dat')
+
+        def write_chunkfile():
+            with ChunkFile.open(voldir, 'wb') as f:
+                for _ in range(nreqs):
+                    f.write(piece)
+
+        def write_plain():
+            with plain.open('wb', buffering=0) as f:
+                for _ in range(nreqs):
+                    f.write(piece)
+
+        def read_chunkfile():
+            with ChunkFile.open(voldir, 'rb') as f:
+                while f.read(reqsize):
+                    pass
+
+        def read_plain():
+            with plain.open('rb', buffering=0) as f:
+                while f.read(reqsize):
+                    pass
+
+        params = {'request_size': reqsize, 'bytes': nreqs * reqsize}
+        bench.record('sequential_write', params, bench.time(write_chunkfile), bench.time(write_plain),
+                     nbytes=nreqs * reqsize)
+        bench.record('sequential_read', params, bench.time(read_chunkfile), bench.time(read_plain),
+                     nbytes=nreqs * reqsize)
+
+def random_io(bench):
+    voldir, plain = _fill(bench, 'random', bench.size)
+    for reqsize in REQUEST_SIZES:
+        nreqs = max(16, min(4096, bench.size // reqsize))
+        offsets = [bench.random.randrange(0, max(1, bench.size - reqsize)) for _ in range(nreqs)]
+        data = os.urandom(reqsize)
+
+        def read_chunkfile():
+            with ChunkFile.open(voldir, 'rb') as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    f.read(reqsize)
+
+        def read_plain():
+            with plain.open('rb', buffering=0) as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    f.read(reqsize)
+
+        def write_chunkfile():
+            with ChunkFile.open(voldir, 'r+b') as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    f.write(data)
+
+        def write_plain():
+            with plain.open('r+b', buffering=0) as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    f.write(data)
+
+        params = {'request_size': reqsize, 'ops': nreqs}
+        bench.record('random_read', params, bench.time(read_chunkfile), bench.time(read_plain),
+                     nbytes=nreqs * reqsize, ops=nreqs)
+        bench.record('random_write', params, bench.time(write_chunkfile), bench.time(write_plain),
+                     nbytes=nreqs * reqsize, ops=nreqs)
+
+def append(bench):
+    # Throughput of appends to a volume that grows chunk by chunk, per
+    # stretch of chunks, to show whether a longer chunk list slows them
+    cds = _chunkdatasize()
+    counts = _chunk_counts(bench)
+    reqsize = min(64 * 1024, cds)
+    data = os.urandom(reqsize)
+
+    voldir = bench.scratch('append.vol')
+    plain = bench.scratch('append.dat')
+    f = ChunkFile.open(voldir, 'ab')
+    g = plain.open('ab', buffering=0)
+    try:
+        have = 0
+        for count in counts:
+            nbytes = count * cds - have
+            nreqs = max(1, nbytes // reqsize)
+            have += nreqs * reqsize
+
+            def append_chunkfile():
+                for _ in range(nreqs):
+                    f.write(data)
+
+            def append_plain():
+                for _ in range(nreqs):
+                    g.write(data)
+
+            # once each: the files keep growing
+            chunkfile_s = _once(append_chunkfile)
+            plain_s = _once(append_plain)
+            bench.record('append', {'up_to_chunks': count, 'request_size': reqsize}, chunkfile_s, plain_s,
+                         nbytes=nreqs * reqsize, ops=nreqs)
+    finally:
+        f.close()
+        g.close()
+
+def _once(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+def open_time(bench):
+    cds = _chunkdatasize()
+    for count in _chunk_counts(bench):
+        voldir, plain = _sparse(bench, 'open', count * cds)
+
+        def open_chunkfile():
+            ChunkFile.open(voldir, 'rb').close()
+
+        def open_plain():
+            plain.open('rb').close()
+
+        bench.record('open', {'chunks': count}, bench.time(open_chunkfile), bench.time(open_plain))
+
+def seek_end(bench):
+    cds = _chunkdatasize()
+    nops = 1000
+    for count in _chunk_counts(bench):
+        voldir, plain = _sparse(bench, 'seekend', count * cds)
+        f = ChunkFile.open(voldir, 'rb')
+        g = plain.open('rb', buffering=0)
+        try:
+            def seek_chunkfile():
+                for _ in range(nops):
+                    f.seek(0, os.SEEK_END)
+
+            def seek_plain():
+                for _ in range(nops):
+                    g.seek(0, os.SEEK_END)
+
+            bench.record('seek_end', {'chunks': count, 'ops': nops},
+                         bench.time(seek_chunkfile), bench.time(seek_plain), ops=nops)
+        finally:
+            f.close()
+            g.close()
+
+def truncate(bench):
+    # cut the volume to one chunk and grow it back, so every chunk goes
+    cds = _chunkdatasize()
+    for count in _chunk_counts(bench):
+        nbytes = count * cds
+        voldir, plain = _sparse(bench, 'truncate', nbytes)
+        f = ChunkFile.open(voldir, 'r+b')
+        g = plain.open('r+b', buffering=0)
+        try:
+            def truncate_chunkfile():
+                f.truncate(cds // 2)
+                f.truncate(nbytes)
+
+            def truncate_plain():
+                g.truncate(cds // 2)
+                g.truncate(nbytes)
+
+            bench.record('truncate', {'chunks': count}, bench.time(truncate_chunkfile),
+                         bench.time(truncate_plain), ops=2)
+        finally:
+            f.close()
+            g.close()
+
+def boundary_reads(bench):
+    # reads straddling chunk boundaries, against the same reads in a file
+    cds = _chunkdatasize()
+    nchunks = max(2, min(64, bench.size // cds))
+    voldir, plain = _fill(bench, 'boundary', nchunks * cds)
+    for reqsize in REQUEST_SIZES:
+        if reqsize > cds:
+            continue
+        offsets = [b * cds - reqsize // 2 for b in range(1, nchunks)]
+        nreps = max(1, 256 // len(offsets))
+
+        def read_chunkfile():
+            with ChunkFile.open(voldir, 'rb') as f:
+                for _ in range(nreps):
+                    for offset in offsets:
+                        f.seek(offset)
+                        f.read(reqsize)
+
+        def read_plain():
+            with plain.open('rb', buffering=0) as f:
+                for _ in range(nreps):
+                    for offset in offsets:
+                        f.seek(offset)
+                        f.read(reqsize)
+
+        nops = nreps * len(offsets)
+        bench.record('boundary_read', {'request_size': reqsize, 'ops': nops},
+                     bench.time(read_chunkfile), bench.time(read_plain), nbytes=nops * reqsize, ops=nops)
+
+CASES = [
+    ('sequential', sequential),
+    ('random', random_io),
+    ('append', append),
+    ('open', open_time),
+    ('seek_end', seek_end),
+    ('truncate', truncate),
+    ('boundary', boundary_reads),
+]
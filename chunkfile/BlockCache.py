@@ -0,0 +1,278 @@
+import collections, threading, weakref
+
+BLOCKSIZE = 64 * 1024
+CACHESIZE = 64 * 1024 * 1024
+
+# Every live BlockCache, so a write through any ChunkFile in the process can
+# invalidate blocks cached on behalf of any other.
+_caches = weakref.WeakSet()
+
+def invalidate(volume, chunknum, offset=0, length=None):
+    # Drop cached blocks of a chunk overlapping [offset, offset+length).
+    # length=None means everything from offset to the end of the chunk.
+    for cache in list(_caches):
+        cache.invalidate(volume, chunknum, offset, length)
+
+class _LRU(object):
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+
+    def get(self, key):
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        self.remove(key)
+        self._entries[key] = data
+        self._nbytes += len(data)
+
+        evicted = []
+        while self._nbytes > self._capacity and len(self._entries) > 1:
+            oldkey, old = self._entries.popitem(last=False)
+            self._nbytes -= len(old)
+            evicted.append(oldkey)
+        return evicted
+
+    def remove(self, key):
+        data = self._entries.pop(key, None)
+        if data is not None:
+            self._nbytes -= len(data)
+
+    def nbytes(self):
+        return self._nbytes
+
+class _ARC(object):
+    # Adaptive Replacement Cache (Megiddo & Modha). T1 holds blocks seen
+    # once recently, T2 blocks seen at least twice; B1 and B2 remember keys
+    # recently evicted from each and steer the target size p of T1. Sizes
+    # count blocks, not bytes.
+
+    def __init__(self, capacity, blocksize):
+        self._c = max(1, capacity // blocksize)
+        self._p = 0
+        self._t1 = collections.OrderedDict()
+        self._t2 = collections.OrderedDict()
+        self._b1 = collections.OrderedDict()
+        self._b2 = collections.OrderedDict()
+        self._nbytes = 0
+
+    def get(self, key):
+        data = self._t1.pop(key, None)
+        if data is not None:
+            self._t2[key] = data
+            return data
+
+        data = self._t2.get(key)
+        if data is not None:
+            self._t2.move_to_end(key)
+        return data
+
+    def _replace(self, key, evicted):
+        if len(self._t1) + len(self._t2) < self._c:
+            return
+
+        if self._t1 and (not self._t2 or len(self._t1) > self._p or (key in self._b2 and len(self._t1) == self._p)):
+            oldkey, old = self._t1.popitem(last=False)
+            self._b1[oldkey] = None
+        else:
+            oldkey, old = self._t2.popitem(last=False)
+            self._b2[oldkey] = None
+
+        self._nbytes -= len(old)
+        evicted.append(oldkey)
+
+    def put(self, key, data):
+        self.remove(key)
+        evicted = []
+        c = self._c
+
+        if key in self._b1:
+            self._p = min(c, self._p + max(len(self._b2) // len(self._b1), 1))
+            del self._b1[key]
+            self._replace(key, evicted)
+            self._t2[key] = data
+        elif key in self._b2:
+            self._p = max(0, self._p - max(len(self._b1) // len(self._b2), 1))
+            del self._b2[key]
+            self._replace(key, evicted)
+            self._t2[key] = data
+        else:
+            if len(self._t1) + len(self._b1) >= c:
+                if len(self._t1) < c:
+                    self._b1.popitem(last=False)
+                    self._replace(key, evicted)
+                else:
+                    oldkey, old = self._t1.popitem(last=False)
+                    self._nbytes -= len(old)
+                    evicted.append(oldkey)
+            else:
+                total = len(self._t1) + len(self._t2) + len(self._b1) + len(self._b2)
+                if total >= c:
+                    if total >= 2 * c and self._b2:
+                        self._b2.popitem(last=False)
+                    self._replace(key, evicted)
+            self._t1[key] = data
+
+        self._nbytes += len(data)
+        return evicted
+
+    def remove(self, key):
+        data = self._t1.pop(key, None)
+        if data is None:
+            data = self._t2.pop(key, None)
+        if data is not None:
+            self._nbytes -= len(data)
+
+    def nbytes(self):
+        return self._nbytes
+
+class BlockCache(object):
+    # In-process cache of chunk data, shared by every ChunkFile that is
+    # opened with it. Blocks are keyed by (volume, chunknum, block index);
+    # *volume* is the real path of the directory holding the chunk.
+    #
+    # Writes, truncates and erases through any ChunkFile in the process
+    # invalidate the blocks they touch. Changes made by other processes are
+    # not seen.
+
+    # SharedBlockCache, held by the host rather than the process, sets this
+    crossprocess = False
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, blocksize=BLOCKSIZE, capacity=CACHESIZE, policy='lru'):
+        if blocksize <= 0:
+            raise ValueError('blocksize must be positive')
+        if capacity < blocksize:
+            raise ValueError('capacity must hold at least one block')
+
+        if policy == 'lru':
+            self._policy = _LRU(capacity)
+        elif policy == 'arc':
+            self._policy = _ARC(capacity, blocksize)
+        else:
+            raise ValueError("policy must be 'lru' or 'arc', not {0!r}".format(policy))
+
+        self.blocksize = blocksize
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # (volume, chunknum) -> set of cached block indexes
+        self._resident = {}
+        # (volume, chunknum) -> index of a cached block shorter than
+        # blocksize, which any write to the chunk may lengthen
+        self._short = {}
+        # bumped by every invalidation, so a block read from disk while an
+        # invalidation ran is not cached
+        self._epoch = 0
+
+        _caches.add(self)
+
+    @classmethod
+    def default(cls):
+        # The process-wide cache used by ChunkFile.open(..., cache=True)
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = BlockCache()
+            return cls._default
+
+    @classmethod
+    def set_default(cls, cache):
+        with cls._default_lock:
+            cls._default = cache
+
+    def epoch(self, key=None):
+        # Taken before reading a block from disk, and passed to put(); key
+        # is the block's
+        return self._epoch
+
+    def get(self, key):
+        with self._lock:
+            data = self._policy.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return data
+
+    def put(self, key, data, epoch):
+        # Empty blocks, read past the end of the chunk, aren't kept. Each
+        # chunk tracks one short block, which writes always drop, and it
+        # has to be the one the data ends in.
+        if not data:
+            return
+
+        with self._lock:
+            if epoch != self._epoch:
+                return
+
+            for oldkey in self._policy.put(key, data):
+                self.evictions += 1
+                self._forget(oldkey)
+
+            volchunk = key[:2]
+            self._resident.setdefault(volchunk, set()).add(key[2])
+            if len(data) < self.blocksize:
+                self._short[volchunk] = key[2]
+
+    def _forget(self, key):
+        volchunk = key[:2]
+        blocks = self._resident.get(volchunk)
+        if blocks is not None:
+            blocks.discard(key[2])
+            if not blocks:
+                del self._resident[volchunk]
+        if self._short.get(volchunk) == key[2]:
+            del self._short[volchunk]
+
+    def invalidate(self, volume, chunknum, offset=0, length=None):
+        volchunk = (volume, chunknum)
+
+        with self._lock:
+            self._epoch += 1
+
+            blocks = self._resident.get(volchunk)
+            if not blocks:
+                return
+
+            first = offset // self.blocksize
+            if length is None:
+                doomed = [b for b in blocks if b >= first]
+            else:
+                last = (offset + max(length, 1) - 1) // self.blocksize
+                doomed = [b for b in blocks if first <= b <= last]
+
+            short = self._short.get(volchunk)
+            if short is not None and short not in doomed:
+                doomed.append(short)
+
+            for b in doomed:
+                self._policy.remove((volume, chunknum, b))
+                self._forget((volume, chunknum, b))
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            for volchunk, blocks in list(self._resident.items()):
+                for b in blocks:
+                    self._policy.remove(volchunk + (b,))
+            self._resident.clear()
+            self._short.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'bytes': self._policy.nbytes(),
+                    'capacity': self.capacity,
+                    'blocksize': self.blocksize}
+
+__all__ = ['BlockCache']
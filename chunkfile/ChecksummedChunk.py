@@ -0,0 +1,192 @@
+import os, struct, zlib
+
+from .ChunkFile import (CHUNKSIZE, FLAG_CHECKSUMMED, HEADERSIZE, Chunk, InvalidHeaderError,
+                        _fdatasync, register_chunk_format)
+
+CHECKSUM_BLOCKSIZE = 64 * 1024
+
+_SUM = struct.Struct('<Q')
+
+class ChecksumError(IOError): pass
+
+def _checksum(name):
+    # checksum function for an algorithm name; all return ints below 2**64
+    if name == 'crc32':
+        return zlib.crc32
+    if name == 'crc32c':
+        try:
+            import crc32c
+            return crc32c.crc32c
+        except ImportError:
+            pass
+        try:
+            import google_crc32c
+            return google_crc32c.value
+        except ImportError:
+            raise ValueError("checksum 'crc32c' needs the crc32c or google-crc32c module")
+    if name == 'xxh64':
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError("checksum 'xxh64' needs the xxhash module")
+        return xxhash.xxh64_intdigest
+    raise ValueError('Unknown checksum: {0!r}'.format(name))
+
+class ChecksummedChunk(Chunk):
+    # Plain chunk data plus a checksum per block, kept in a hidden sidecar
+    # next to the chunk (.chunk.NNNNNNNNNNN.dat.sum). Sums are updated as
+    # part of every write and truncate. After a crash, blocks written since
+    # the last sync() may show up as mismatches.
+
+    __slots__ = ('_algo', '_csbs', '_sum', '_zerosum')
+
+    def __init__(self, path, header, direct=None, cache=None):
+        super(ChecksummedChunk, self).__init__(path, header, direct, cache)
+
+        try:
+            self._algo = header.fields['checksum']
+            self._csbs = int(header.fields['checksumblock'])
+        except (KeyError, ValueError):
+            raise InvalidHeaderError('{0}: bad checksum fields'.format(path))
+        self._sum = _checksum(self._algo)
+        self._zerosum = self._sum(bytes(self._csbs))
+
+    @classmethod
+    def _header_fields(cls, checksum='crc32', blocksize=CHECKSUM_BLOCKSIZE, chunksize=CHUNKSIZE):
+        _checksum(checksum)
+        if blocksize <= 0:
+            raise ValueError('blocksize must be positive')
+
+        return {'flags': '{0:x}'.format(FLAG_CHECKSUMMED),
+                'checksum': checksum, 'checksumblock': str(blocksize)}
+
+    @classmethod
+    def create(cls, basedir, chunknum, direct=None, cache=None, **options):
+        chunk = super(ChecksummedChunk, cls).create(basedir, chunknum, direct, cache, **options)
+        with chunk._sumpath().open('wb'):
+            pass
+        return chunk
+
+    def _sumpath(self):
+        return self._path.parent / '.{0}.sum'.format(self._path.name)
+
+    def _sidecars(self):
+        return super(ChecksummedChunk, self)._sidecars() + [self._sumpath()]
+
+    def _update_sums(self, start, end, oldsize, data=None):
+        # Recompute the sums of the blocks overlapping [start, end), and of
+        # those between the old end of the chunk and start, which the change
+        # zero-filled. *data* is what was just written at start, if any.
+        bs = self._csbs
+        size = self.size()
+        lo = min(start, oldsize)
+        end = min(end, size)
+        if end <= lo:
+            return
+
+        first = lo // bs
+        sums = []
+        with self._path.open('rb') as f:
+            for b in range(first, (end - 1) // bs + 1):
+                bstart = b * bs
+                bend = min(bstart + bs, size)
+
+                if bend - bstart == bs and oldsize <= bstart and bend <= start:
+                    sums.append(self._zerosum)
+                elif data is not None and start <= bstart and bend <= start + len(data):
+                    sums.append(self._sum(data[bstart-start:bend-start]))
+                else:
+                    f.seek(HEADERSIZE + bstart)
+                    sums.append(self._sum(f.read(bend - bstart)))
+
+        fd = os.open(str(self._sumpath()), os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            os.pwrite(fd, b''.join(_SUM.pack(s) for s in sums), first * _SUM.size)
+        finally:
+            os.close(fd)
+
+    def _write(self, offset, data):
+        oldsize = self.size()
+        super(ChecksummedChunk, self)._write(offset, data)
+        self._update_sums(offset, offset + len(data), oldsize, data)
+
+    def _truncate(self, size):
+        oldsize = self.size()
+        super(ChecksummedChunk, self)._truncate(size)
+
+        nblocks = (size + self._csbs - 1) // self._csbs
+        with self._sumpath().open('r+b') as f:
+            f.truncate(nblocks * _SUM.size)
+
+        if size < oldsize:
+            if size % self._csbs:
+                self._update_sums(size - 1, size, size)
+        else:
+            self._update_sums(size, size, oldsize)
+
+    def _bad_blocks(self, first, last):
+        # indexes of blocks in [first, last] whose data doesn't match its sum
+        size = self.size()
+        bad = []
+
+        with self._sumpath().open('rb') as f:
+            f.seek(first * _SUM.size)
+            sums = f.read((last - first + 1) * _SUM.size)
+
+        with self._path.open('rb') as f:
+            f.seek(HEADERSIZE + first * self._csbs)
+            for i, b in enumerate(range(first, last + 1)):
+                block = f.read(min(self._csbs, size - b * self._csbs))
+                if (i + 1) * _SUM.size > len(sums) or _SUM.unpack_from(sums, i * _SUM.size)[0] != self._sum(block):
+                    bad.append(b)
+
+        return bad
+
+    def _read(self, offset, count):
+        if self.verify_reads:
+            end = min(offset + count, self.size())
+            if end > offset:
+                bad = self._bad_blocks(offset // self._csbs, (end - 1) // self._csbs)
+                if bad:
+                    raise ChecksumError('{0}: checksum mismatch in block {1}'.format(self._path, bad[0]))
+
+        return super(ChecksummedChunk, self)._read(offset, count)
+
+    def _readinto(self, offset, view):
+        if self.verify_reads:
+            data = self._read(offset, len(view))
+            view[:len(data)] = data
+            return len(data)
+
+        return super(ChecksummedChunk, self)._readinto(offset, view)
+
+    def scrub(self):
+        size = self.size()
+        if not size:
+            return []
+
+        bs = self._csbs
+        nblocks = (size + bs - 1) // bs
+        bad = []
+        # a few MiB at a time, to keep memory flat
+        step = max(1, (8 * 1024 * 1024) // bs)
+        for first in range(0, nblocks, step):
+            for b in self._bad_blocks(first, min(first + step, nblocks) - 1):
+                bad.append((b * bs, min((b + 1) * bs, size)))
+        return bad
+
+    def sync(self):
+        super(ChecksummedChunk, self).sync()
+
+        try:
+            fd = os.open(str(self._sumpath()), os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            _fdatasync(fd)
+        finally:
+            os.close(fd)
+
+register_chunk_format(FLAG_CHECKSUMMED, ChecksummedChunk)
+
+__all__ = ['CHECKSUM_BLOCKSIZE', 'ChecksumError', 'ChecksummedChunk']
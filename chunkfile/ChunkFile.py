@@ -1,24 +1,245 @@
-import os
+import array, collections, errno, functools, mmap, multiprocessing, os, struct, sys, threading, time, uuid, weakref
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .BlockCache import BlockCache, _caches as _blockcaches, invalidate as _invalidate_blocks
+from .ChunkStore import ChunkStore, DirectoryStore
+from .MerkleTree import (MERKLE_BLOCKSIZE, MerkleTree, leaf_hash as _leaf_hash,
+                         load_leaves as _load_leaves, load_root as _load_root,
+                         save_leaves as _save_leaves, stamp as _stamp)
+from . import Trace as _trace
+from .Watch import DIRS as _DIRS, POLL as _POLL, watcher as _watcher
+from .Stats import (Stats, metrics_enabled as _metrics_enabled, now as _now,
+                    register as _register_stats, retire as _retire_stats)
+
 SIGNATURE = "CHNKFILE"
 VERSION = (1,0)
-IFACE_VERSION = 1
+# 2: headers record the chunk size, the volume's UUID and generation, and
+# the chunk's data length. Version 1 chunks, without them, are still read
+# and written.
+IFACE_VERSION = 2
 HEADERSIZE = 4096
 CHUNKSIZE = 512 * 1024 * 1024
 CHUNKDATASIZE = CHUNKSIZE - HEADERSIZE
 
+# O_DIRECT needs the file offset, the length and the buffer address to be
+# aligned. 4KiB covers every logical block size we expect to meet, and since
+# it is also HEADERSIZE, chunk data starts on an aligned boundary.
+DIRECTALIGN = 4096
+DIRECTBUFSIZE = 1024 * 1024
+
 class InvalidHeaderError(Exception): pass
 class UnsupportedVersionError(Exception): pass
 
+# macOS has no fdatasync; fsync is the closest thing there.
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+def _fsync_dir(dirpath):
+    fd = os.open(str(dirpath), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+COPYBUFSIZE = 8 * 1024 * 1024
+
+def _copy_range(infd, outfd, offset, count, dstoffset=None):
+    # Copy count bytes at offset in infd to dstoffset (default: the same
+    # offset) in outfd, in the kernel where possible.
+    if dstoffset is None:
+        dstoffset = offset
+
+    while count > 0:
+        n = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                n = os.copy_file_range(infd, outfd, min(count, 1 << 30), offset, dstoffset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+
+        if not n:
+            data = os.pread(infd, min(count, COPYBUFSIZE), offset)
+            if not data:
+                return
+            n = os.pwrite(outfd, data, dstoffset)
+
+        offset += n
+        dstoffset += n
+        count -= n
+
+def _data_extents(fd, start, end):
+    # (offset, length) of each range of [start, end) that isn't a hole
+    if not hasattr(os, 'SEEK_DATA'):
+        yield start, end - start
+        return
+
+    pos = start
+    while pos < end:
+        try:
+            data = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            if e.errno == errno.EINVAL:
+                # filesystem without SEEK_DATA support
+                yield pos, end - pos
+                return
+            raise
+        if data >= end:
+            return
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        yield data, hole - data
+        pos = hole
+
+def _copy_file(src, dst):
+    # Copy a file, leaving holes in src as holes in dst
+    infd = os.open(str(src), os.O_RDONLY)
+    try:
+        outfd = os.open(str(dst), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            size = os.fstat(infd).st_size
+            for offset, count in _data_extents(infd, 0, size):
+                _copy_range(infd, outfd, offset, count)
+            os.ftruncate(outfd, size)
+            os.fsync(outfd)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
+# Linux FICLONE ioctl: make dst share src's extents, copy-on-write
+_FICLONE = 0x40049409
+
+def _reflink(src, dst):
+    # Clone src to a new file dst, keeping its mtime. False if the
+    # filesystem (or platform) can't.
+    if fcntl is None or not hasattr(fcntl, 'ioctl'):
+        return False
+
+    infd = os.open(str(src), os.O_RDONLY)
+    try:
+        outfd = os.open(str(dst), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            fcntl.ioctl(outfd, _FICLONE, infd)
+            os.fsync(outfd)
+        except OSError:
+            os.close(outfd)
+            os.unlink(str(dst))
+            return False
+        os.close(outfd)
+
+        st = os.fstat(infd)
+        os.utime(str(dst), ns=(st.st_atime_ns, st.st_mtime_ns))
+        return True
+    finally:
+        os.close(infd)
+
+def _clone_file(src, dst):
+    # Reflink src to dst if possible, else copy it; either way keeping holes
+    # and the mtime
+    if not _reflink(src, dst):
+        st = os.stat(str(src))
+        _copy_file(src, dst)
+        os.utime(str(dst), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def _share_file(src, dst):
+    # Cheapest independent-looking copy of src at dst: a reflink, else a
+    # hard link (which the writer breaks before changing the file), else a
+    # real copy across filesystems
+    if _reflink(src, dst):
+        return
+
+    try:
+        os.link(str(src), str(dst))
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        _clone_file(src, dst)
+
+# struct flock for open file description locks (Linux)
+_FLOCK = struct.Struct('hhqqi4x')
+
+# fcntl only names the open file description lock commands from Python 3.9
+if fcntl is not None and hasattr(fcntl, 'F_OFD_SETLKW'):
+    _F_OFD_SETLK, _F_OFD_SETLKW = fcntl.F_OFD_SETLK, fcntl.F_OFD_SETLKW
+elif fcntl is not None and sys.platform.startswith('linux'):
+    _F_OFD_SETLK, _F_OFD_SETLKW = 37, 38
+else:
+    _F_OFD_SETLK = _F_OFD_SETLKW = None
+
+def _lock_range(fd, exclusive, start, length):
+    # Wait for a lock on bytes [start, start+length) of fd's file; length 0
+    # runs to the end. Where the platform has open file description locks,
+    # the lock belongs to fd: it excludes other fds in this process too, and
+    # closing some other fd on the file doesn't drop it. Closing fd does.
+    ltype = fcntl.F_WRLCK if exclusive else fcntl.F_RDLCK
+    if _F_OFD_SETLKW is not None:
+        fcntl.fcntl(fd, _F_OFD_SETLKW, _FLOCK.pack(ltype, os.SEEK_SET, start, length, 0))
+    else:
+        fcntl.lockf(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, length, start)
+
+def _unlock_range(fd, start, length):
+    if _F_OFD_SETLK is not None:
+        fcntl.fcntl(fd, _F_OFD_SETLK, _FLOCK.pack(fcntl.F_UNLCK, os.SEEK_SET, start, length, 0))
+    else:
+        fcntl.lockf(fd, fcntl.LOCK_UN, length, start)
+
+# Shared volumes count changes to their set of chunks in this hidden file
+GENERATIONNAME = '.generation'
+_GENERATION = struct.Struct('<Q')
+
+# Bumped by every snapshot, so chunks know to check whether their files
+# became shared
+_snapshots = 0
+
+class GroupCommit(object):
+    # Durability policy: a background thread syncs dirty chunks once *nbytes*
+    # have been written since the last sync, or *ms* milliseconds after the
+    # first unsynced write, whichever comes first.
+
+    def __init__(self, nbytes=None, ms=None):
+        if nbytes is None and ms is None:
+            raise ValueError('GroupCommit needs nbytes, ms, or both')
+        if nbytes is not None and nbytes <= 0:
+            raise ValueError('nbytes must be positive')
+        if ms is not None and ms <= 0:
+            raise ValueError('ms must be positive')
+
+        self.nbytes = nbytes
+        self.ms = ms
+
+DURABILITY_POLICIES = ('none', 'on_close', 'every_write')
+SYNC_THREADS = 16
+
+# default most bytes yielded at a time by follow()
+FOLLOW_BLOCKSIZE = 1024 * 1024
+
+# Header flags, kept in the 'flags' field of the reserved area
+FLAG_COMPRESSED = 0x1
+FLAG_CHECKSUMMED = 0x4
+FLAG_DEDUP = 0x8
+
 class ChunkFileHeader(object):
     # Header page uses 4KiB of each 512MiB chunk, 0.00077% overhead
 
-    def __init__(self, sig, version, iface_version, chunknum):
+    __slots__ = ('sig', 'version', 'iface_version', 'chunknum', 'fields')
+
+    def __init__(self, sig, version, iface_version, chunknum, fields=None):
         self.sig = sig
         self.version = version
         self.iface_version = iface_version
         self.chunknum = chunknum
+        # key=value lines stored in the reserved area; empty for plain chunks
+        self.fields = dict(fields or {})
+
+    def flags(self):
+        return int(self.fields.get('flags', '0'), 16)
 
     @staticmethod
     def size(): return HEADERSIZE
@@ -50,8 +271,27 @@ class ChunkFileHeader(object):
             raise InvalidHeaderError('Chunknum should be 0-99999999999')
         buf[0x14:0x20] = '{0:0>11}\n'.format(self.chunknum).encode('ascii')
 
-        # 020-FFF: reserved, must be \n
-        buf[0x0020:0x1000] = '\n'.encode('ascii') * 0xFE0
+        # 020-FFF: key=value\n lines, then \n padding. Version 1 plain
+        # chunks have no fields, so this is all \n. Version 2 chunks have
+        #   chunksize   size of the file when full, header included; the
+        #               same for every chunk of a volume
+        #   volume      UUID of the volume, as hex, shared by all its chunks
+        #   generation  the volume's generation when the header was written;
+        #               the tail chunk's is the volume's (see
+        #               ChunkFile._layout_changed)
+        #   length      data length, recorded at flush; only there while it
+        #               is right (see Chunk._dirty_header)
+        extra = ''.join('{0}={1}\n'.format(k, v) for k, v in sorted(self.fields.items()))
+        for k, v in self.fields.items():
+            if not k or not k.replace('_', '').isalnum() or '\n' in str(v):
+                raise InvalidHeaderError('Invalid header field {0!r}'.format(k))
+        try:
+            extra = extra.encode('ascii')
+        except UnicodeEncodeError:
+            raise InvalidHeaderError('Header fields must be ASCII')
+        if len(extra) > 0xFE0:
+            raise InvalidHeaderError('Header fields too long')
+        buf[0x0020:0x1000] = extra + '\n'.encode('ascii') * (0xFE0 - len(extra))
 
     @classmethod
     def unpack_from(self, buf):
@@ -86,30 +326,146 @@ class ChunkFileHeader(object):
         except ValueError:
             raise InvalidHeaderError('Invalid chunknum')
 
-        return ChunkFileHeader(sig, version, iface_version, chunknum)
+        fields = {}
+        try:
+            for line in bytes(buf[0x0020:0x1000]).decode('ascii').split('\n'):
+                if line:
+                    k, v = line.split('=', 1)
+                    fields[k] = v
+        except (UnicodeDecodeError, ValueError):
+            raise InvalidHeaderError('Invalid header fields')
+
+        return ChunkFileHeader(sig, version, iface_version, chunknum, fields)
+
+class AlignedBufferPool(object):
+    # Scratch buffers for O_DIRECT I/O. Anonymous mmaps always start on a page
+    # boundary, so they satisfy the buffer alignment O_DIRECT requires.
+
+    def __init__(self, bufsize=DIRECTBUFSIZE, maxfree=4):
+        if bufsize <= 0 or bufsize % DIRECTALIGN:
+            raise ValueError('bufsize must be a positive multiple of {0}'.format(DIRECTALIGN))
+
+        self.bufsize = bufsize
+        self._maxfree = maxfree
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+
+        return mmap.mmap(-1, self.bufsize)
+
+    def release(self, buf):
+        with self._lock:
+            if len(self._free) < self._maxfree:
+                self._free.append(buf)
+                return
+
+        buf.close()
+
+    def close(self):
+        with self._lock:
+            for buf in self._free:
+                buf.close()
+            del self._free[:]
+
+def _align_down(n):
+    return n & ~(DIRECTALIGN - 1)
+
+def _align_up(n):
+    return _align_down(n + DIRECTALIGN - 1)
+
+# header flag -> Chunk subclass that reads and writes that chunk format
+_chunk_formats = {}
+
+def _chunk_name(chunknum):
+    return 'chunk.{0:0>11d}.dat'.format(chunknum)
+
+def _chunk_number(name):
+    # number of the chunk a file name is for, or None for other names
+    if (len(name) == 21 and name.startswith('chunk.') and name.endswith('.dat')
+            and all('0' <= c <= '9' for c in name[6:17])):
+        return int(name[6:17])
+    return None
+
+def register_chunk_format(flag, cls):
+    _chunk_formats[flag] = cls
 
 class Chunk(object):
-    def __init__(self, path, header):
+    # Plain chunk: the header, then the data as-is. Subclasses for other
+    # formats override _read, _readinto, _write, _truncate and size.
+
+    # True for formats that hold data in memory until flush()
+    buffered = False
+
+    # A volume may have millions of chunks; keep them small
+    __slots__ = ('_path', '_header', '_direct', '_cache', '_volkey', '_atime',
+                 '_treetracking', '_treedirty', '_unshared_at', '_stats',
+                 'verify_reads', 'locking', 'foreign_writes')
+
+    def __init__(self, path, header, direct=None, cache=None):
         self._path = path
         self._header = header
+        # Formats with checksums check them on every read when this is set
+        self.verify_reads = False
+        # Reads and writes take byte-range locks when this is set
+        self.locking = False
+        # Set when other processes may change the chunk under us: its length
+        # is then neither recorded in the header nor taken from it
+        self.foreign_writes = False
+        # the volume's Stats, when it collects metrics
+        self._stats = None
+
+        # AlignedBufferPool when chunk data goes through O_DIRECT, else None
+        self._direct = direct
+        # BlockCache that reads go through, or None
+        self._cache = cache
+        self._volkey = None
+        # time.monotonic() of the last read or write, 0 if never touched
+        self._atime = 0
+
+        # Hash tree upkeep. Once the chunk is first changed, _treedirty
+        # collects the blocks changed since its tree sidecar was saved, or
+        # is None if the sidecar was already out of date then.
+        self._treetracking = False
+        self._treedirty = None
+        # _snapshots as of the last check that the chunk file isn't shared
+        self._unshared_at = -1
 
     @classmethod
-    def create(cls, basedir, chunknum):
-        path = basedir / 'chunk.{0:0>11d}.dat'.format(chunknum)
-        header = ChunkFileHeader(sig=SIGNATURE, version=VERSION,
-                                 iface_version=IFACE_VERSION,
-                                 chunknum=chunknum)
+    def _header_fields(cls, chunksize=CHUNKSIZE):
+        return {}
 
-        buf = bytearray(HEADERSIZE)
-        header.pack_into(buf)
+    @classmethod
+    def create(cls, basedir, chunknum, direct=None, cache=None, **options):
+        path = basedir / _chunk_name(chunknum)
+        header, buf = cls._new_header(chunknum, **options)
 
         with path.open('wb') as f:
             f.write(buf)
 
-        return Chunk(path, header)
+        return cls(path, header, direct, cache)
 
     @classmethod
-    def open(cls, path):
+    def _new_header(cls, chunknum, header=None, chunksize=CHUNKSIZE, **options):
+        # header of a new chunk, and its packed page. *header* holds fields
+        # from the volume, such as its UUID.
+        fields = cls._header_fields(chunksize=chunksize, **options)
+        fields.update({'chunksize': str(chunksize), 'generation': '0'})
+        fields.update(header or {})
+        header = ChunkFileHeader(sig=SIGNATURE, version=VERSION,
+                                 iface_version=IFACE_VERSION,
+                                 chunknum=chunknum,
+                                 fields=fields)
+
+        buf = bytearray(HEADERSIZE)
+        header.pack_into(buf)
+        return header, buf
+
+    @classmethod
+    def open(cls, path, direct=None, cache=None):
         if not path.is_file():
             raise IOError('{0} is not a regular file'.format(path))
 
@@ -121,86 +477,1555 @@ class Chunk(object):
 
         header = ChunkFileHeader.unpack_from(header_data)
 
-        return Chunk(path, header)
+        flags = header.flags()
+        if not flags:
+            return Chunk(path, header, direct, cache)
+
+        for flag, chunkcls in _chunk_formats.items():
+            if flags & flag:
+                return chunkcls(path, header, direct, cache)
+
+        raise UnsupportedVersionError('{0} uses an unknown chunk format (flags {1:x})'.format(path, flags))
 
     def chunknum(self):
         return self._header.chunknum
 
+    def chunksize(self):
+        # size of the chunk file when full, header included
+        return int(self._header.fields.get('chunksize', CHUNKSIZE))
+
+    def _volume(self):
+        if self._volkey is None:
+            self._volkey = os.path.realpath(str(self._path.parent))
+        return self._volkey
+
+    def _invalidate(self, offset=0, length=None):
+        # Called after the change is on disk: a cache fill racing with it
+        # either sees the new data or is refused by the cache.
+        if _blockcaches:
+            _invalidate_blocks(self._volume(), self.chunknum(), offset, length)
+
+    def _cached_read(self, offset, count):
+        cache = self._cache
+        bs = cache.blocksize
+        volume = self._volume()
+        chunknum = self.chunknum()
+        end = offset + count
+        pieces = []
+
+        for b in range(offset // bs, (end + bs - 1) // bs):
+            key = (volume, chunknum, b)
+            block = cache.get(key)
+            if self._stats is not None:
+                if block is None:
+                    self._stats.cache_misses += 1
+                else:
+                    self._stats.cache_hits += 1
+            if block is None:
+                epoch = cache.epoch(key)
+                block = self._read(b * bs, bs)
+                cache.put(key, block, epoch)
+
+            lo = max(offset, b * bs) - b * bs
+            hi = min(end, b * bs + len(block)) - b * bs
+            if hi > lo:
+                pieces.append(block[lo:hi])
+            if len(block) < bs:
+                break
+
+        return b''.join(pieces)
+
+    def _open_direct(self, flags):
+        try:
+            return os.open(str(self._path), flags | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+
+        # The filesystem refused O_DIRECT (tmpfs does this). Stay correct and
+        # use the page cache for this chunk from now on.
+        self._direct = None
+        return None
+
+    def _direct_readinto(self, offset, view):
+        fd = self._open_direct(os.O_RDONLY)
+        if fd is None:
+            return self._readinto(offset, view)
+
+        pool = self._direct
+        buf = pool.acquire()
+        try:
+            start = HEADERSIZE + offset
+            end = start + len(view)
+            pos = _align_down(start)
+            nread = 0
+
+            with memoryview(buf) as bufview:
+                while pos < end:
+                    n = min(pool.bufsize, _align_up(end) - pos)
+                    # the fd is ours alone, so seek and readv() stand in
+                    # for preadv(), which is new in Python 3.7
+                    os.lseek(fd, pos, os.SEEK_SET)
+                    got = os.readv(fd, [bufview[:n]])
+
+                    lo = max(start, pos)
+                    hi = min(end, pos + got)
+                    if hi > lo:
+                        view[lo-start:hi-start] = bufview[lo-pos:hi-pos]
+                        nread = hi - start
+
+                    if got < n:
+                        break
+                    pos += n
+
+            return nread
+        finally:
+            pool.release(buf)
+            os.close(fd)
+
+    def _direct_write(self, offset, data):
+        start = HEADERSIZE + offset
+        end = start + len(data)
+        astart = _align_up(start)
+        aend = _align_down(end)
+
+        fd = None
+        if astart < aend:
+            fd = self._open_direct(os.O_WRONLY)
+        if fd is None:
+            return self._buffered_write(offset, data)
+
+        pool = self._direct
+        buf = pool.acquire()
+        try:
+            with memoryview(data) as dataview, memoryview(buf) as bufview:
+                pos = astart
+                while pos < aend:
+                    n = min(pool.bufsize, aend - pos)
+                    bufview[:n] = dataview[pos-start:pos-start+n]
+                    os.lseek(fd, pos, os.SEEK_SET)
+                    os.writev(fd, [bufview[:n]])
+                    pos += n
+
+                # The unaligned head and tail can't go through O_DIRECT.
+                # They sit in pages of their own, away from the direct range.
+                if start < astart or aend < end:
+                    with self._path.open('r+b') as f:
+                        if start < astart:
+                            f.seek(start)
+                            f.write(dataview[:astart-start])
+                        if aend < end:
+                            f.seek(aend)
+                            f.write(dataview[aend-start:])
+        finally:
+            pool.release(buf)
+            os.close(fd)
+
+    def _buffered_write(self, offset, data):
+        with self._path.open('r+b') as f:
+            f.seek(HEADERSIZE + offset)
+            f.write(data)
+
+    def _lock_data(self, offset, length, exclusive):
+        # Byte-range lock on [offset, offset+length) of the data (length 0:
+        # to the end) for other processes to respect. Returns the fd that
+        # holds it, to be closed to let go; None when not locking.
+        if not self.locking:
+            return None
+        return self._lock_file(HEADERSIZE + offset, length, exclusive)
+
+    def _lock_file(self, start, length, exclusive):
+        fd = os.open(str(self._path), os.O_RDWR if exclusive else os.O_RDONLY)
+        try:
+            _lock_range(fd, exclusive, start, length)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def _lock_tail(self):
+        # Appenders sharing the volume take this lock, on the first byte of
+        # the header, to claim space at the end of the chunk
+        return self._lock_file(0, 1, True)
+
+    @staticmethod
+    def _unlock_data(fd):
+        if fd is not None:
+            os.close(fd)
+
     def read(self, offset, count):
+        traced = _trace.hooks
+        if traced:
+            start = _now()
+
+        self._atime = time.monotonic()
+        fd = self._lock_data(offset, count, False)
+        try:
+            # Big reads are streaming, not lookups. Sending them through the
+            # cache would only push the hot blocks out.
+            if self._cache is not None and count <= self._cache.capacity // 16:
+                data = self._cached_read(offset, count)
+            else:
+                data = self._read(offset, count)
+        finally:
+            self._unlock_data(fd)
+
+        if traced:
+            _trace.emit(traced, 'Chunk.read', self._path, self.chunknum(), offset, len(data), start)
+        return data
+
+    def _read(self, offset, count):
+        if self._direct is not None:
+            count = max(0, min(count, self.size() - offset))
+            buf = bytearray(count)
+            return bytes(buf[:self._direct_readinto(offset, memoryview(buf))])
+
         with self._path.open('rb') as f:
             f.seek(HEADERSIZE + offset)
             return f.read(count)
 
-    def write(self, offset, data):
-        with self._path.open('r+b') as f:
+    def readinto(self, offset, view):
+        traced = _trace.hooks
+        if traced:
+            start = _now()
+
+        self._atime = time.monotonic()
+        fd = self._lock_data(offset, len(view), False)
+        try:
+            if self._cache is not None and len(view) <= self._cache.capacity // 16:
+                data = self._cached_read(offset, len(view))
+                view[:len(data)] = data
+                n = len(data)
+            else:
+                n = self._readinto(offset, view)
+        finally:
+            self._unlock_data(fd)
+
+        if traced:
+            _trace.emit(traced, 'Chunk.read', self._path, self.chunknum(), offset, n, start)
+        return n
+
+    def _readinto(self, offset, view):
+        if self._direct is not None:
+            return self._direct_readinto(offset, view)
+
+        with self._path.open('rb') as f:
             f.seek(HEADERSIZE + offset)
-            f.write(data)
+            return f.readinto(view)
+
+    def write(self, offset, data):
+        traced = _trace.hooks
+        if traced:
+            start = _now()
+
+        self._atime = time.monotonic()
+        self._unshare()
+        self._dirty_header(end=offset + len(data))
+        fd = self._lock_data(offset, len(data), True)
+        try:
+            self._track(offset, offset + len(data))
+            self._write(offset, data)
+        finally:
+            self._unlock_data(fd)
+        self._invalidate(offset, len(data))
+
+        if traced:
+            _trace.emit(traced, 'Chunk.write', self._path, self.chunknum(), offset, len(data), start)
+
+    def _write(self, offset, data):
+        if self._direct is not None:
+            self._direct_write(offset, data)
+        else:
+            self._buffered_write(offset, data)
 
     def truncate(self, size):
+        traced = _trace.hooks
+        if traced:
+            start = _now()
+
+        self._unshare()
+        self._dirty_header(size=size)
+        fd = self._lock_data(size, 0, True)
+        try:
+            oldsize = self.size()
+            self._track(min(size, oldsize), max(size, oldsize))
+            self._truncate(size)
+        finally:
+            self._unlock_data(fd)
+        self._invalidate()
+
+        if traced:
+            _trace.emit(traced, 'Chunk.truncate', self._path, self.chunknum(), size, 0, start)
+
+    def _truncate(self, size):
         with self._path.open('r+b') as f:
             f.truncate(HEADERSIZE + size)
 
+    def flush(self):
+        pass
+
+    def scrub(self):
+        # (start, end) ranges of data failing the format's integrity checks.
+        # Plain chunks have nothing to check.
+        return []
+
     def size(self):
+        length = self._recorded_length()
+        if length is not None:
+            return length
+        return self._stored_size()
+
+    def _stored_size(self):
         return self._path.stat().st_size - HEADERSIZE
 
+    def _unshare(self):
+        # A chunk file hard linked into a snapshot gets a copy of its own
+        # before it is changed. The copy is made under a hidden name and
+        # renamed into place, leaving the old file to the snapshot.
+        if self._unshared_at == _snapshots:
+            return
+        snapshots = _snapshots
+
+        if self._path.stat().st_nlink > 1:
+            tmp = self._path.parent / '.{0}.unshare'.format(self._path.name)
+            try:
+                tmp.unlink()
+            except FileNotFoundError:
+                pass
+
+            _clone_file(self._path, tmp)
+            os.rename(str(tmp), str(self._path))
+            _fsync_dir(self._path.parent)
+
+        self._unshared_at = snapshots
+
+    def update_header(self, **fields):
+        # Add or change header fields, rewriting the header page in place
+        # and durably. The data is untouched, so the hash tree stays valid.
+        self._unshare()
+        self._track(0, 0)
+
+        self._header.fields.update(fields)
+        if self.foreign_writes:
+            # what we read may have been taken out since
+            self._header.fields.pop('length', None)
+        self._write_header(True)
+
+    def _write_header(self, durable):
+        buf = bytearray(HEADERSIZE)
+        self._header.pack_into(buf)
+
+        fd = os.open(str(self._path), os.O_WRONLY)
+        try:
+            os.pwrite(fd, buf, 0)
+            if durable:
+                _fdatasync(fd)
+        finally:
+            os.close(fd)
+
+    def _recorded_length(self):
+        # data length from the header, or None if it isn't known good
+        length = self._header.fields.get('length')
+        if length is None or self.foreign_writes:
+            return None
+        return int(length)
+
+    def _dirty_header(self, size=None, end=None):
+        # Called before a truncate to *size*, or a write ending at *end*.
+        # The first change to the length after it was recorded takes it out
+        # of the header, before the change is made, and flush() records the
+        # new one after it. Neither header write is synced; sync() makes
+        # the header durable along with the data, so a synced header with
+        # a length is right about it.
+        length = self._header.fields.get('length')
+        if length is None:
+            return
+        length = int(length)
+        if (size if size is not None else max(length, end)) == length:
+            return
+
+        if not self.foreign_writes:
+            self._match_length(length)
+        del self._header.fields['length']
+        self._track(0, 0)
+        self._write_header(False)
+
+    def _match_length(self, length):
+        # A crash between syncs can leave the data running past the
+        # recorded length, or stopping short of it. Readers went by the
+        # header; make the data agree before it changes.
+        stored = self._stored_size()
+        if stored != length:
+            self._track(min(stored, length), max(stored, length))
+            self._truncate(length)
+
+    def _record_length(self):
+        # Record the length of a chunk changed since it was last recorded,
+        # at flush, once the data is written. Chunks that a snapshot may
+        # share, or other processes change, are left alone.
+        if (self._header.iface_version >= 2 and not self.foreign_writes
+                and 'length' not in self._header.fields and self._unshared_at == _snapshots):
+            self._header.fields['length'] = str(self.size())
+            self._track(0, 0)
+            self._write_header(False)
+
+    def _sidecars(self):
+        # Hidden files that go with the chunk: moved and erased along with it
+        return [self._treepath()]
+
+    def _treepath(self):
+        return self._path.parent / '.{0}.tree'.format(self._path.name)
+
+    def _track(self, start, end):
+        # Note blocks [start, end) as changed, before the change is made
+        if not self._treetracking:
+            self._treetracking = True
+            leaves = _load_leaves(self._treepath(), MERKLE_BLOCKSIZE, _stamp(self._path))
+            self._treedirty = None if leaves is None else set()
+
+        if self._treedirty is not None and end > start:
+            self._treedirty.update(range(start // MERKLE_BLOCKSIZE, (end - 1) // MERKLE_BLOCKSIZE + 1))
+
+    def _data_ranges(self, start, end):
+        # (offset, length) of each range of [start, end) that may hold
+        # something other than zeros
+        fd = os.open(str(self._path), os.O_RDONLY)
+        try:
+            return [(offset - HEADERSIZE, count) for offset, count
+                    in _data_extents(fd, HEADERSIZE + start, HEADERSIZE + end)]
+        finally:
+            os.close(fd)
+
+    def merkle_tree(self):
+        # The chunk's MerkleTree, with leaves over MERKLE_BLOCKSIZE blocks.
+        # Only blocks changed since the tree was last saved are rehashed.
+        self.flush()
+        bs = MERKLE_BLOCKSIZE
+        size = self.size()
+        nblocks = (size + bs - 1) // bs
+
+        leaves = None
+        restamp = False
+        if self._treetracking and self._treedirty is not None:
+            leaves = _load_leaves(self._treepath(), bs)
+            changed = self._treedirty
+            restamp = True
+        elif not self._treetracking:
+            leaves = _load_leaves(self._treepath(), bs, _stamp(self._path))
+            changed = set()
+        if leaves is None:
+            leaves = []
+            changed = range(nblocks)
+
+        del leaves[nblocks:]
+        changed = set(b for b in changed if b < nblocks)
+        changed.update(range(len(leaves), nblocks))
+        leaves.extend([None] * (nblocks - len(leaves)))
+
+        if changed:
+            self._hash_blocks(leaves, sorted(changed), size)
+        tree = MerkleTree(leaves, (self.chunksize() - HEADERSIZE + bs - 1) // bs)
+        if changed or restamp:
+            _save_leaves(self._treepath(), bs, leaves, _stamp(self._path), tree.root())
+
+        self._treetracking = True
+        self._treedirty = set()
+        return tree
+
+    def merkle_root(self):
+        # Root of merkle_tree(), from the sidecar's header alone while the
+        # chunk hasn't changed since the tree was saved
+        self.flush()
+        if not self._treedirty:
+            root = _load_root(self._treepath(), MERKLE_BLOCKSIZE, _stamp(self._path))
+            if root is not None:
+                return root
+        return self.merkle_tree().root()
+
+    def _hash_blocks(self, leaves, blocks, size):
+        bs = MERKLE_BLOCKSIZE
+        hasdata = set()
+        for offset, count in self._data_ranges(blocks[0] * bs, min((blocks[-1] + 1) * bs, size)):
+            hasdata.update(range(offset // bs, (offset + count - 1) // bs + 1))
+
+        zeros = {}
+        run = []
+        for b in blocks + [None]:
+            # read runs of neighboring blocks with data in one go
+            if run and (b is None or b != run[-1] + 1 or b not in hasdata or len(run) * bs >= COPYBUFSIZE):
+                data = self._read(run[0] * bs, min((run[-1] + 1) * bs, size) - run[0] * bs)
+                with memoryview(data) as view:
+                    for i, rb in enumerate(run):
+                        leaves[rb] = _leaf_hash(view[i*bs:(i+1)*bs])
+                run = []
+            if b is None:
+                break
+
+            if b in hasdata:
+                run.append(b)
+            else:
+                n = min(bs, size - b * bs)
+                if n not in zeros:
+                    zeros[n] = _leaf_hash(bytes(n))
+                leaves[b] = zeros[n]
+
     def erase(self):
+        traced = _trace.hooks
+        if traced:
+            start = _now()
+
         self._path.unlink()
+        self._invalidate()
+        if self._stats is not None:
+            self._stats.chunk_erases += 1
+
+        if traced:
+            _trace.emit(traced, 'Chunk.erase', self._path, self.chunknum(), 0, 0, start)
+        for sidecar in self._sidecars():
+            try:
+                sidecar.unlink()
+            except FileNotFoundError:
+                pass
+        self._treetracking = False
+
+    def move(self, dirpath):
+        # Crash-safe move to another directory: copy to a hidden temporary,
+        # fsync it, rename it into place, and only then drop the original.
+        # A crash leaves either the original alone or two identical copies.
+        #
+        # Sidecars are copied first; a leftover copy of one is harmless. The
+        # copy keeps the chunk's mtime, so its hash tree stays valid.
+        dst = dirpath / self._path.name
+        tmp = dirpath / '.{0}.migrating'.format(self._path.name)
+
+        oldsidecars = [s for s in self._sidecars() if s.exists()]
+        for sidecar in oldsidecars:
+            _copy_file(sidecar, dirpath / sidecar.name)
+
+        st = self._path.stat()
+        _copy_file(self._path, tmp)
+        os.utime(str(tmp), ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.rename(str(tmp), str(dst))
+        _fsync_dir(dirpath)
+
+        src = self._path
+        self._invalidate()
+        self._path = dst
+        self._volkey = None
+
+        src.unlink()
+        for sidecar in oldsidecars:
+            sidecar.unlink()
+        _fsync_dir(src.parent)
+
+    def sync(self):
+        try:
+            fd = os.open(str(self._path), os.O_RDONLY)
+        except FileNotFoundError:
+            # erased since it was dirtied; the directory sync covers that
+            return
 
-class ChunkFile(object):
-    def _open_existing(self, dirpath):
-        entries = list(dirpath.glob('*'))
-        self._chunks = [None] * len(entries)
-        for entry in entries:
-            chunk = Chunk.open(entry)
-            chunknum = chunk.chunknum()
+        try:
+            _fdatasync(fd)
+        finally:
+            os.close(fd)
+
+class StoreChunk(Chunk):
+    # Plain chunk kept as an object in a ChunkStore other than a directory.
+    # Its path is a StorePath: the store, and the object's name. With no
+    # place for a hash tree sidecar, merkle_tree() hashes the whole chunk.
+
+    # stores may buffer writes until flushed
+    buffered = True
+
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, store, chunknum, direct=None, cache=None, **options):
+        path = store / _chunk_name(chunknum)
+        header, buf = cls._new_header(chunknum, **options)
+
+        store.create(path.name)
+        store.write_at(path.name, 0, buf)
+
+        return cls(path, header, direct, cache)
+
+    @classmethod
+    def open(cls, path, direct=None, cache=None):
+        path.parent.open(path.name)
+        header_data = path.parent.read_at(path.name, 0, HEADERSIZE)
+
+        if len(header_data) < HEADERSIZE:
+            raise IOError('{0} is not a valid chunkfile'.format(path))
+
+        header = ChunkFileHeader.unpack_from(header_data)
+        if header.flags():
+            raise UnsupportedVersionError('{0}: only plain chunks can be kept in a {1}'.format(
+                path, type(path.parent).__name__))
+
+        return cls(path, header, direct, cache)
+
+    def _volume(self):
+        return self._path.parent
+
+    def _read(self, offset, count):
+        return self._path.parent.read_at(self._path.name, HEADERSIZE + offset, count)
+
+    def _readinto(self, offset, view):
+        data = self._read(offset, len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def _write(self, offset, data):
+        self._path.parent.write_at(self._path.name, HEADERSIZE + offset, data)
+
+    def _truncate(self, size):
+        self._path.parent.truncate(self._path.name, HEADERSIZE + size)
+
+    def _stored_size(self):
+        return self._path.parent.size(self._path.name) - HEADERSIZE
+
+    def _unshare(self):
+        # stores can't be snapshotted
+        self._unshared_at = _snapshots
+
+    def _write_header(self, durable):
+        buf = bytearray(HEADERSIZE)
+        self._header.pack_into(buf)
+
+        self._path.parent.write_at(self._path.name, 0, buf)
+        if durable:
+            self._path.parent.sync(self._path.name)
+
+    def _sidecars(self):
+        return []
+
+    def _track(self, start, end):
+        pass
+
+    def _data_ranges(self, start, end):
+        return [(start, end - start)] if end > start else []
+
+    def merkle_tree(self):
+        self.flush()
+        bs = MERKLE_BLOCKSIZE
+        size = self.size()
+        nblocks = (size + bs - 1) // bs
+
+        leaves = [None] * nblocks
+        if nblocks:
+            self._hash_blocks(leaves, list(range(nblocks)), size)
+        return MerkleTree(leaves, (self.chunksize() - HEADERSIZE + bs - 1) // bs)
+
+    def merkle_root(self):
+        return self.merkle_tree().root()
+
+    def erase(self):
+        traced = _trace.hooks
+        if traced:
+            start = _now()
+
+        self._path.parent.erase(self._path.name)
+        self._invalidate()
+        if self._stats is not None:
+            self._stats.chunk_erases += 1
+
+        if traced:
+            _trace.emit(traced, 'Chunk.erase', self._path, self.chunknum(), 0, 0, start)
+
+    def move(self, dirpath):
+        raise NotImplementedError('chunks in a {0} cannot move'.format(type(self._path.parent).__name__))
+
+    def flush(self):
+        self._path.parent.flush(self._path.name)
 
-            if self._chunks[chunknum]:
-                raise IOError('Multiple files with chunknum {0:0>11d}'.format(chunknum))
+    def sync(self):
+        try:
+            self._path.parent.sync(self._path.name)
+        except FileNotFoundError:
+            # erased since it was dirtied
+            pass
+
+class _GroupCommitThread(threading.Thread):
+    def __init__(self, chunkfile, policy):
+        super(_GroupCommitThread, self).__init__(name='chunkfile-sync')
+        self.daemon = True
+        self._cf = chunkfile
+        self._policy = policy
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._unsynced = 0
+        self._first_write = None
+        self.error = None
+
+    def wrote(self, nbytes):
+        with self._cond:
+            if self._first_write is None:
+                self._first_write = time.monotonic()
+            self._unsynced += nbytes
+
+            if self._policy.nbytes is not None and self._unsynced >= self._policy.nbytes:
+                self._cond.notify()
+            elif self._unsynced == nbytes:
+                # first write since the last sync starts the ms timer
+                self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self.join()
+
+    def _due(self):
+        if self._first_write is None:
+            return False
+        if self._policy.nbytes is not None and self._unsynced >= self._policy.nbytes:
+            return True
+        if self._policy.ms is not None:
+            return time.monotonic() - self._first_write >= self._policy.ms / 1000.0
+        return False
 
-            self._chunks[chunknum] = chunk
+    def _timeout(self):
+        if self._first_write is None or self._policy.ms is None:
+            return None
+        return max(0, self._first_write + self._policy.ms / 1000.0 - time.monotonic())
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._stopping and not self._due():
+                    self._cond.wait(self._timeout())
+                if self._stopping:
+                    return
+                self._unsynced = 0
+                self._first_write = None
+
+            try:
+                self._cf._sync_dirty()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+class _WriteBehind(object):
+    # Bounded write-behind queue. write() hands data over here and returns;
+    # writer threads land it in the chunk files. Each chunk always goes to
+    # the same writer, so writes to one chunk land in the order they were
+    # made.
+
+    def __init__(self, chunkfile, budget, nwriters):
+        self._cf = chunkfile
+        self._budget = budget
+        self._queued = 0
+        self._end = 0
+        self._cond = threading.Condition()
+        self._queues = [collections.deque() for _ in range(nwriters)]
+        self._stopping = False
+        self.error = None
+
+        self._threads = []
+        for i in range(nwriters):
+            t = threading.Thread(target=self._run, args=(self._queues[i],),
+                                 name='chunkfile-writer-{0}'.format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def end(self):
+        # end of the queued data, which may not be on disk yet
+        return self._end
+
+    def reset_end(self):
+        self._end = 0
+
+    def submit(self, pieces, end):
+        nbytes = sum(len(data) for chunk, offset, data in pieces)
+
+        with self._cond:
+            # a write bigger than the whole budget goes through on its own
+            while self._queued and self._queued + nbytes > self._budget and self.error is None:
+                self._cond.wait()
+
+            self._raise_error()
+
+            for piece in pieces:
+                chunk = piece[0]
+                self._queues[chunk.chunknum() % len(self._queues)].append(piece)
+            self._queued += nbytes
+            self._end = max(self._end, end)
+            self._cond.notify_all()
+
+    def drain(self):
+        with self._cond:
+            while self._queued:
+                self._cond.wait()
+
+            self._raise_error()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        for t in self._threads:
+            t.join()
+
+    def _raise_error(self):
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+
+    def _run(self, queue):
+        while True:
+            with self._cond:
+                while not queue and not self._stopping:
+                    self._cond.wait()
+                if not queue:
+                    return
+                chunk, offset, data = queue.popleft()
+                failed = self.error is not None
+
+            try:
+                # after a failure, drop queued data until the error is seen
+                if not failed:
+                    chunk.write(offset, data)
+                    self._cf._wrote(chunk, len(data))
+            except Exception as e:
+                with self._cond:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                with self._cond:
+                    self._queued -= len(data)
+                    self._cond.notify_all()
+
+def _scrub_chunk(path):
+    # verify() worker; runs in a separate process
+    return Chunk.open(Path(path)).scrub()
+
+# map_chunks() worker state: each worker process opens the volume once
+_mapvolume = None
+_mapfunc = None
+_mapoverlap = 0
+
+def _map_init(dirpaths, kwargs, func, overlap):
+    global _mapvolume, _mapfunc, _mapoverlap
+    _mapvolume = ChunkFile(dirpaths, 'rb', **kwargs)
+    _mapfunc = func
+    _mapoverlap = overlap
+
+def _map_chunk(chunknum):
+    datasize = _mapvolume._chunkdatasize
+    return _mapfunc(chunknum * datasize, _mapvolume._do_read(chunknum * datasize, datasize + _mapoverlap))
+
+# _ChunkTable directory number for "no chunk here (yet)"
+_NODIR = 0xffff
+
+class _ChunkTable(object):
+    # ChunkFile._chunks: the chunks of a volume, in order. A volume can have
+    # millions of chunks, so for most of them all that is kept is the number
+    # of the directory they are in. The Chunk object is made the first time
+    # the chunk is used, from the path that and its chunk number give.
+
+    __slots__ = ('_volume', '_dirs', '_where', '_loaded')
+
+    def __init__(self, volume, dirs, where=None, loaded=None):
+        self._volume = volume
+        self._dirs = list(dirs)
+        self._where = array.array('H') if where is None else where
+        # position -> Chunk, for the chunks made so far
+        self._loaded = loaded or {}
+
+    def __len__(self):
+        return len(self._where)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._chunk(j) for j in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('chunk index out of range')
+        return self._chunk(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._chunk(i)
+
+    def __delitem__(self, i):
+        # contiguous slices only
+        start, stop, _ = i.indices(len(self))
+        if stop <= start:
+            return
+
+        del self._where[start:stop]
+        n = stop - start
+        self._loaded = dict((j if j < start else j - n, chunk)
+                            for j, chunk in self._loaded.items() if not start <= j < stop)
+
+    def append(self, chunk):
+        dirpath = chunk._path.parent
+        if dirpath not in self._dirs:
+            self._dirs.append(dirpath)
+        self._where.append(self._dirs.index(dirpath))
+        self._loaded[len(self._where) - 1] = chunk
+
+    def _chunk(self, i):
+        chunk = self._loaded.get(i)
+        if chunk is None:
+            chunk = self._volume._load_chunk(self.path(i), self._volume._first + i)
+            self._loaded[i] = chunk
+        return chunk
+
+    def loaded(self, i):
+        # the Chunk at i if it was made already, else None
+        return self._loaded.get(i)
+
+    def dirpath(self, i):
+        chunk = self._loaded.get(i)
+        return self._dirs[self._where[i]] if chunk is None else chunk._path.parent
+
+    def path(self, i):
+        chunk = self._loaded.get(i)
+        if chunk is None:
+            return self._dirs[self._where[i]] / _chunk_name(self._volume._first + i)
+        return chunk._path
+
+    def atime(self, i):
+        chunk = self._loaded.get(i)
+        return 0 if chunk is None else chunk._atime
+
+def round_robin(chunknum, dirpaths):
+    # Default chunk placement: chunk N goes to directory N mod len(dirpaths)
+    return dirpaths[chunknum % len(dirpaths)]
 
-    def _create_new(self, dirpath):
-        if dirpath.exists():
-            self._open_existing(dirpath)
+class ChunkFile(object):
+    def _open_existing(self):
+        dirs = self._scan_dirs()
+        # chunk numbers found in each directory
+        numbers = []
+        # Chunks for files not named after their chunk number
+        odd = {}
+        for dirpath in dirs:
+            found = array.array('q')
+            numbers.append(found)
+            for name, path, isfile in self._list_dir(dirpath):
+                # hidden names are ours: temporaries, indexes and the like
+                if name.startswith('.'):
+                    continue
+
+                chunknum = _chunk_number(name)
+                if chunknum is None or not isfile:
+                    # whatever it is had better be a chunk
+                    chunk = self._open_chunk(path())
+                    chunknum = chunk.chunknum()
+                    if chunknum in odd:
+                        raise IOError('Multiple files with chunknum {0:0>11d}'.format(chunknum))
+                    odd[chunknum] = chunk
+                found.append(chunknum)
+
+        total = sum(len(found) for found in numbers)
+        if not total:
+            self._first = 0
+            self._chunks = _ChunkTable(self, dirs)
+            self._chunkdatasize = CHUNKDATASIZE
+            return
+
+        low = min(min(found) for found in numbers if found)
+        high = max(max(found) for found in numbers if found)
+
+        def chunk_at(chunknum, d):
+            if chunknum in odd:
+                return odd[chunknum]
+            return self._load_chunk(dirs[d] / _chunk_name(chunknum), chunknum)
+
+        # A log that dropped its oldest chunks starts at the lowest one, which
+        # is marked logstart. One being dropped is marked with where the log
+        # is to start instead; it goes last, after the chunks above it.
+        # the lowest chunk tells which volume this is, and its chunk size
+        self._volid = self._chunkdatasize = None
+        lowest = chunk_at(low, [low in found for found in numbers].index(True))
+        if lowest.chunksize() <= HEADERSIZE:
+            raise InvalidHeaderError('{0} has chunks of {1} bytes, too small for the header'.format(
+                self._name, lowest.chunksize()))
+        self._volid = lowest._header.fields.get('volume')
+        self._chunkdatasize = lowest.chunksize() - HEADERSIZE
+        if 'dropto' in lowest._header.fields:
+            self._first = int(lowest._header.fields['dropto'])
+        elif 'logstart' in lowest._header.fields or low == 0:
+            self._first = low
+        else:
+            # Unmarked chunks below the start of the log: take the highest
+            # chunk marked logstart, reading every header to find it
+            starts = [n for d, found in enumerate(numbers) for n in found
+                      if n == low or 'logstart' in chunk_at(n, d)._header.fields]
+            self._first = max(starts) if len(starts) > 1 else 0
+
+        if low < self._first and 'w' in self._access:
+            doomed = sorted(((n, d) for d, found in enumerate(numbers) for n in found
+                             if n < self._first), reverse=True)
+            for n, d in doomed:
+                (lowest if n == low else chunk_at(n, d)).erase()
+
+        # Every number from the first on is there exactly once, barring
+        # copies left by a migration
+        if high < self._first:
+            where = array.array('H')
+        elif high - self._first + 1 > total:
+            have = set(n for found in numbers for n in found)
+            missing = next(n for n in range(self._first, high) if n not in have)
+            raise IOError('Missing chunk {0:0>11d}'.format(missing))
         else:
-            if not dirpath.parent.exists():
-                # same behavior as trying to open a file in a directory that doesn't exist
-                raise IOError('No such file or directory: {0}'.format(dirpath))
+            where = array.array('H', [_NODIR]) * (high - self._first + 1)
+
+        for d, found in enumerate(numbers):
+            for n in found:
+                if n < self._first:
+                    continue
+
+                i = n - self._first
+                if where[i] != _NODIR:
+                    if dirs[d] == self._slowdir and dirs[where[i]] != self._slowdir:
+                        # A migration stopped after the copy was in place,
+                        # but before the original was removed. Both are
+                        # complete; keep the original.
+                        if 'w' in self._access:
+                            (dirs[d] / _chunk_name(n)).unlink()
+                        continue
+
+                    raise IOError('Multiple files with chunknum {0:0>11d}'.format(n))
+                where[i] = d
+
+        if _NODIR in where:
+            raise IOError('Missing chunk {0:0>11d}'.format(self._first + where.index(_NODIR)))
+
+        loaded = dict((n - self._first, chunk) for n, chunk in odd.items() if n >= self._first)
+        if low >= self._first:
+            loaded[low - self._first] = lowest
+        self._chunks = _ChunkTable(self, dirs, where, loaded)
+
+        # chunks we already had keep their state, with the new header
+        for path, chunk in self._known.items():
+            i = chunk.chunknum() - self._first
+            if 0 <= i < len(where) and self._chunks.path(i) == path:
+                chunk._header = self._chunks[i]._header
+                self._chunks._loaded[i] = chunk
+
+    def _list_dir(self, dirpath):
+        # (name, path maker, is it a file) for everything in a directory
+        if self._store is not None:
+            for name in self._store.list():
+                yield name, lambda name=name: self._store / name, True
+            return
+
+        with os.scandir(str(dirpath)) as entries:
+            for entry in entries:
+                yield entry.name, lambda entry=entry: Path(entry.path), entry.is_file()
+
+    def _init_chunk(self, chunk):
+        chunk.verify_reads = self._verify_reads
+        chunk.locking = self._shared
+        chunk.foreign_writes = self._shared or self._following
+        chunk._stats = self._stats
+        return chunk
+
+    def _open_chunk(self, path):
+        traced = _trace.hooks
+        if traced:
+            start = _now()
+
+        chunk = self._init_chunk(self._openclass.open(path, self._pool, self._cache))
+        if self._stats is not None:
+            self._stats.chunk_opens += 1
+
+        if traced:
+            _trace.emit(traced, 'Chunk.open', path, chunk.chunknum(), 0, 0, start)
+        return chunk
+
+    def _load_chunk(self, path, chunknum):
+        chunk = self._open_chunk(path)
+        if chunk.chunknum() != chunknum:
+            raise IOError('{0} holds chunk {1:0>11d}, not {2:0>11d}'.format(path, chunk.chunknum(), chunknum))
+        volume = chunk._header.fields.get('volume')
+        if volume is not None and self._volid is not None and volume != self._volid:
+            raise IOError('{0} belongs to another volume'.format(path))
+        if self._chunkdatasize is not None and chunk.chunksize() != self._chunkdatasize + HEADERSIZE:
+            raise IOError('{0} has chunks of {1} bytes, not {2}'.format(
+                path, chunk.chunksize(), self._chunkdatasize + HEADERSIZE))
+        return chunk
+
+    def _scan_dirs(self):
+        if self._slowdir is None:
+            return self._dirpaths
+        return self._dirpaths + [self._slowdir]
+
+    def _make_dirs(self):
+        if self._store is not None:
+            return
+
+        for dirpath in self._scan_dirs():
+            if not dirpath.exists():
+                if not dirpath.parent.exists():
+                    # same behavior as trying to open a file in a directory that doesn't exist
+                    raise IOError('No such file or directory: {0}'.format(dirpath))
+
+                dirpath.mkdir()
 
-            dirpath.mkdir()
-            self._chunks = []
+    def _open_generation(self):
+        if self._shared:
+            flags = os.O_RDWR if self._mode[0] != 'r' or '+' in self._mode else os.O_RDONLY
+            self._genfd = os.open(str(self._dirpath / GENERATIONNAME), flags | os.O_CREAT, 0o666)
 
-        self.truncate(0)
+    def _create_new(self):
+        self._make_dirs()
+        self._open_generation()
+        self._lock_layout()
+        try:
+            self._refresh()
+            # a fresh volume starts at offset 0, even where a log left off
+            if self._first:
+                self._drop_front(len(self._chunks))
+                self._first = 0
+            self.truncate(0)
+            # and is a new volume, whose chunks get a new UUID and the
+            # default size
+            self._volid = None
+            self._chunkdatasize = CHUNKDATASIZE
+        finally:
+            self._unlock_layout()
 
     def _add_new_chunk(self):
-        self._chunks.append(Chunk.create(self._dirpath, len(self._chunks)))
+        self._lock_layout()
+        try:
+            # someone else may have added it
+            wanted = self._first + len(self._chunks)
+            self._check_layout()
+            if self._first + len(self._chunks) <= wanted:
+                self._create_chunk()
+                self._layout_changed()
+        finally:
+            self._unlock_layout()
+
+    def _create_chunk(self):
+        traced = _trace.hooks
+        if traced:
+            start = _now()
+
+        chunknum = self._first + len(self._chunks)
+        dirpath = self._placement(chunknum, self._dirpaths)
+        if self._store is None:
+            dirpath = Path(dirpath)
+        if dirpath not in self._dirpaths:
+            raise ValueError('placement chose {0}, which is not one of the volume directories'.format(dirpath))
+        if self._volid is None and not self._chunks:
+            self._volid = uuid.uuid4().hex
+        # the change this chunk is part of bumps the generation
+        header = {'generation': str(self._volume_generation() + 1)}
+        if self._volid is not None:
+            header['volume'] = self._volid
+        chunk = self._init_chunk(self._chunkclass.create(dirpath, chunknum, self._pool, self._cache,
+                                                         header=header,
+                                                         chunksize=self._chunkdatasize + HEADERSIZE,
+                                                         **self._chunkopts))
+        if self._first and not self._chunks:
+            chunk.update_header(logstart='1')
+        self._chunks.append(chunk)
+        if self._stats is not None:
+            self._stats.chunk_creates += 1
+        if traced:
+            _trace.emit(traced, 'Chunk.create', chunk._path, chunknum, 0, 0, start)
+
+        self._mark_dirty(chunk)
+        with self._synclock:
+            self._dirtydirs.add(dirpath)
+
+        if self._hot_chunks is not None:
+            self._migrate(max_hot=self._hot_chunks)
+        if self._retain_bytes is not None or self._retain_chunks is not None:
+            self._retire()
+
+    def _retire(self):
+        # Log retention: drop the oldest chunks that neither cap needs
+        held = self._nbytes() - self._first * self._chunkdatasize
+        ndrop = 0
+        while ndrop < len(self._chunks) - 1:
+            size = self._chunks[ndrop].size()
+            too_many = self._retain_chunks is not None and len(self._chunks) - ndrop > self._retain_chunks
+            too_big = self._retain_bytes is not None and held - size >= self._retain_bytes
+            if not (too_many or too_big):
+                break
+            held -= size
+            ndrop += 1
+
+        if ndrop:
+            self._drop_front(ndrop)
+
+    def _drop_front(self, n):
+        # Erase the first n chunks. The new first chunk is marked as the
+        # start of the log, and the old one with where the log is to start,
+        # beforehand. The old first chunk is erased last, so a crash part
+        # way leaves chunks that the next open knows to finish dropping.
+        self._drain_writes()
+
+        self._lock_layout()
+        try:
+            self._volume_generation()
+            if n < len(self._chunks):
+                self._chunks[n].update_header(logstart='1')
+            if n:
+                self._chunks[0].update_header(dropto=str(self._first + n))
+
+            for chunk in reversed(self._chunks[:n]):
+                chunk.erase()
+                self._forget_chunk(chunk)
+
+            del self._chunks[:n]
+            self._first += n
+            self._layout_changed()
+        finally:
+            self._unlock_layout()
+
+    def _forget_chunk(self, chunk):
+        # bookkeeping for an erased chunk
+        with self._synclock:
+            self._dirty.discard(chunk)
+            self._unflushed.discard(chunk)
+            self._dirtydirs.add(chunk._path.parent)
+
+    def _check_dropped(self, offset):
+        if offset < self._first * self._chunkdatasize:
+            raise IOError('Offset {0} was dropped from the log, which now starts at {1}'.format(
+                offset, self._first * self._chunkdatasize))
+
+    def _migrate(self, max_hot=None, idle=None):
+        self._drain_writes()
+
+        # The tail chunk is where appends go; it always stays hot. Chunks
+        # not used since the volume was opened count as the least recent.
+        table = self._chunks
+        candidates = [i for i in range(len(table) - 1) if table.dirpath(i) != self._slowdir]
+        candidates.sort(key=table.atime)
+
+        if max_hot is None and idle is None:
+            doomed = candidates
+        else:
+            doomed = set()
+            if max_hot is not None:
+                nhot = len(candidates) + (1 if table else 0)
+                doomed.update(candidates[:max(0, nhot - max_hot)])
+            if idle is not None:
+                cutoff = time.monotonic() - idle
+                doomed.update(i for i in candidates if table.atime(i) <= cutoff)
+            doomed = [i for i in candidates if i in doomed]
+        doomed = [table[i] for i in doomed]
+
+        self._lock_layout()
+        try:
+            for chunk in doomed:
+                # the copy is fsynced as part of the move
+                with self._synclock:
+                    self._dirty.discard(chunk)
+                chunk.move(self._slowdir)
+            if doomed:
+                self._layout_changed()
+        finally:
+            self._unlock_layout()
+
+        return len(doomed)
+
+    def _mark_dirty(self, chunk):
+        with self._synclock:
+            self._dirty.add(chunk)
+            self._unflushed.add(chunk)
+
+    def _flush_chunks(self):
+        # Flush the chunks changed since the last flush, and record their
+        # lengths in their headers
+        with self._synclock:
+            unflushed, self._unflushed = self._unflushed, set()
+
+        for chunk in unflushed:
+            chunk.flush()
+            chunk._record_length()
+
+    def _truncate_chunk(self, chunk, size):
+        # Full chunks ahead of the new end usually already have the right
+        # size; leaving them alone keeps them out of the next sync.
+        if chunk.size() != size:
+            chunk.truncate(size)
+            self._mark_dirty(chunk)
+
+    def _sync_dirty(self):
+        with self._synclock:
+            dirty, self._dirty = self._dirty, set()
+            dirtydirs, self._dirtydirs = self._dirtydirs, set()
+
+        if len(dirty) > 1:
+            with ThreadPoolExecutor(min(len(dirty), SYNC_THREADS)) as pool:
+                for _ in pool.map(Chunk.sync, dirty):
+                    pass
+        else:
+            for chunk in dirty:
+                chunk.sync()
 
-    def _do_read(self, offset, length):
-        n = offset // CHUNKDATASIZE
-        if n >= len(self._chunks):
-            return b''
+        for dirpath in dirtydirs:
+            if self._store is not None:
+                self._store.sync()
+            else:
+                _fsync_dir(dirpath)
+
+    def _check_sync_error(self):
+        if self._committer is not None and self._committer.error is not None:
+            e, self._committer.error = self._committer.error, None
+            raise e
+
+    def _read_segments(self, offset, length):
+        # Split a read at chunk boundaries into (chunk, chunk offset, length)
+        # segments, stopping at the last chunk.
+        segments = []
+        if length > 0:
+            self._check_dropped(offset)
+        n = offset // self._chunkdatasize - self._first
+        chunkofs = offset % self._chunkdatasize
+        while length > 0 and n < len(self._chunks):
+            nbytes = min(length, self._chunkdatasize - chunkofs)
+            segments.append((self._chunks[n], chunkofs, nbytes))
+
+            length -= nbytes
+            n += 1
+            chunkofs = 0
+
+        if self._stats is not None and len(segments) > 1:
+            self._stats.boundary_crossings += len(segments) - 1
+        return segments
+
+    def _run_segments(self, func, segments):
+        # Segments in different chunks are independent, so with more than
+        # one they can run on the executor and drive several disks at once.
+        if self._executor is not None and len(segments) > 1:
+            return list(self._executor.map(lambda seg: func(*seg), segments))
+
+        return [func(*seg) for seg in segments]
 
-        s = self._chunks[n].read(offset % CHUNKDATASIZE, length)
+    def _do_read(self, offset, length):
+        segments = self._read_segments(offset, length)
+        pieces = self._run_segments(lambda chunk, chunkofs, nbytes: chunk.read(chunkofs, nbytes), segments)
+
+        # Only the last chunk can be short; anything read past a short
+        # piece would not be contiguous with it.
+        for i, (piece, segment) in enumerate(zip(pieces, segments)):
+            if len(piece) < segment[2]:
+                del pieces[i+1:]
+                break
+
+        return b''.join(pieces)
+
+    def _do_readinto(self, offset, view):
+        segments = []
+        pos = 0
+        for chunk, chunkofs, nbytes in self._read_segments(offset, len(view)):
+            segments.append((chunk, chunkofs, view[pos:pos+nbytes]))
+            pos += nbytes
+
+        counts = self._run_segments(lambda chunk, chunkofs, v: chunk.readinto(chunkofs, v), segments)
+
+        nread = 0
+        for count, segment in zip(counts, segments):
+            nread += count
+            if count < len(segment[2]):
+                break
+
+        return nread
+
+    def _write_pieces(self, offset, data):
+        # Split a write at chunk boundaries into (chunk, chunk offset, data)
+        # pieces, creating chunks as needed.
+        pieces = []
+        pos = 0
+        self._check_dropped(offset)
+        while True:
+            chunknum = (offset + pos) // self._chunkdatasize
+            if chunknum >= self._first + len(self._chunks):
+                # Writing past the end zero-fills the gap, so every chunk
+                # before the one written to has to be full. A tail this
+                # write fills anyway is left to it: zero-filling first would
+                # show readers zeros where the data is about to go.
+                if self._chunks and not self._fills_tail(pieces):
+                    self._truncate_chunk(self._chunks[-1], self._chunkdatasize)
+                while chunknum >= self._first + len(self._chunks):
+                    if self._first + len(self._chunks) < chunknum:
+                        self._add_new_chunk()
+                        self._truncate_chunk(self._chunks[-1], self._chunkdatasize)
+                    else:
+                        self._add_new_chunk()
+
+            chunkofs = (offset + pos) % self._chunkdatasize
+            nbytes = min(len(data) - pos, self._chunkdatasize - chunkofs)
+            pieces.append((chunknum, chunkofs, data[pos:pos+nbytes]))
+
+            pos += nbytes
+            if pos >= len(data):
+                break
+
+        if self._stats is not None and len(pieces) > 1:
+            self._stats.boundary_crossings += len(pieces) - 1
+
+        # A log may have dropped chunks written early on in a long write
+        return [(self._chunks[chunknum - self._first], chunkofs, piece)
+                for chunknum, chunkofs, piece in pieces if chunknum >= self._first]
+
+    def _fills_tail(self, pieces):
+        # Whether the last piece so far runs from no later than the end of
+        # the tail chunk to its full size
+        if not pieces:
+            return False
+        tail = self._first + len(self._chunks) - 1
+        chunknum, chunkofs, piece = pieces[-1]
+        return chunknum == tail and chunkofs + len(piece) == self._chunkdatasize and chunkofs <= self._chunks[-1].size()
 
-        if len(s) < length and n+1 < len(self._chunks):
-            s += self._do_read(offset + len(s), length - len(s))
+    def _do_write(self, offset, data):
+        pieces = self._write_pieces(offset, memoryview(data).cast('B'))
+        self._run_segments(lambda chunk, chunkofs, piece: chunk.write(chunkofs, piece), pieces)
 
-        return s
+        for chunk, chunkofs, piece in pieces:
+            self._wrote(chunk, len(piece))
 
-    def _do_write(self, offset, data):
-        n = offset // CHUNKDATASIZE
-        while n >= len(self._chunks):
-            self._add_new_chunk()
+    def _wrote(self, chunk, nbytes):
+        self._mark_dirty(chunk)
 
-        nextchunkofs = (n+1) * CHUNKDATASIZE
-        nbytes = nextchunkofs - offset
-        self._chunks[n].write(offset % CHUNKDATASIZE, data[:nbytes])
+        if self._committer is not None:
+            self._committer.wrote(nbytes)
 
-        if len(data) > nbytes:
-            self._do_write(nextchunkofs, data[nbytes:])
+    def _drain_writes(self):
+        if self._writebehind is not None:
+            self._writebehind.drain()
 
     def _nbytes(self):
-        return sum([chunk.size() for chunk in self._chunks])
+        # every chunk but the last is full
+        nbytes = (self._first + len(self._chunks)) * self._chunkdatasize
+        if self._chunks:
+            nbytes -= self._chunkdatasize - self._chunks[-1].size()
+
+        if self._writebehind is not None:
+            nbytes = max(nbytes, self._writebehind.end())
+
+        return nbytes
+
+    # A volume's generation is bumped by every change to its set of chunks
+    # (new, erased, dropped or migrated ones), and kept in the header of its
+    # tail chunk. Volumes opened with shared=True also keep it in a hidden
+    # file. Changes are made under an exclusive lock on the file and
+    # rescans under a shared one. Each ChunkFile compares the file with the
+    # generation it last scanned before reading, writing or finding the
+    # end, and rescans when they differ.
+
+    def _volume_generation(self):
+        # Read from the tail chunk when first needed. Call before erasing
+        # the tail: the chunk before it may have an older one.
+        if self._generation is None:
+            self._generation = 0
+            if self._chunks:
+                self._generation = int(self._chunks[-1]._header.fields.get('generation', 0))
+        return self._generation
+
+    def _read_generation(self):
+        data = os.pread(self._genfd, _GENERATION.size, 0)
+        return _GENERATION.unpack(data)[0] if len(data) == _GENERATION.size else 0
+
+    def _lock_layout(self):
+        # Nests: only the outermost call takes the lock
+        if self._genfd is None:
+            return
+        if not self._layoutdepth:
+            _lock_range(self._genfd, 'w' in self._access, 0, 0)
+        self._layoutdepth += 1
+
+    def _unlock_layout(self):
+        if self._genfd is None:
+            return
+        self._layoutdepth -= 1
+        if not self._layoutdepth:
+            _unlock_range(self._genfd, 0, 0)
+
+    def _layout_changed(self):
+        # call with the layout locked, after changing it
+        generation = self._volume_generation() + 1
+        if self._genfd is not None:
+            generation = max(generation, self._read_generation() + 1)
+            os.pwrite(self._genfd, _GENERATION.pack(generation), 0)
+            self._genseen = generation
+        self._generation = generation
+
+        # into the tail's header; new chunks were made with it already
+        if self._chunks:
+            tail = self._chunks[-1]
+            if tail._header.fields.get('generation', str(generation)) != str(generation):
+                tail.update_header(generation=str(generation))
+
+    def _check_layout(self):
+        if self._genfd is not None and self._read_generation() != self._genseen:
+            self._refresh()
+
+    def _refresh(self):
+        self._drain_writes()
+        self._flush_chunks()
+
+        self._lock_layout()
+        try:
+            if self._genfd is not None:
+                self._genseen = self._read_generation()
+            self._generation = None
+            # chunks we already have keep their state
+            self._known = dict((chunk._path, chunk) for chunk in self._chunks._loaded.values())
+            try:
+                self._open_existing()
+            finally:
+                self._known = {}
+        finally:
+            self._unlock_layout()
+
+    def _reserve(self, nbytes):
+        # Claim nbytes at the end of a shared volume for an append, and grow
+        # the volume over them; returns their offset. The claim is made
+        # under the tail chunk's lock, so appenders in other processes get
+        # ranges of their own. The data is written afterwards, unlocked.
+        while True:
+            self._check_layout()
+            if not self._chunks:
+                self._add_new_chunk()
+                continue
+
+            fds = [self._chunks[-1]._lock_tail()]
+            try:
+                # the tail may have been filled, or the volume truncated,
+                # while we waited
+                if self._read_generation() != self._genseen:
+                    continue
+
+                chunknum = len(self._chunks) - 1
+                offset = (self._first + chunknum) * self._chunkdatasize + self._chunks[-1].size()
+                end = offset + nbytes
+                if end <= (self._first + len(self._chunks)) * self._chunkdatasize:
+                    self._truncate_chunk(self._chunks[-1], end - (self._first + chunknum) * self._chunkdatasize)
+                    return offset
+
+                # Spilling over: the new chunks are created, and locked
+                # before anyone else can see them, with the tail held
+                self._lock_layout()
+                try:
+                    while (self._first + len(self._chunks)) * self._chunkdatasize < end:
+                        self._truncate_chunk(self._chunks[-1], self._chunkdatasize)
+                        self._create_chunk()
+                        fds.append(self._chunks[-1]._lock_tail())
+                    self._layout_changed()
+                finally:
+                    self._unlock_layout()
+
+                self._truncate_chunk(self._chunks[-1], end - (self._first + len(self._chunks) - 1) * self._chunkdatasize)
+                return offset
+            finally:
+                for fd in fds:
+                    os.close(fd)
 
     # public API starts here
 
@@ -230,15 +2055,228 @@ class ChunkFile(object):
     # Accordingly, we won't support 'U' in mode, or 1 for buffering.
     # Mode must contain 'b' (text data not supported)
 
-    def __init__(self, dirpath, mode='ab'):
-        self._name = str(dirpath)
-        self._dirpath = Path(dirpath)
+    #
+    # Beyond the file API, direct=True moves chunk data through O_DIRECT so
+    # large sequential transfers bypass the page cache.
+    #
+    # durability picks when written data is made crash-safe with sync():
+    #   'none': only when sync() is called. Default.
+    #   'on_close': at close()
+    #   'every_write': before every write() returns
+    #   GroupCommit(nbytes, ms): from a background thread, batching writes
+    #
+    # write_behind=nbytes makes write() queue a copy of its data and return,
+    # while *writers* background threads write it out. write() only blocks
+    # when nbytes are already queued. Errors from the writers are raised by
+    # the next write(), flush() or close().
+    #
+    # cache=True reads through the process-wide BlockCache.default(); a
+    # BlockCache instance can be passed instead, or a SharedBlockCache to
+    # cache blocks once for every process on the host.
+    #
+    # dirpath may also be a ChunkStore, such as a MemoryStore or a
+    # LocalObjectStore, to keep the chunks in. Volumes in a store use plain
+    # chunks only, and can't be opened with the options below that work on
+    # chunk files directly (direct, slow_tier, compression, checksum,
+    # dedup, shared). A DirectoryStore is the same as its directory.
+    #
+    # dirpath may also be a list of directories to stripe the chunks over.
+    # placement(chunknum, dirpaths) picks the directory for each new chunk,
+    # round robin by default. Reads and writes spanning several chunks use
+    # up to *parallelism* threads; by default one per directory.
+    #
+    # slow_tier names a directory for cold chunks. New chunks are always
+    # placed in dirpath, and migrate() moves chunks that haven't been used
+    # recently to slow_tier. hot_chunks=N migrates after each new chunk so
+    # that no more than N chunks stay in dirpath.
+    #
+    # compression='zlib', 'lzma' or 'zstd' creates new chunks in the
+    # compressed format, in blocks of compress_blocksize bytes. Existing
+    # chunks keep whatever format they were written in.
+    #
+    # dedup=True creates new chunks in the dedup format: their data is cut
+    # into blocks of dedup_blocksize bytes, and each distinct block is kept
+    # once per volume directory, however many times it occurs. Such volumes
+    # can't be snapshotted, copied with copy(), shared or tiered.
+    #
+    # retain_bytes and retain_chunks make the volume a log that drops its
+    # oldest chunks, one unlink each, once a new chunk takes it over either
+    # cap; the newest retain_bytes bytes (or retain_chunks chunks) are always
+    # kept. Offsets don't move when chunks are dropped: start tells where
+    # the data now begins, and reading or writing before it raises IOError.
+    #
+    # checksum='crc32', 'crc32c' or 'xxh64' creates new chunks that keep a
+    # checksum for every checksum_blocksize bytes of data. verify() checks
+    # them all; verify_reads=True also checks the blocks under every read,
+    # raising ChecksumError on a mismatch.
+    #
+    # shared=True lets several processes open the volume at once. Reads
+    # and writes take fcntl byte-range locks on the chunks they touch, each
+    # ChunkFile picks up chunks added or removed by the others on its next
+    # operation (or at refresh()), and appends in 'a' mode get ranges of
+    # their own, even when they race. Mixing such appends with positional
+    # writes past the end in other processes is not supported. Compressed
+    # chunks and a BlockCache keep state in memory and can't be shared; a
+    # SharedBlockCache can.
+    #
+    # metrics=True counts operations, bytes, chunk opens, creates and
+    # erases, reads and writes crossing chunk boundaries and block cache
+    # hits, and keeps latency histograms, for stats() and process_stats().
+    # The default is off, unless enable_metrics() was called.
+
+    def __init__(self, dirpath, mode='ab', direct=False, durability='none',
+                 write_behind=None, writers=1, cache=None, placement=round_robin,
+                 parallelism=None, slow_tier=None, hot_chunks=None,
+                 compression=None, compress_blocksize=None, checksum=None,
+                 checksum_blocksize=None, verify_reads=False, dedup=False, dedup_blocksize=None,
+                 retain_bytes=None, retain_chunks=None, shared=False, metrics=None):
+        # Stats when collecting metrics, else None. Chunks made from here
+        # on count into it.
+        self._stats = None
+        if metrics or (metrics is None and _metrics_enabled()):
+            self._stats = Stats()
+            _register_stats(self._stats)
+            # a volume never closed still adds to the process total
+            self._statsdone = weakref.finalize(self, _retire_stats, self._stats)
+
+        # a ChunkStore other than a directory, or None
+        self._store = None
+        if isinstance(dirpath, DirectoryStore):
+            dirpath = dirpath.dirpath
+
+        if isinstance(dirpath, (list, tuple)):
+            if not dirpath:
+                raise ValueError('At least one directory is needed')
+            self._name = [str(d) for d in dirpath]
+            self._dirpaths = [Path(d) for d in dirpath]
+        elif isinstance(dirpath, ChunkStore):
+            self._store = dirpath
+            self._name = str(dirpath)
+            self._dirpaths = [dirpath]
+        else:
+            self._name = str(dirpath)
+            self._dirpaths = [Path(dirpath)]
+
+        if len(set(self._dirpaths)) != len(self._dirpaths):
+            raise ValueError('Duplicate directory in {0}'.format(self._name))
+
+        self._dirpath = self._dirpaths[0]
+        self._placement = placement
+        self._slowdir = None if slow_tier is None else Path(slow_tier)
+        self._hot_chunks = hot_chunks
+
+        self._retain_bytes = retain_bytes
+        self._retain_chunks = retain_chunks
+        if retain_bytes is not None and retain_bytes < 0:
+            raise ValueError('retain_bytes must not be negative')
+        if retain_chunks is not None and retain_chunks < 1:
+            raise ValueError('retain_chunks must be at least 1')
+
+        if self._slowdir in self._dirpaths:
+            raise ValueError('slow_tier must not be one of the volume directories')
+        if hot_chunks is not None:
+            if self._slowdir is None:
+                raise ValueError('hot_chunks needs a slow_tier')
+            if hot_chunks < 1:
+                raise ValueError('hot_chunks must be at least 1')
         self._mode = mode
-        self._chunks = []
+        self._chunks = _ChunkTable(self, self._scan_dirs())
+        # chunk number of self._chunks[0]
+        self._first = 0
         self._closed = False
         self._offset = 0
         self._access = ''
         self._append = False
+        self._pool = None
+        self._dirty = set()
+        self._dirtydirs = set()
+        self._unflushed = set()
+        self._synclock = threading.Lock()
+        self._durability = durability
+        self._committer = None
+        self._writebehind = None
+        self._cache = BlockCache.default() if cache is True else (cache or None)
+        self._executor = None
+        self._chunkclass = Chunk if self._store is None else StoreChunk
+        # opens any existing chunk; Chunk.open() picks the class by format
+        self._openclass = self._chunkclass
+        self._chunkopts = {}
+        self._verify_reads = verify_reads
+        self._shared = shared
+        # the generation file, when shared, and its value as of the last scan
+        self._genfd = None
+        self._genseen = 0
+        # the volume's generation; None until read from the tail chunk
+        self._generation = None
+        # set by follow(): another process is writing the volume
+        self._following = False
+        # UUID of the volume, from its lowest chunk; None until there's one
+        self._volid = None
+        # data bytes in each chunk, from the lowest chunk's header; new
+        # volumes get the default
+        self._chunkdatasize = CHUNKDATASIZE
+        self._layoutdepth = 0
+        # Chunks to reuse by path while rescanning
+        self._known = {}
+
+        if self._store is not None:
+            for option, value in [('direct', direct), ('slow_tier', slow_tier), ('compression', compression),
+                                  ('checksum', checksum), ('dedup', dedup), ('shared', shared)]:
+                if value:
+                    raise ValueError('{0} needs a volume of files, not a {1}'.format(
+                        option, type(self._store).__name__))
+
+        if compression is not None:
+            self._chunkclass = _chunk_formats[FLAG_COMPRESSED]
+            self._chunkopts['codec'] = compression
+            if compress_blocksize is not None:
+                self._chunkopts['blocksize'] = compress_blocksize
+            self._chunkclass._header_fields(**self._chunkopts)
+
+        if checksum is not None:
+            if compression is not None:
+                raise ValueError('checksum and compression cannot be combined; compressed chunks carry their own checksums')
+            self._chunkclass = _chunk_formats[FLAG_CHECKSUMMED]
+            self._chunkopts['checksum'] = checksum
+            if checksum_blocksize is not None:
+                self._chunkopts['blocksize'] = checksum_blocksize
+            self._chunkclass._header_fields(**self._chunkopts)
+
+        if dedup:
+            if compression is not None or checksum is not None:
+                raise ValueError('dedup cannot be combined with compression or checksum')
+            if slow_tier is not None:
+                raise ValueError('dedup chunks keep their blocks in their own directory and cannot be tiered')
+            self._chunkclass = _chunk_formats[FLAG_DEDUP]
+            if dedup_blocksize is not None:
+                self._chunkopts['blocksize'] = dedup_blocksize
+            self._chunkclass._header_fields(**self._chunkopts)
+
+        if shared:
+            if fcntl is None:
+                raise NotImplementedError('shared volumes need fcntl locks, which this platform lacks')
+            if compression is not None or dedup:
+                raise ValueError('compressed and dedup volumes cannot be shared')
+            if self._cache is not None and not self._cache.crossprocess:
+                raise ValueError('shared volumes cannot use an in-process block cache')
+
+        if parallelism is None:
+            parallelism = len(self._dirpaths)
+        if parallelism < 1:
+            raise ValueError('parallelism must be at least 1')
+
+        if write_behind is not None and write_behind <= 0:
+            raise ValueError('write_behind must be a positive byte count')
+        if writers < 1:
+            raise ValueError('writers must be at least 1')
+
+        if not isinstance(durability, GroupCommit) and durability not in DURABILITY_POLICIES:
+            raise ValueError('Invalid durability policy: {0!r}'.format(durability))
+
+        if direct:
+            if not hasattr(os, 'O_DIRECT'):
+                raise NotImplementedError('O_DIRECT is not available on this platform')
+            self._pool = AlignedBufferPool()
 
         if not mode:
             raise ValueError('empty mode string')
@@ -249,30 +2287,33 @@ class ChunkFile(object):
         if mode[0] not in 'rwa':
             raise ValueError("mode string must begin with one of 'r', 'w', or 'a', not \"{0}\"".format(mode))
 
-        dirpath = Path(dirpath)
+        for dirpath in self._scan_dirs() if self._store is None else []:
+            if dirpath.exists() and not dirpath.is_dir():
+                raise ValueError('The specified path is not a directory: {0}'.format(dirpath))
 
-        if dirpath.exists() and not dirpath.is_dir():
-            raise ValueError('The specified path is not a directory: {0}'.format(dirpath))
+        if parallelism > 1:
+            self._executor = ThreadPoolExecutor(parallelism)
 
         if mode[0] == 'r':
             self._access = 'r'
-            if not dirpath.exists():
-                raise IOError('No such directory: {0}'.format(dirpath))
+            for dirpath in self._scan_dirs() if self._store is None else []:
+                if not dirpath.exists():
+                    raise IOError('No such directory: {0}'.format(dirpath))
 
-            self._open_existing(dirpath)
+            self._open_generation()
+            self._refresh()
 
         if mode[0] == 'w':
             self._access = 'w'
-            self._create_new(dirpath)
+            self._create_new()
 
         if mode[0] == 'a':
             self._access = 'rw'
             self._append = True
 
-            if dirpath.exists():
-                self._open_existing(dirpath)
-            else:
-                self._create_new(dirpath)
+            self._make_dirs()
+            self._open_generation()
+            self._refresh()
 
         for c in mode[1:]:
             if c == '+':
@@ -282,23 +2323,452 @@ class ChunkFile(object):
             else:
                 raise ValueError("Invalid mode ('{0}')".format(mode))
 
+        if isinstance(durability, GroupCommit) and 'w' in self._access:
+            self._committer = _GroupCommitThread(self, durability)
+            self._committer.start()
+
+        if write_behind is not None and 'w' in self._access:
+            self._writebehind = _WriteBehind(self, write_behind, writers)
+
     # TODO: buffering
     @staticmethod
-    def open(dirpath, mode='ab'):
-        return ChunkFile(dirpath, mode)
+    def open(dirpath, mode='ab', **kwargs):
+        return ChunkFile(dirpath, mode, **kwargs)
 
     # file.close(): close the file, deny further access
     def close(self):
         if not self._closed:
-            self.flush()
-            self._closed = True
+            try:
+                try:
+                    self.flush()
+                finally:
+                    if self._writebehind is not None:
+                        self._writebehind.stop()
+
+                if self._committer is not None:
+                    self._committer.stop()
+                    self._check_sync_error()
+                if self._durability != 'none':
+                    self._sync_dirty()
+            finally:
+                self._closed = True
+
+                if self._pool is not None:
+                    self._pool.close()
+                if self._executor is not None:
+                    self._executor.shutdown()
+                if self._genfd is not None:
+                    os.close(self._genfd)
+                if self._stats is not None:
+                    self._statsdone()
 
     # file.flush(): flush the internal buffer
     def flush(self):
         if self._closed:
             raise ValueError('I/O operation on closed file')
 
-        # we don't currently buffer anything :(
+        stats = self._stats
+        if stats is not None:
+            start = _now()
+
+        self._drain_writes()
+        self._flush_chunks()
+        self._check_sync_error()
+
+        if stats is not None:
+            stats.flushes += 1
+            stats.flush_latency.record(_now() - start)
+
+    # sync(): make everything written so far durable. Only chunks written
+    #         since the last sync are flushed to disk, and the directory too
+    #         if chunks were created or erased. Not part of the file API.
+    def sync(self):
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+
+        stats = self._stats
+        if stats is not None:
+            start = _now()
+
+        self._drain_writes()
+        self._check_sync_error()
+        self._sync_dirty()
+        # lengths are recorded once the data they cover is on disk
+        self._flush_chunks()
+
+        if stats is not None:
+            stats.syncs += 1
+            stats.sync_latency.record(_now() - start)
+
+    # migrate([max_hot[, idle]]): move cold chunks to the slow tier. Chunks
+    #     idle for at least *idle* seconds move, as do the least recently used
+    #     ones beyond the *max_hot* most recent. With neither, every chunk but
+    #     the tail moves. Returns the number of chunks moved. Not part of the
+    #     file API.
+    def migrate(self, max_hot=None, idle=None):
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+
+        if 'w' not in self._access:
+            raise IOError('File not open for writing')
+
+        if self._slowdir is None:
+            raise ValueError('No slow tier to migrate to')
+
+        return self._migrate(max_hot, idle)
+
+    # refresh(): pick up chunks other processes added to or removed from a
+    #     shared volume. Reads, writes and seeks from the end do this on
+    #     their own. Not part of the file API.
+    def refresh(self):
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+
+        self._refresh()
+
+    # follow([blocksize[, idle_timeout[, poll]]]): generator yielding the data
+    #     appended to the volume, from the current offset on, up to blocksize
+    #     bytes at a time, as it arrives. It waits on inotify watches on the
+    #     tail chunk and the volume directories, so new chunks are noticed;
+    #     where inotify isn't available (or with poll=True) it polls, backing
+    #     off from 1 ms to 50 ms while nothing arrives. It ends once nothing
+    #     has arrived for idle_timeout seconds, if given. Not part of the
+    #     file API.
+    def follow(self, blocksize=FOLLOW_BLOCKSIZE, idle_timeout=None, poll=False):
+        watcher = self._follow_start(blocksize, poll)
+        return self._follow(watcher, blocksize, idle_timeout)
+
+    # afollow([blocksize[, idle_timeout[, poll]]]): follow() as an async
+    #     generator, waiting in the event loop. The reads themselves are
+    #     made in the loop's thread. Not part of the file API.
+    def afollow(self, blocksize=FOLLOW_BLOCKSIZE, idle_timeout=None, poll=False):
+        watcher = self._follow_start(blocksize, poll)
+        return self._afollow(watcher, blocksize, idle_timeout)
+
+    def _follow_start(self, blocksize, poll):
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+        if 'r' not in self._access:
+            raise IOError('File not open for reading')
+        if self._store is not None:
+            raise NotImplementedError('following needs chunk files, not a {0}'.format(type(self._store).__name__))
+        if blocksize <= 0:
+            raise ValueError('blocksize must be positive')
+
+        # lengths in headers we read go stale as data arrives
+        self._following = True
+        for chunk in self._chunks._loaded.values():
+            chunk.foreign_writes = True
+
+        watcher = _watcher(self._scan_dirs(), poll)
+        # chunks created before the watches were in place
+        self._refresh()
+        self._follow_tail(watcher)
+        return watcher
+
+    def _follow_tail(self, watcher):
+        watcher.watch_file(self._chunks.path(len(self._chunks) - 1) if self._chunks else None)
+
+    def _follow_changed(self, watcher, kinds):
+        # After a wait: rescan if chunks were (or, polling, may have been)
+        # added, and watch the new tail
+        if _POLL in kinds:
+            chunkname = _chunk_name(self._first + len(self._chunks))
+            if not any((dirpath / chunkname).exists() for dirpath in self._scan_dirs()):
+                return
+        elif _DIRS not in kinds:
+            return
+
+        self._refresh()
+        self._follow_tail(watcher)
+
+    def _follow(self, watcher, blocksize, idle_timeout):
+        try:
+            idle_since = time.monotonic()
+            while True:
+                data = self.read(blocksize)
+                if data:
+                    watcher.data_seen()
+                    yield data
+                    idle_since = time.monotonic()
+                    continue
+
+                left = None if idle_timeout is None else idle_since + idle_timeout - time.monotonic()
+                kinds = watcher.wait(left)
+                if kinds is None:
+                    return
+                self._follow_changed(watcher, kinds)
+        finally:
+            watcher.close()
+
+    async def _afollow(self, watcher, blocksize, idle_timeout):
+        try:
+            idle_since = time.monotonic()
+            while True:
+                data = self.read(blocksize)
+                if data:
+                    watcher.data_seen()
+                    yield data
+                    idle_since = time.monotonic()
+                    continue
+
+                left = None if idle_timeout is None else idle_since + idle_timeout - time.monotonic()
+                kinds = await watcher.wait_async(left)
+                if kinds is None:
+                    return
+                self._follow_changed(watcher, kinds)
+        finally:
+            watcher.close()
+
+    # stats(): metrics collected since the volume was opened, as a dict of
+    #     counters plus a 'latency' dict of histograms by operation; None
+    #     unless opened with metrics. Not part of the file API.
+    def stats(self):
+        if self._stats is None:
+            return None
+        return self._stats.as_dict()
+
+    # map_chunks(func[, reduce[, processes[, overlap]]]): call
+    #     func(offset, data) for each chunk, with the chunk's data and the
+    #     volume offset it starts at, and return the results in chunk order,
+    #     or with *reduce*, functools.reduce(reduce, results) (None for an
+    #     empty volume). data runs *overlap* bytes into the next chunk, for
+    #     records straddling a boundary. Chunks are handed out to up to
+    #     *processes* worker processes, one per CPU by default, each of which
+    #     opens the volume for reading; func and its results must pickle.
+    #     Each worker holds a chunk's data at a time. Volumes in a ChunkStore
+    #     are mapped in this process. Not part of the file API.
+    def map_chunks(self, func, reduce=None, processes=None, overlap=0):
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+
+        if 'r' not in self._access:
+            raise IOError('File not open for reading')
+
+        if overlap < 0:
+            raise ValueError('overlap must not be negative')
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes < 1:
+            raise ValueError('processes must be at least 1')
+
+        # the workers read what is on disk
+        if 'w' in self._access:
+            self.flush()
+        self._check_layout()
+
+        chunknums = range(self._first, self._first + len(self._chunks))
+        if self._store is not None or processes == 1 or len(chunknums) < 2:
+            results = []
+            for chunknum in chunknums:
+                offset = chunknum * self._chunkdatasize
+                results.append(func(offset, self._do_read(offset, self._chunkdatasize + overlap)))
+        else:
+            dirpaths = [str(d) for d in self._dirpaths]
+            kwargs = {'slow_tier': None if self._slowdir is None else str(self._slowdir),
+                      'verify_reads': self._verify_reads, 'shared': self._shared}
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(min(processes, len(chunknums)), _map_init,
+                              (dirpaths, kwargs, func, overlap)) as pool:
+                results = pool.map(_map_chunk, chunknums, chunksize=1)
+
+        if reduce is None:
+            return results
+        return functools.reduce(reduce, results) if results else None
+
+    # verify([parallelism]): check every chunk against its checksums. Returns
+    #     a sorted list of (start, end) volume offsets whose data doesn't
+    #     match; empty if all is well. Chunks are checked by up to
+    #     *parallelism* worker processes, one per CPU by default. Not part of
+    #     the file API.
+    def verify(self, parallelism=None):
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+
+        if 'w' in self._access:
+            self.flush()
+
+        if parallelism is None:
+            parallelism = os.cpu_count() or 1
+        if parallelism < 1:
+            raise ValueError('parallelism must be at least 1')
+
+        paths = [str(self._chunks.path(i)) for i in range(len(self._chunks))]
+        if self._store is not None:
+            # other processes can't see into the store
+            results = [chunk.scrub() for chunk in self._chunks]
+        elif parallelism == 1 or len(paths) < 2:
+            results = [_scrub_chunk(path) for path in paths]
+        else:
+            # a Pool, as ProcessPoolExecutor only takes a context from 3.7
+            with multiprocessing.get_context('spawn').Pool(min(parallelism, len(paths))) as pool:
+                results = pool.map(_scrub_chunk, paths)
+
+        bad = []
+        for i, ranges in enumerate(results):
+            base = (self._first + i) * self._chunkdatasize
+            for start, end in ranges:
+                if bad and bad[-1][1] == base + start:
+                    bad[-1] = (bad[-1][0], base + end)
+                else:
+                    bad.append((base + start, base + end))
+        return bad
+
+    # merkle_root(): hash of the whole volume, the root of a tree over the
+    #     chunks' own hash trees. Volumes with equal roots hold the same data.
+    #     Each chunk keeps its tree leaves and root in a hidden sidecar, and
+    #     only blocks changed since they were saved are rehashed. Not part of
+    #     the file API.
+    def merkle_root(self):
+        return MerkleTree(self._merkle_roots()).root()
+
+    def _merkle_roots(self):
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+
+        if 'w' in self._access:
+            self.flush()
+
+        return self._run_segments(lambda chunk: chunk.merkle_root(),
+                                  [(chunk,) for chunk in self._chunks])
+
+    # diff(other): sorted (start, end) ranges of bytes that differ from
+    #     *other*, a ChunkFile or a volume directory. Bytes only one of the
+    #     two has count as different. Chunks are compared by their roots
+    #     first, and only the trees of those that differ are loaded and
+    #     walked where they differ. Both must have the same chunk size. Not
+    #     part of the file API.
+    def diff(self, other):
+        if not isinstance(other, ChunkFile):
+            with ChunkFile.open(other, 'rb') as f:
+                return self.diff(f)
+        if other._chunkdatasize != self._chunkdatasize:
+            raise ValueError('Cannot diff volumes with chunks of {0} and {1} bytes'.format(
+                self.chunk_size, other.chunk_size))
+
+        mine = dict(enumerate(self._merkle_roots(), self._first))
+        theirs = dict(enumerate(other._merkle_roots(), other._first))
+        bs = MERKLE_BLOCKSIZE
+        empty = MerkleTree([], (self._chunkdatasize + bs - 1) // bs)
+
+        def tree(volume, roots, chunknum):
+            if chunknum not in roots:
+                return empty
+            return volume._chunks[chunknum - volume._first].merkle_tree()
+
+        ranges = []
+        for chunknum in sorted(set(mine) | set(theirs)):
+            if mine.get(chunknum, empty.root()) == theirs.get(chunknum, empty.root()):
+                continue
+            a = tree(self, mine, chunknum)
+            b = tree(other, theirs, chunknum)
+
+            base = chunknum * self._chunkdatasize
+            for block in a.diff(b):
+                start = base + block * bs
+                end = base + min((block + 1) * bs, self._chunkdatasize)
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], end)
+                else:
+                    ranges.append((start, end))
+
+        # the last block of each volume may be short
+        length = max(self._nbytes(), other._nbytes())
+        if ranges and ranges[-1][1] > length:
+            ranges[-1] = (ranges[-1][0], length)
+        return ranges
+
+    # sync_to(dest): make the volume in directory *dest* a copy of this one,
+    #     writing only the ranges diff() finds. Other keyword arguments are
+    #     passed to ChunkFile.open() for dest. Returns the number of bytes
+    #     copied. Not part of the file API.
+    def sync_to(self, dest, **kwargs):
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+
+        if 'r' not in self._access:
+            raise IOError('File not open for reading')
+
+        if isinstance(dest, DirectoryStore):
+            dest = dest.dirpath
+        mode = 'r+b' if isinstance(dest, ChunkStore) or Path(dest).is_dir() else 'w+b'
+        copied = 0
+        with ChunkFile.open(dest, mode, **kwargs) as f:
+            # Sizing dest first turns new space into holes, which hash the
+            # same as any zeros here and so are never copied.
+            length = self._nbytes()
+            # a new dest takes this volume's chunk size
+            if not f._chunks:
+                f._chunkdatasize = self._chunkdatasize
+            # a log here may have dropped chunks dest still has
+            if f._first < self._first:
+                f._drop_front(min(len(f._chunks), self._first - f._first))
+                f._first = self._first
+            if f._nbytes() != length:
+                f.truncate(length)
+
+            for start, end in self.diff(f):
+                pos = start
+                while pos < end:
+                    data = self._do_read(pos, min(COPYBUFSIZE, end - pos))
+                    f.seek(pos)
+                    f.write(data)
+                    pos += len(data)
+                    copied += len(data)
+
+        return copied
+
+    # snapshot(dest): make a point-in-time copy of the volume in *dest*, a
+    #     new or empty directory, or a list of them with one per volume
+    #     directory. Each chunk file is reflinked where the filesystem can,
+    #     else hard linked, so this takes time in the number of chunks, not
+    #     their size. A hard linked chunk is copied the first time either
+    #     side changes it. Open the snapshot with ChunkFile.open(dest, 'rb').
+    #     Writers in other processes don't notice a snapshot and must not be
+    #     running. Not part of the file API.
+    def snapshot(self, dest):
+        global _snapshots
+
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+
+        if self._store is not None:
+            raise NotImplementedError('snapshots need chunk files, not a {0}'.format(type(self._store).__name__))
+        if any(chunk._header.flags() & FLAG_DEDUP for chunk in self._chunks):
+            raise NotImplementedError('dedup chunks cannot be snapshotted; their blocks are kept apart')
+
+        if 'w' in self._access:
+            self.flush()
+
+        if isinstance(dest, (list, tuple)):
+            dests = [Path(d) for d in dest]
+            if len(dests) != len(self._dirpaths):
+                raise ValueError('dest needs one directory per volume directory')
+        else:
+            dests = [Path(dest)] * len(self._dirpaths)
+
+        for dirpath in set(dests):
+            if dirpath.exists():
+                if any(not entry.name.startswith('.') for entry in dirpath.iterdir()):
+                    raise IOError('Snapshot directory is not empty: {0}'.format(dirpath))
+            else:
+                dirpath.mkdir()
+
+        # chunks sharing their file from here on must check before writing
+        _snapshots += 1
+
+        for chunk in self._chunks:
+            parent = chunk._path.parent
+            # chunks in the slow tier go to the first directory
+            todir = dests[self._dirpaths.index(parent)] if parent in self._dirpaths else dests[0]
+
+            _share_file(chunk._path, todir / chunk._path.name)
+            for sidecar in chunk._sidecars():
+                if sidecar.exists():
+                    _copy_file(sidecar, todir / sidecar.name)
+
+        for dirpath in set(dests):
+            _fsync_dir(dirpath)
 
     # file.fileno(): provide internal file descriptor. Chunkfiles do NOT
     #                     have an FD!
@@ -319,14 +2789,59 @@ class ChunkFile(object):
         if 'r' not in self._access:
             raise IOError('File not open for reading')
 
+        stats = self._stats
+        traced = _trace.hooks
+        if stats is not None or traced:
+            start = _now()
+
+        self._drain_writes()
+        self._check_layout()
+
         if size < 0:
             size = self._nbytes() - self._offset
 
-        data = self._do_read(self._offset, size)
+        offset = self._offset
+        data = self._do_read(offset, size)
         self._offset += len(data)
 
+        if stats is not None:
+            stats.reads += 1
+            stats.bytes_read += len(data)
+            stats.read_latency.record(_now() - start)
+        if traced:
+            _trace.emit(traced, 'ChunkFile.read', self._name, None, offset, len(data), start)
         return data
 
+    # file.readinto(b): Read up to len(b) bytes into b, return the number of
+    #                       bytes read.
+    def readinto(self, b):
+        if self._closed:
+            raise ValueError('I/O operation on closed file')
+
+        if 'r' not in self._access:
+            raise IOError('File not open for reading')
+
+        stats = self._stats
+        traced = _trace.hooks
+        if stats is not None or traced:
+            start = _now()
+
+        self._drain_writes()
+        self._check_layout()
+
+        offset = self._offset
+        with memoryview(b) as view:
+            n = self._do_readinto(offset, view.cast('B'))
+        self._offset += n
+
+        if stats is not None:
+            stats.reads += 1
+            stats.bytes_read += n
+            stats.read_latency.record(_now() - start)
+        if traced:
+            _trace.emit(traced, 'ChunkFile.read', self._name, None, offset, n, start)
+        return n
+
     # file.readline([size]): Read one line. We're not plaintext-focused so
     #                            we don't support it.
 
@@ -350,11 +2865,16 @@ class ChunkFile(object):
         if self._closed:
             raise ValueError('I/O operation on closed file')
 
+        stats = self._stats
+        if stats is not None:
+            start = _now()
+
         if whence == os.SEEK_SET:
             startofs = 0
         elif whence == os.SEEK_CUR:
             startofs = self._offset
         elif whence == os.SEEK_END:
+            self._check_layout()
             startofs = self._nbytes()
         else:
             raise IOError('Invalid argument')
@@ -365,6 +2885,10 @@ class ChunkFile(object):
 
         self._offset = new_offset
 
+        if stats is not None:
+            stats.seeks += 1
+            stats.seek_latency.record(_now() - start)
+
     # file.tell(): Return the file's current position.
     def tell(self):
         if self._closed:
@@ -385,31 +2909,67 @@ class ChunkFile(object):
         if 'w' not in self._access:
             raise IOError('File not open for writing')
 
-        nbytes = 0
-        chunknum = 0
-
-        while nbytes + CHUNKDATASIZE < size:
-            if chunknum >= len(self._chunks):
-                self._add_new_chunk()
-
-            self._chunks[chunknum].truncate(CHUNKDATASIZE)
-
-            nbytes += CHUNKDATASIZE
-            chunknum += 1
-
-        if nbytes < size:
-            if chunknum >= len(self._chunks):
-                self._add_new_chunk()
+        stats = self._stats
+        traced = _trace.hooks
+        if stats is not None or traced:
+            start = _now()
 
-            self._chunks[chunknum].truncate(size - nbytes)
+        self._drain_writes()
+        if self._writebehind is not None:
+            self._writebehind.reset_end()
 
-            nbytes += size - nbytes
-            chunknum += 1
-
-        for chunk in self._chunks[chunknum:]:
-            chunk.erase()
-
-        del self._chunks[chunknum:]
+        self._lock_layout()
+        try:
+            self._check_layout()
+            self._check_dropped(size)
+
+            # chunknum counts from chunk 0 of the volume, not from the table:
+            # a log growing here may drop chunks from the front as it goes
+            chunknum = self._first
+            # whether chunks are made or erased
+            changed = False
+
+            while (chunknum + 1) * self._chunkdatasize < size:
+                if chunknum >= self._first + len(self._chunks):
+                    self._create_chunk()
+                    changed = True
+
+                self._truncate_chunk(self._chunks[chunknum - self._first], self._chunkdatasize)
+                chunknum += 1
+
+            if chunknum * self._chunkdatasize < size:
+                if chunknum >= self._first + len(self._chunks):
+                    self._create_chunk()
+                    changed = True
+
+                self._truncate_chunk(self._chunks[chunknum - self._first], size - chunknum * self._chunkdatasize)
+                chunknum += 1
+
+            keep = chunknum - self._first
+
+            # A log keeps its first chunk, even empty: its number is the base
+            if self._first and not keep and self._chunks:
+                self._truncate_chunk(self._chunks[0], 0)
+                keep = 1
+
+            if keep < len(self._chunks):
+                self._volume_generation()
+                changed = True
+            for chunk in self._chunks[keep:]:
+                chunk.erase()
+                self._forget_chunk(chunk)
+
+            del self._chunks[keep:]
+            if changed:
+                self._layout_changed()
+        finally:
+            self._unlock_layout()
+
+        if stats is not None:
+            stats.truncates += 1
+            stats.truncate_latency.record(_now() - start)
+        if traced:
+            _trace.emit(traced, 'ChunkFile.truncate', self._name, None, size, 0, start)
 
     # file.write(str): Write str to file.
     def write(self, s):
@@ -419,12 +2979,40 @@ class ChunkFile(object):
         if 'w' not in self._access:
             raise IOError('File not open for writing')
 
-        if self._append:
-            self.seek(0, os.SEEK_END)
+        stats = self._stats
+        traced = _trace.hooks
+        if stats is not None or traced:
+            start = _now()
 
-        self._do_write(self._offset, s)
+        self._check_sync_error()
+
+        if self._append and self._genfd is not None:
+            self._offset = self._reserve(len(s))
+        elif self._append:
+            self._check_layout()
+            self._offset = self._nbytes()
+        else:
+            self._check_layout()
+
+        offset = self._offset
+        if self._writebehind is not None:
+            data = memoryview(bytes(s))
+            self._writebehind.submit(self._write_pieces(offset, data), offset + len(data))
+        else:
+            self._do_write(offset, s)
         self._offset += len(s)
 
+        if self._durability == 'every_write':
+            self._drain_writes()
+            self._sync_dirty()
+
+        if stats is not None:
+            stats.writes += 1
+            stats.bytes_written += len(s)
+            stats.write_latency.record(_now() - start)
+        if traced:
+            _trace.emit(traced, 'ChunkFile.write', self._name, None, offset, len(s), start)
+
     # file.writelines(sequence): We're not plaintext-focused so we don't
     #                                support it.
 
@@ -441,6 +3029,33 @@ class ChunkFile(object):
     def mode(self):
         return self._mode
 
+    # start: Offset of the first byte still held; nonzero once a log has
+    #        dropped chunks. Read-only. Not part of the file API.
+    @property
+    def start(self):
+        return self._first * self._chunkdatasize
+
+    # chunk_size: size of the volume's chunk files when full, header
+    #             included. CHUNKSIZE, unless the volume was rechunked.
+    #             Read-only. Not part of the file API.
+    @property
+    def chunk_size(self):
+        return self._chunkdatasize + HEADERSIZE
+
+    # volume_id: UUID of the volume, as hex, recorded in the header of each
+    #            of its chunks; None for a volume written before there was
+    #            one. Read-only. Not part of the file API.
+    @property
+    def volume_id(self):
+        return self._volid
+
+    # generation: the volume's generation, bumped whenever chunks are added,
+    #             erased, dropped or migrated, and recorded in the header of
+    #             its tail chunk. Read-only. Not part of the file API.
+    @property
+    def generation(self):
+        return self._volume_generation()
+
     # file.name: The name parameter passed to open. Read-only.
     @property
     def name(self):
@@ -461,4 +3076,5 @@ class ChunkFile(object):
 
 open = ChunkFile.open
 __all__ = ['SIGNATURE', 'VERSION', 'IFACE_VERSION', 'HEADERSIZE', 'CHUNKSIZE',
-           'CHUNKDATASIZE', 'ChunkFile', 'open']
+           'CHUNKDATASIZE', 'DIRECTALIGN', 'ChunkFile', 'GroupCommit', 'open',
+           'round_robin']
@@ -0,0 +1,206 @@
+import os, threading
+from pathlib import Path
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+class ChunkStore(object):
+    # Where the chunks of a volume are kept: a flat namespace of objects,
+    # each a string of bytes that can be read, written and resized at any
+    # offset. ChunkFile.open() takes a store in place of a directory.
+    #
+    # Names starting with '.' belong to the volume's own bookkeeping and are
+    # not chunks. Methods taking a name raise FileNotFoundError when there is
+    # no such object.
+
+    # list(): names of all the objects
+    def list(self):
+        raise NotImplementedError
+
+    # create(name): a new empty object, replacing any there was
+    def create(self, name):
+        raise NotImplementedError
+
+    # open(name): check that the object exists
+    def open(self, name):
+        raise NotImplementedError
+
+    # read_at(name, offset, count): up to count bytes; short at the end
+    def read_at(self, name, offset, count):
+        raise NotImplementedError
+
+    # write_at(name, offset, data): writing past the end zero-fills the gap
+    def write_at(self, name, offset, data):
+        raise NotImplementedError
+
+    # truncate(name, size): cut the object short, or zero-fill it, to size
+    def truncate(self, name, size):
+        raise NotImplementedError
+
+    def size(self, name):
+        raise NotImplementedError
+
+    def erase(self, name):
+        raise NotImplementedError
+
+    # flush(name): pass buffered writes to the object on to the backend
+    def flush(self, name):
+        pass
+
+    # sync([name]): make the object durable; without a name, the set of
+    # objects (names created and erased)
+    def sync(self, name=None):
+        pass
+
+    def close(self):
+        pass
+
+    # store / name: the path of an object, as kept by chunks
+    def __truediv__(self, name):
+        return StorePath(self, name)
+
+class StorePath(object):
+    # Stands in for a pathlib.Path to a chunk file: the store is the parent
+    __slots__ = ('parent', 'name')
+
+    def __init__(self, parent, name):
+        self.parent = parent
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, StorePath) and (self.parent, self.name) == (other.parent, other.name)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.parent), self.name))
+
+    def __str__(self):
+        return '{0}/{1}'.format(self.parent, self.name)
+
+    def __repr__(self):
+        return 'StorePath({0!r}, {1!r})'.format(self.parent, self.name)
+
+class DirectoryStore(ChunkStore):
+    # One file per object in a directory: the usual layout. ChunkFile opens
+    # a DirectoryStore as it would the directory itself, with all that only
+    # works on files (O_DIRECT, snapshots, tiers, sharing, ...).
+
+    def __init__(self, dirpath):
+        self.dirpath = Path(dirpath)
+
+    def _path(self, name):
+        return str(self.dirpath / name)
+
+    def list(self):
+        return sorted(os.listdir(str(self.dirpath)))
+
+    def create(self, name):
+        with open(self._path(name), 'wb'):
+            pass
+
+    def open(self, name):
+        if not os.path.isfile(self._path(name)):
+            raise FileNotFoundError('No such object: {0}'.format(name))
+
+    def read_at(self, name, offset, count):
+        fd = os.open(self._path(name), os.O_RDONLY)
+        try:
+            return os.pread(fd, count, offset)
+        finally:
+            os.close(fd)
+
+    def write_at(self, name, offset, data):
+        fd = os.open(self._path(name), os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+
+    def truncate(self, name, size):
+        os.truncate(self._path(name), size)
+
+    def size(self, name):
+        return os.stat(self._path(name)).st_size
+
+    def erase(self, name):
+        os.unlink(self._path(name))
+
+    def sync(self, name=None):
+        if name is None:
+            fd = os.open(str(self.dirpath), os.O_RDONLY)
+            sync = os.fsync
+        else:
+            fd = os.open(self._path(name), os.O_RDONLY)
+            sync = _fdatasync
+        try:
+            sync(fd)
+        finally:
+            os.close(fd)
+
+    def __str__(self):
+        return str(self.dirpath)
+
+    def __repr__(self):
+        return 'DirectoryStore({0!r})'.format(str(self.dirpath))
+
+class MemoryStore(ChunkStore):
+    # Objects in memory, for scratch volumes that don't outlive the
+    # process. Each chunk takes as much RAM as it holds data.
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name):
+        try:
+            return self._objects[name]
+        except KeyError:
+            raise FileNotFoundError('No such object: {0}'.format(name))
+
+    def list(self):
+        with self._lock:
+            return sorted(self._objects)
+
+    def create(self, name):
+        with self._lock:
+            self._objects[name] = bytearray()
+
+    def open(self, name):
+        with self._lock:
+            self._get(name)
+
+    def read_at(self, name, offset, count):
+        with self._lock:
+            return bytes(self._get(name)[offset:offset+count])
+
+    def write_at(self, name, offset, data):
+        with self._lock:
+            obj = self._get(name)
+            if len(obj) < offset:
+                obj.extend(bytes(offset - len(obj)))
+            obj[offset:offset+len(data)] = data
+
+    def truncate(self, name, size):
+        with self._lock:
+            obj = self._get(name)
+            if size < len(obj):
+                del obj[size:]
+            else:
+                obj.extend(bytes(size - len(obj)))
+
+    def size(self, name):
+        with self._lock:
+            return len(self._get(name))
+
+    def erase(self, name):
+        with self._lock:
+            self._get(name)
+            del self._objects[name]
+
+    def __repr__(self):
+        return '<MemoryStore at {0:#x}>'.format(id(self))
+
+    __str__ = __repr__
+
+__all__ = ['ChunkStore', 'DirectoryStore', 'MemoryStore']
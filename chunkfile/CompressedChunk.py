@@ -0,0 +1,425 @@
+import os, struct, threading, zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .ChunkFile import (CHUNKSIZE, FLAG_COMPRESSED, HEADERSIZE, Chunk,
+                        InvalidHeaderError, _fdatasync, _fsync_dir,
+                        register_chunk_format)
+
+COMPRESS_BLOCKSIZE = 1024 * 1024
+
+# Partial blocks are kept uncompressed in memory until they fill up or the
+# chunk is flushed. Past this many, they are flushed early.
+MAXPENDING = 16
+
+# Layout of a compressed chunk:
+#
+#   header page     flags=1, codec, blocksize and indexslot fields
+#   index slot A    } the block index, written alternately to each slot so
+#   index slot B    } a torn write always leaves the other one intact
+#   extents...      compressed blocks, appended; rewritten blocks leave the
+#                   old extent behind until the chunk is compacted
+#
+# An index slot is _SLOT followed by one _ENTRY per logical block. An entry
+# with clen 0 is a hole (zeros). Blocks that don't shrink are stored raw,
+# marked by RAW in clen.
+_SLOT = struct.Struct('<4sQQII')   # magic, seq, logical size, nblocks, crc32
+_ENTRY = struct.Struct('<QII')     # file offset, stored length, crc32
+_MAGIC = b'CIDX'
+RAW = 0x80000000
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("codec 'zstd' needs the zstandard module")
+    return zstandard
+
+def _codec(name):
+    # (compress, decompress) for a codec name. Each call makes its own
+    # (de)compressor, so the functions are safe to use from many threads.
+    if name == 'zlib':
+        return (lambda data: zlib.compress(data, 6)), zlib.decompress
+    if name == 'lzma':
+        import lzma
+        return lzma.compress, lzma.decompress
+    if name == 'zstd':
+        zstandard = _zstd()
+        return ((lambda data: zstandard.ZstdCompressor().compress(data)),
+                (lambda data: zstandard.ZstdDecompressor().decompress(data)))
+    raise ValueError('Unknown compression codec: {0!r}'.format(name))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _compress_pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(os.cpu_count() or 1)
+        return _executor
+
+def _slotsize(blocksize, chunksize):
+    nblocks = (chunksize - HEADERSIZE + blocksize - 1) // blocksize
+    size = _SLOT.size + _ENTRY.size * nblocks
+    return (size + HEADERSIZE - 1) // HEADERSIZE * HEADERSIZE
+
+class CompressedChunk(Chunk):
+    # Chunk whose data is split into fixed logical blocks, each compressed
+    # on its own, so a read only decompresses the blocks it touches.
+    #
+    # The block index is loaded on first use and kept in memory; changes
+    # made through another ChunkFile after that aren't seen.
+
+    buffered = True
+
+    def __init__(self, path, header, direct=None, cache=None):
+        # extents aren't aligned, so O_DIRECT doesn't apply
+        super(CompressedChunk, self).__init__(path, header, None, cache)
+
+        try:
+            self._codecname = header.fields['codec']
+            self._bs = int(header.fields['blocksize'])
+            self._slotsize = int(header.fields['indexslot'])
+        except (KeyError, ValueError):
+            raise InvalidHeaderError('{0}: bad compressed chunk fields'.format(path))
+        self._compress, self._decompress = _codec(self._codecname)
+
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._index = []
+        self._pending = {}
+        self._size = 0
+        self._seq = 0
+        self._end = 0
+        self._dead = 0
+        self._index_dirty = False
+
+    @classmethod
+    def _header_fields(cls, codec='zlib', blocksize=COMPRESS_BLOCKSIZE, chunksize=CHUNKSIZE):
+        _codec(codec)
+        if blocksize <= 0:
+            raise ValueError('blocksize must be positive')
+
+        return {'flags': '{0:x}'.format(FLAG_COMPRESSED), 'codec': codec,
+                'blocksize': str(blocksize),
+                'indexslot': str(_slotsize(blocksize, chunksize))}
+
+    def _datastart(self):
+        return HEADERSIZE + 2 * self._slotsize
+
+    def _parse_slot(self, data):
+        if len(data) < _SLOT.size:
+            return None
+
+        magic, seq, size, nblocks, crc = _SLOT.unpack_from(data)
+        entriesend = _SLOT.size + nblocks * _ENTRY.size
+        if magic != _MAGIC or entriesend > len(data):
+            return None
+        if zlib.crc32(data[4:_SLOT.size-4] + data[_SLOT.size:entriesend]) != crc:
+            return None
+
+        index = [list(_ENTRY.unpack_from(data, _SLOT.size + i * _ENTRY.size))
+                 for i in range(nblocks)]
+        return seq, size, index
+
+    def _load(self):
+        if self._loaded:
+            return
+
+        with self._path.open('rb') as f:
+            f.seek(HEADERSIZE)
+            slots = f.read(2 * self._slotsize)
+            self._end = max(os.fstat(f.fileno()).st_size, self._datastart())
+
+        best = None
+        for i in range(2):
+            slot = self._parse_slot(slots[i*self._slotsize:(i+1)*self._slotsize])
+            if slot is not None and (best is None or slot[0] > best[0]):
+                best = slot
+
+        if best is not None:
+            self._seq, self._size, self._index = best
+
+        live = sum(entry[1] & ~RAW for entry in self._index)
+        self._dead = self._end - self._datastart() - live
+        self._loaded = True
+
+    def _write_index(self, fd):
+        self._seq += 1
+        entries = b''.join(_ENTRY.pack(*entry) for entry in self._index)
+        fixed = _SLOT.pack(_MAGIC, self._seq, self._size, len(self._index), 0)
+        crc = zlib.crc32(fixed[4:_SLOT.size-4] + entries)
+        slot = _SLOT.pack(_MAGIC, self._seq, self._size, len(self._index), crc) + entries
+
+        os.pwrite(fd, slot, HEADERSIZE + (self._seq % 2) * self._slotsize)
+        self._index_dirty = False
+
+    def _blocklen(self, b):
+        return max(0, min(self._bs, self._size - b * self._bs))
+
+    def _get_block(self, fd, b):
+        n = self._blocklen(b)
+
+        buf = self._pending.get(b)
+        if buf is not None:
+            data = bytes(buf)
+        elif b < len(self._index) and self._index[b][1]:
+            offset, clen, crc = self._index[b]
+            stored = os.pread(fd, clen & ~RAW, offset)
+            if zlib.crc32(stored) != crc:
+                raise IOError('{0}: block {1} is corrupt'.format(self._path, b))
+            data = stored if clen & RAW else self._decompress(stored)
+        else:
+            data = b''
+
+        if len(data) < n:
+            data += bytes(n - len(data))
+        return data[:n]
+
+    def _encode(self, data):
+        packed = self._compress(data)
+        if len(packed) >= len(data):
+            return data, RAW
+        return packed, 0
+
+    def _store(self, fd, blocks):
+        # Compress (block, data) pairs, in parallel when there are several,
+        # and append them to the chunk.
+        if not blocks:
+            return
+
+        datas = [data for b, data in blocks]
+        if len(blocks) > 1:
+            encoded = list(_compress_pool().map(self._encode, datas))
+        else:
+            encoded = [self._encode(datas[0])]
+
+        for (b, data), (stored, raw) in zip(blocks, encoded):
+            os.pwrite(fd, stored, self._end)
+
+            while len(self._index) <= b:
+                self._index.append([0, 0, 0])
+            self._dead += self._index[b][1] & ~RAW
+            self._index[b] = [self._end, len(stored) | raw, zlib.crc32(stored)]
+
+            self._end += len(stored)
+
+        self._index_dirty = True
+
+    def _open_rw(self):
+        return os.open(str(self._path), os.O_RDWR)
+
+    def _read(self, offset, count):
+        with self._lock:
+            self._load()
+
+            end = min(offset + count, self._size)
+            if end <= offset:
+                return b''
+
+            pieces = []
+            fd = os.open(str(self._path), os.O_RDONLY)
+            try:
+                for b in range(offset // self._bs, (end - 1) // self._bs + 1):
+                    block = self._get_block(fd, b)
+                    lo = max(offset - b * self._bs, 0)
+                    hi = min(end - b * self._bs, len(block))
+                    pieces.append(block[lo:hi])
+            finally:
+                os.close(fd)
+
+            return b''.join(pieces)
+
+    def _readinto(self, offset, view):
+        data = self._read(offset, len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def _write(self, offset, data):
+        with self._lock:
+            self._load()
+
+            bs = self._bs
+            end = offset + len(data)
+            full = []
+
+            fd = self._open_rw()
+            try:
+                pos = offset
+                while pos < end:
+                    b = pos // bs
+                    lo = pos - b * bs
+                    hi = min(end - b * bs, bs)
+                    piece = data[pos-offset:pos-offset+hi-lo]
+
+                    if lo == 0 and hi == bs:
+                        self._pending.pop(b, None)
+                        full.append((b, bytes(piece)))
+                    else:
+                        buf = self._pending.get(b)
+                        if buf is None:
+                            buf = bytearray(self._get_block(fd, b))
+                        if len(buf) < hi:
+                            buf.extend(bytes(hi - len(buf)))
+                        buf[lo:hi] = piece
+
+                        if len(buf) == bs:
+                            self._pending.pop(b, None)
+                            full.append((b, bytes(buf)))
+                        else:
+                            self._pending[b] = buf
+
+                    pos = b * bs + hi
+
+                self._size = max(self._size, end)
+                self._index_dirty = True
+                self._store(fd, full)
+
+                if len(self._pending) > MAXPENDING:
+                    self._flush(fd)
+            finally:
+                os.close(fd)
+
+    def _truncate(self, size):
+        with self._lock:
+            self._load()
+
+            if size < self._size:
+                nblocks = (size + self._bs - 1) // self._bs
+                for entry in self._index[nblocks:]:
+                    self._dead += entry[1] & ~RAW
+                del self._index[nblocks:]
+                for b in [b for b in self._pending if b >= nblocks]:
+                    del self._pending[b]
+
+                # Cut the new last block down, so that growing the chunk
+                # again shows zeros rather than the old bytes.
+                if size % self._bs:
+                    b = size // self._bs
+                    fd = os.open(str(self._path), os.O_RDONLY)
+                    try:
+                        buf = bytearray(self._get_block(fd, b))
+                    finally:
+                        os.close(fd)
+                    self._pending[b] = buf[:size % self._bs]
+
+            self._size = size
+            self._index_dirty = True
+
+    def size(self):
+        with self._lock:
+            if not self._loaded:
+                # the header knows, unless the chunk changed since a flush
+                length = self._recorded_length()
+                if length is not None:
+                    return length
+            self._load()
+            return self._size
+
+    def _stored_size(self):
+        with self._lock:
+            self._load()
+            return self._size
+
+    def _flush(self, fd, durable=False):
+        if self._pending:
+            blocks = sorted(self._pending.items())
+            self._pending = {}
+            self._store(fd, [(b, bytes(buf)) for b, buf in blocks])
+
+        if self._index_dirty:
+            # the index must never point at extents that aren't on disk
+            if durable:
+                _fdatasync(fd)
+            self._write_index(fd)
+
+    def flush(self, durable=False):
+        with self._lock:
+            if not self._loaded:
+                return
+            if self._pending or self._index_dirty:
+                self._unshare()
+
+            fd = self._open_rw()
+            try:
+                self._flush(fd, durable)
+            finally:
+                os.close(fd)
+
+            if self._dead > max(self._end - self._datastart() - self._dead, 4 * self._bs):
+                self.compact()
+
+    def compact(self):
+        # Rewrite the chunk with only live extents: build it under a hidden
+        # name, fsync, then rename it over the original.
+        with self._lock:
+            self._load()
+
+            fd = self._open_rw()
+            try:
+                self._flush(fd)
+            finally:
+                os.close(fd)
+
+            tmp = self._path.parent / '.{0}.compact'.format(self._path.name)
+            infd = os.open(str(self._path), os.O_RDONLY)
+            try:
+                outfd = os.open(str(tmp), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+                try:
+                    os.pwrite(outfd, os.pread(infd, HEADERSIZE, 0), 0)
+
+                    pos = self._datastart()
+                    for entry in self._index:
+                        n = entry[1] & ~RAW
+                        if n:
+                            os.pwrite(outfd, os.pread(infd, n, entry[0]), pos)
+                            entry[0] = pos
+                            pos += n
+
+                    self._write_index(outfd)
+                    os.fsync(outfd)
+                finally:
+                    os.close(outfd)
+            finally:
+                os.close(infd)
+
+            os.rename(str(tmp), str(self._path))
+            _fsync_dir(self._path.parent)
+            self._end = pos
+            self._dead = 0
+
+    def _data_ranges(self, start, end):
+        # extents aren't laid out by offset; treat it all as data
+        return [(start, end - start)]
+
+    def scrub(self):
+        # blocks whose stored extent fails its crc32
+        with self._lock:
+            self._load()
+
+            bad = []
+            fd = os.open(str(self._path), os.O_RDONLY)
+            try:
+                for b, (offset, clen, crc) in enumerate(self._index):
+                    if b in self._pending or not clen:
+                        continue
+                    if zlib.crc32(os.pread(fd, clen & ~RAW, offset)) != crc:
+                        bad.append((b * self._bs, b * self._bs + self._blocklen(b)))
+            finally:
+                os.close(fd)
+            return bad
+
+    def erase(self):
+        with self._lock:
+            self._pending = {}
+            self._index_dirty = False
+            self._loaded = False
+            super(CompressedChunk, self).erase()
+
+    def sync(self):
+        self.flush(durable=True)
+        super(CompressedChunk, self).sync()
+
+register_chunk_format(FLAG_COMPRESSED, CompressedChunk)
+
+__all__ = ['COMPRESS_BLOCKSIZE', 'CompressedChunk']
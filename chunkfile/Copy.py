@@ -0,0 +1,224 @@
+import collections, os, time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .ChunkFile import (COPYBUFSIZE, FLAG_DEDUP, HEADERSIZE, Chunk, ChunkFile,
+                        ChunkFileHeader, _chunk_name, _clone_file, _copy_file, _copy_range, _data_extents, _fsync_dir)
+
+# Whole-volume copies that work on chunk files rather than through read()
+# and write(). Neither volume should be written to meanwhile by anyone else.
+
+COPY_THREADS = 8
+
+def _prepare_dir(dirpath):
+    if dirpath.exists():
+        if any(not entry.name.startswith('.') for entry in dirpath.iterdir()):
+            raise IOError('Directory is not empty: {0}'.format(dirpath))
+    else:
+        dirpath.mkdir()
+
+def _open_volume(dirpath, mode):
+    volume = ChunkFile(dirpath, mode)
+    if volume._store is not None:
+        volume.close()
+        raise NotImplementedError('copying volumes needs chunk files, not a {0}'.format(
+            type(volume._store).__name__))
+    return volume
+
+def _has_dedup(volume):
+    # dedup chunk files are only maps into blocks kept elsewhere
+    return any(chunk._header.flags() & FLAG_DEDUP for chunk in volume._chunks)
+
+def _copy_chunk(chunk, dirpath):
+    # Copy a chunk file, and its sidecars first, under its own name
+    name = chunk._path.name
+    for sidecar in chunk._sidecars():
+        if sidecar.exists():
+            _copy_file(sidecar, dirpath / sidecar.name)
+
+    tmp = dirpath / '.{0}.copying'.format(name)
+    if tmp.exists():
+        tmp.unlink()
+    _clone_file(chunk._path, tmp)
+    os.rename(str(tmp), str(dirpath / name))
+
+# copy(src, dst[, threads]): copy the volume in src (a directory, or a list
+#     of them) to the empty or new directory dst. Chunk files are reflinked
+#     where the filesystem allows and otherwise copied in the kernel, with
+#     holes kept, *threads* at a time. Returns the number of chunks copied.
+def copy(src, dst, threads=COPY_THREADS):
+    if threads < 1:
+        raise ValueError('threads must be at least 1')
+    dst = Path(dst)
+
+    volume = _open_volume(src, 'rb')
+    try:
+        if _has_dedup(volume):
+            raise NotImplementedError('dedup volumes cannot be copied chunk by chunk; use concat()')
+        _prepare_dir(dst)
+        chunks = list(volume._chunks)
+        with ThreadPoolExecutor(threads) as pool:
+            for _ in pool.map(lambda chunk: _copy_chunk(chunk, dst), chunks):
+                pass
+        _fsync_dir(dst)
+        return len(chunks)
+    finally:
+        volume.close()
+
+def _renumber_chunk(chunk, dirpath, chunknum, volume, generation):
+    # Put a copy of chunk into dirpath as chunk number chunknum of the volume
+    # with UUID *volume*, at its *generation*. Only the header changes; the
+    # mtime is kept, so that a hash tree sidecar stays good. The copy is
+    # made and given its header under a hidden name, then renamed into
+    # place: the chunk appears whole or not at all.
+    name = _chunk_name(chunknum)
+    oldname = chunk._path.name
+    tmp = dirpath / '.{0}.concat'.format(name)
+    if tmp.exists():
+        tmp.unlink()
+
+    sidecars = [s for s in chunk._sidecars() if s.exists()]
+    st = chunk._path.stat()
+    _clone_file(chunk._path, tmp)
+
+    fields = dict(chunk._header.fields)
+    fields.pop('logstart', None)
+    fields.pop('dropto', None)
+    if volume is not None:
+        fields['volume'] = volume
+    if 'generation' in fields:
+        fields['generation'] = str(generation)
+    header = ChunkFileHeader(sig=chunk._header.sig, version=chunk._header.version,
+                             iface_version=chunk._header.iface_version, chunknum=chunknum,
+                             fields=fields)
+    buf = bytearray(HEADERSIZE)
+    header.pack_into(buf)
+
+    fd = os.open(str(tmp), os.O_WRONLY)
+    try:
+        os.pwrite(fd, buf, 0)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.utime(str(tmp), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    for sidecar in sidecars:
+        newpath = dirpath / sidecar.name.replace(oldname, name)
+        if newpath.exists():
+            newpath.unlink()
+        _clone_file(sidecar, newpath)
+    os.rename(str(tmp), str(dirpath / name))
+
+def _copy_into(dstchunk, offset, srcchunk, srcoffset, count):
+    # Copy count bytes of srcchunk's data into dstchunk, whose range must
+    # read as zeros. Between plain chunk files this happens in the kernel,
+    # skipping holes; other formats go through read() and write().
+    plain = (type(dstchunk) is Chunk and type(srcchunk) is Chunk
+             and dstchunk._direct is None and srcchunk._direct is None)
+    if not plain:
+        pos = 0
+        while pos < count:
+            data = srcchunk.read(srcoffset + pos, min(COPYBUFSIZE, count - pos))
+            if not data:
+                break
+            dstchunk.write(offset + pos, data)
+            pos += len(data)
+        return
+
+    dstchunk._atime = time.monotonic()
+    dstchunk._unshare()
+    dstchunk._track(offset, offset + count)
+
+    infd = os.open(str(srcchunk._path), os.O_RDONLY)
+    try:
+        outfd = os.open(str(dstchunk._path), os.O_WRONLY)
+        try:
+            start = HEADERSIZE + srcoffset
+            for pos, n in _data_extents(infd, start, start + count):
+                _copy_range(infd, outfd, pos, n, pos - srcoffset + offset)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+    dstchunk._invalidate(offset, count)
+
+def _append_volume(out, volume, pool):
+    start = out._nbytes()
+    if not volume._chunks:
+        return
+
+    if (start % out._chunkdatasize == 0 and volume._chunkdatasize == out._chunkdatasize
+            and out._store is None and volume._store is None and not _has_dedup(volume)):
+        # Aligned: the chunks themselves go over, renumbered
+        base = out._first + len(out._chunks)
+        generation = out._volume_generation() + 1
+        jobs = []
+        for i, chunk in enumerate(volume._chunks):
+            chunknum = base + i
+            jobs.append((chunk, Path(out._placement(chunknum, out._dirpaths)), chunknum))
+        for _ in pool.map(lambda job: _renumber_chunk(job[0], job[1], job[2], out._volid, generation), jobs):
+            pass
+
+        for dirpath in set(job[1] for job in jobs):
+            _fsync_dir(dirpath)
+        out._refresh()
+        return
+
+    # Otherwise every byte moves by the same amount: copy each destination
+    # chunk's share, grouped so no chunk is worked on by two threads. The
+    # volumes' chunk sizes may differ.
+    shift = start - volume.start
+    out.truncate(start + volume._nbytes() - volume.start)
+
+    pieces = collections.OrderedDict()
+    dstsize = out._chunkdatasize
+    for i, chunk in enumerate(volume._chunks):
+        srcbase = (volume._first + i) * volume._chunkdatasize
+        pos, end = srcbase, srcbase + chunk.size()
+        while pos < end:
+            dstpos = pos + shift
+            n = min(end - pos, dstsize - dstpos % dstsize)
+            dstchunk = out._chunks[dstpos // dstsize - out._first]
+            pieces.setdefault(dstchunk, []).append((dstpos % dstsize, chunk, pos - srcbase, n))
+            pos += n
+
+    def copy_pieces(item):
+        dstchunk, todo = item
+        for args in todo:
+            _copy_into(dstchunk, *args)
+        out._mark_dirty(dstchunk)
+
+    for _ in pool.map(copy_pieces, pieces.items()):
+        pass
+
+# concat(dst, *srcs[, move[, threads]]): append the volumes srcs, in order,
+#     to the volume dst, which is created if need be. While dst ends on a
+#     chunk boundary, a source's chunk files are reflinked (or copied) in
+#     with new chunk numbers in their headers. Otherwise the data is copied
+#     in the kernel into chunks at its new offsets. With move=True each
+#     source is emptied once dst holds its data durably, so a crash leaves
+#     the data in one or both. Returns the new size of dst.
+def concat(dst, *srcs, move=False, threads=COPY_THREADS):
+    if threads < 1:
+        raise ValueError('threads must be at least 1')
+
+    out = ChunkFile(dst, 'ab')
+    try:
+        with ThreadPoolExecutor(threads) as pool:
+            for src in srcs:
+                volume = ChunkFile(src, 'rb')
+                try:
+                    _append_volume(out, volume, pool)
+                finally:
+                    volume.close()
+                if move:
+                    # what's left of the source is an empty volume
+                    out.sync()
+                    ChunkFile(src, 'wb').close()
+
+        out.sync()
+        return out._nbytes()
+    finally:
+        out.close()
+
+__all__ = ['copy', 'concat']
@@ -0,0 +1,541 @@
+import collections, hashlib, os, struct, threading, weakref, zlib
+from pathlib import Path
+
+from .ChunkFile import (CHUNKSIZE, FLAG_DEDUP, HEADERSIZE, Chunk, InvalidHeaderError,
+                        _fdatasync, _fsync_dir, register_chunk_format)
+
+DEDUP_BLOCKSIZE = 64 * 1024
+
+# Block maps of this many chunks per directory stay in memory; beyond that
+# the least recently used maps with nothing unsaved are dropped, to be read
+# again when next needed
+MAPCACHE = 64
+
+# Layout of a dedup chunk:
+#
+#   header page     flags=8, hash, dedupblock and mapslot fields
+#   map slot A      } the block map, written alternately to each slot so a
+#   map slot B      } torn write always leaves the other one intact
+#
+# A map slot is _SLOT followed by the digest of each logical block; a
+# digest of all zero bytes is a hole. The blocks themselves are files in
+# the directory's DedupStore.
+_SLOT = struct.Struct('<4sQQII')   # magic, seq, logical size, nblocks, crc32
+_MAGIC = b'DMAP'
+DIGESTSIZE = 32
+_HOLE = bytes(DIGESTSIZE)
+
+STORENAME = '.dedup'
+REFSNAME = 'refs'
+_REF = struct.Struct('<32sQ')      # digest, reference count
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=DIGESTSIZE).digest()
+
+def _slotsize(blocksize, chunksize):
+    nblocks = (chunksize - HEADERSIZE + blocksize - 1) // blocksize
+    size = _SLOT.size + DIGESTSIZE * nblocks
+    return (size + HEADERSIZE - 1) // HEADERSIZE * HEADERSIZE
+
+class DedupStore(object):
+    # The unique blocks of the dedup chunks in one directory, each in a
+    # hidden file named for its digest (.dedup/ab/abcd...), with a count of
+    # the block map entries pointing at it. A block whose count drops to
+    # zero is deleted.
+    #
+    # Counts live in memory and are saved whole to .dedup/refs, under a
+    # temporary name and renamed into place. Chunks save counts they raised
+    # before the map using the blocks, and lower counts only once the map
+    # no longer using them is saved, so after a crash counts can only be
+    # too high: the space of some blocks leaks, and reclaim() finds it.
+
+    _stores = weakref.WeakValueDictionary()
+    _stores_lock = threading.Lock()
+
+    def __init__(self, dirpath):
+        self._dir = dirpath / STORENAME
+        self._lock = threading.RLock()
+        self._refs = None
+        # the refs file as of the last load or save, to notice another
+        # process having changed it since
+        self._refstamp = None
+        self._unsaved = False
+        # block files written since the last durable save, and blocks
+        # whose count dropped to zero since the last save
+        self._new = []
+        self._doomed = []
+        # id -> weak reference of the chunks with their map in memory,
+        # least recently used first
+        self._maps = collections.OrderedDict()
+
+    @classmethod
+    def of(cls, dirpath):
+        # The store for the directory dirpath, shared in the process
+        key = os.path.realpath(str(dirpath))
+        with cls._stores_lock:
+            store = cls._stores.get(key)
+            if store is None:
+                store = cls._stores[key] = cls(Path(key))
+            return store
+
+    def _stamp(self):
+        try:
+            st = os.stat(str(self._dir / REFSNAME))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _load(self):
+        if self._refs is not None and (self._unsaved or self._stamp() == self._refstamp):
+            return
+
+        refs = {}
+        try:
+            with (self._dir / REFSNAME).open('rb') as f:
+                data = f.read()
+                stamp = os.fstat(f.fileno())
+        except FileNotFoundError:
+            data = b''
+            stamp = None
+        if len(data) % _REF.size:
+            raise IOError('{0} is damaged'.format(self._dir / REFSNAME))
+        for digest, count in _REF.iter_unpack(data):
+            refs[digest] = count
+        self._refs = refs
+        self._refstamp = None if stamp is None else (stamp.st_ino, stamp.st_mtime_ns, stamp.st_size)
+
+    def _blockpath(self, digest):
+        name = digest.hex()
+        return self._dir / name[:2] / name
+
+    def add(self, digest, data):
+        # One more reference to the block data, whose digest is given;
+        # stored if it's new
+        with self._lock:
+            self._load()
+            count = self._refs.get(digest, 0)
+            if not count:
+                path = self._blockpath(digest)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.parent / ('.' + path.name)
+                with tmp.open('wb') as f:
+                    f.write(data)
+                os.rename(str(tmp), str(path))
+                self._new.append(digest)
+            self._refs[digest] = count + 1
+            self._unsaved = True
+
+    def release(self, digests):
+        with self._lock:
+            self._load()
+            for digest in digests:
+                count = self._refs.get(digest, 0) - 1
+                if count > 0:
+                    self._refs[digest] = count
+                elif count == 0:
+                    del self._refs[digest]
+                    self._doomed.append(digest)
+                self._unsaved = True
+
+    def get(self, digest):
+        try:
+            with self._blockpath(digest).open('rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise IOError('{0}: block {1} is missing'.format(self._dir, digest.hex()))
+
+    def save(self, durable=False):
+        # Write the counts out, then delete the blocks nothing uses
+        with self._lock:
+            if not self._unsaved:
+                return
+
+            if durable:
+                paths = [self._blockpath(digest) for digest in self._new]
+                for path in paths:
+                    try:
+                        fd = os.open(str(path), os.O_RDONLY)
+                    except FileNotFoundError:
+                        # unused again, and deleted
+                        continue
+                    try:
+                        _fdatasync(fd)
+                    finally:
+                        os.close(fd)
+                for dirpath in set(path.parent for path in paths):
+                    _fsync_dir(dirpath)
+                self._new = []
+
+            self._dir.mkdir(exist_ok=True)
+            path = self._dir / REFSNAME
+            tmp = self._dir / (REFSNAME + '.tmp')
+            with tmp.open('wb') as f:
+                f.write(b''.join(_REF.pack(digest, count) for digest, count in self._refs.items()))
+                if durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(str(tmp), str(path))
+            if durable:
+                _fsync_dir(self._dir)
+            self._unsaved = False
+            self._refstamp = self._stamp()
+
+            for digest in self._doomed:
+                # counted again since
+                if digest in self._refs:
+                    continue
+                try:
+                    self._blockpath(digest).unlink()
+                except FileNotFoundError:
+                    pass
+            self._doomed = []
+
+    def _touch(self, chunk):
+        # chunk's map was just used: drop the oldest clean maps beyond
+        # MAPCACHE. A chunk busy in another thread is skipped, not waited on.
+        with self._lock:
+            key = id(chunk)
+            if key in self._maps:
+                self._maps.move_to_end(key)
+            else:
+                self._maps[key] = weakref.ref(chunk, lambda ref: self._maps.pop(key, None))
+
+            for oldkey, ref in list(self._maps.items()):
+                if len(self._maps) <= MAPCACHE:
+                    break
+                old = ref()
+                if old is None or old is chunk or not old._lock.acquire(False):
+                    continue
+                try:
+                    if not old._mapdirty and not old._released:
+                        old._map = None
+                        del self._maps[oldkey]
+                finally:
+                    old._lock.release()
+
+    def _forget(self, chunk):
+        with self._lock:
+            self._maps.pop(id(chunk), None)
+
+    def recount(self, counts):
+        # Replace the counts by *counts* (digest -> references), and delete
+        # every block file not in them. Returns the number deleted.
+        with self._lock:
+            self._refs = dict(counts)
+            self._unsaved = True
+            self._doomed = []
+            self.save(durable=True)
+
+            deleted = 0
+            if self._dir.is_dir():
+                for subdir in self._dir.iterdir():
+                    if not subdir.is_dir():
+                        continue
+                    for path in subdir.iterdir():
+                        try:
+                            digest = bytes.fromhex(path.name)
+                        except ValueError:
+                            digest = None
+                        if digest not in self._refs:
+                            path.unlink()
+                            deleted += 1
+            return deleted
+
+    def stats(self):
+        # unique blocks stored, and references to them
+        with self._lock:
+            self._load()
+            return {'blocks': len(self._refs), 'references': sum(self._refs.values())}
+
+class DedupChunk(Chunk):
+    # Chunk whose data is split into fixed logical blocks, stored once per
+    # directory however many times they occur: the chunk file only holds
+    # the map from each of its blocks to a block in the DedupStore. Blocks
+    # of zeros are holes and aren't stored at all.
+    #
+    # Changed blocks are hashed and stored as they are written; the map is
+    # written on flush(). Like the compressed format's index, the map is
+    # loaded on first use and changes made through another ChunkFile after
+    # that aren't seen.
+
+    buffered = True
+
+    __slots__ = ('_bs', '_slotsize', '_blocks', '_lock', '_map', '_size', '_seq',
+                 '_mapdirty', '_released', '__weakref__')
+
+    def __init__(self, path, header, direct=None, cache=None):
+        # blocks live in files of their own; O_DIRECT doesn't apply
+        super(DedupChunk, self).__init__(path, header, None, cache)
+
+        try:
+            hashname = header.fields['hash']
+            self._bs = int(header.fields['dedupblock'])
+            self._slotsize = int(header.fields['mapslot'])
+        except (KeyError, ValueError):
+            raise InvalidHeaderError('{0}: bad dedup chunk fields'.format(path))
+        if hashname != 'blake2b':
+            raise InvalidHeaderError('{0}: unknown block hash {1!r}'.format(path, hashname))
+
+        self._blocks = DedupStore.of(path.parent)
+        self._lock = threading.RLock()
+        # digest of each block, None until loaded
+        self._map = None
+        self._size = 0
+        self._seq = 0
+        self._mapdirty = False
+        # blocks the unsaved map no longer uses
+        self._released = []
+
+    @classmethod
+    def _header_fields(cls, blocksize=DEDUP_BLOCKSIZE, chunksize=CHUNKSIZE):
+        if blocksize <= 0:
+            raise ValueError('blocksize must be positive')
+
+        return {'flags': '{0:x}'.format(FLAG_DEDUP), 'hash': 'blake2b',
+                'dedupblock': str(blocksize),
+                'mapslot': str(_slotsize(blocksize, chunksize))}
+
+    def _parse_slot(self, data):
+        if len(data) < _SLOT.size:
+            return None
+
+        magic, seq, size, nblocks, crc = _SLOT.unpack_from(data)
+        end = _SLOT.size + nblocks * DIGESTSIZE
+        if magic != _MAGIC or end > len(data):
+            return None
+        if zlib.crc32(data[4:_SLOT.size-4] + data[_SLOT.size:end]) != crc:
+            return None
+
+        digests = [bytes(data[pos:pos+DIGESTSIZE]) for pos in range(_SLOT.size, end, DIGESTSIZE)]
+        return seq, size, digests
+
+    def _load(self):
+        if self._map is None:
+            with self._path.open('rb') as f:
+                f.seek(HEADERSIZE)
+                slots = f.read(2 * self._slotsize)
+
+            best = None
+            for i in range(2):
+                slot = self._parse_slot(slots[i*self._slotsize:(i+1)*self._slotsize])
+                if slot is not None and (best is None or slot[0] > best[0]):
+                    best = slot
+
+            if best is None:
+                self._seq, self._size, self._map = 0, 0, []
+            else:
+                self._seq, self._size, self._map = best
+
+        self._blocks._touch(self)
+
+    def _write_map(self, fd):
+        self._seq += 1
+        digests = b''.join(self._map)
+        fixed = _SLOT.pack(_MAGIC, self._seq, self._size, len(self._map), 0)
+        crc = zlib.crc32(fixed[4:_SLOT.size-4] + digests)
+        slot = _SLOT.pack(_MAGIC, self._seq, self._size, len(self._map), crc) + digests
+
+        os.pwrite(fd, slot, HEADERSIZE + (self._seq % 2) * self._slotsize)
+        self._mapdirty = False
+
+    def _blocklen(self, b):
+        return max(0, min(self._bs, self._size - b * self._bs))
+
+    def _get_block(self, b):
+        n = self._blocklen(b)
+        digest = self._map[b] if b < len(self._map) else _HOLE
+        data = b'' if digest == _HOLE else self._blocks.get(digest)
+        if len(data) < n:
+            data += bytes(n - len(data))
+        return data[:n]
+
+    def _put_block(self, b, data):
+        digest = _HOLE if data.count(0) == len(data) else _digest(data)
+        if len(self._map) <= b:
+            self._map.extend([_HOLE] * (b + 1 - len(self._map)))
+
+        old = self._map[b]
+        if digest == old:
+            return
+        if digest != _HOLE:
+            self._blocks.add(digest, data)
+        if old != _HOLE:
+            self._released.append(old)
+        self._map[b] = digest
+        self._mapdirty = True
+
+    def _read(self, offset, count):
+        with self._lock:
+            self._load()
+
+            end = min(offset + count, self._size)
+            if end <= offset:
+                return b''
+
+            pieces = []
+            for b in range(offset // self._bs, (end - 1) // self._bs + 1):
+                block = self._get_block(b)
+                lo = max(offset - b * self._bs, 0)
+                hi = min(end - b * self._bs, len(block))
+                pieces.append(block[lo:hi])
+            return b''.join(pieces)
+
+    def _readinto(self, offset, view):
+        data = self._read(offset, len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def _write(self, offset, data):
+        with self._lock:
+            self._load()
+
+            bs = self._bs
+            end = offset + len(data)
+            pos = offset
+            while pos < end:
+                b = pos // bs
+                lo = pos - b * bs
+                hi = min(end - b * bs, bs)
+                piece = data[pos-offset:pos-offset+hi-lo]
+
+                if lo == 0 and (hi == bs or end >= self._size):
+                    block = bytes(piece)
+                else:
+                    buf = bytearray(self._get_block(b))
+                    if len(buf) < hi:
+                        buf.extend(bytes(hi - len(buf)))
+                    buf[lo:hi] = piece
+                    block = bytes(buf)
+
+                self._put_block(b, block)
+                pos = b * bs + hi
+
+            if end > self._size:
+                self._size = end
+                self._mapdirty = True
+
+    def _truncate(self, size):
+        with self._lock:
+            self._load()
+
+            if size < self._size:
+                nblocks = (size + self._bs - 1) // self._bs
+                self._released.extend(d for d in self._map[nblocks:] if d != _HOLE)
+                del self._map[nblocks:]
+
+                # Cut the new last block down, so that growing the chunk
+                # again shows zeros rather than the old bytes.
+                if size % self._bs:
+                    b = size // self._bs
+                    self._put_block(b, self._get_block(b)[:size % self._bs])
+
+            self._size = size
+            self._mapdirty = True
+
+    def size(self):
+        with self._lock:
+            if self._map is None:
+                # the header knows, unless the chunk changed since a flush
+                length = self._recorded_length()
+                if length is not None:
+                    return length
+            self._load()
+            return self._size
+
+    def _stored_size(self):
+        with self._lock:
+            self._load()
+            return self._size
+
+    def flush(self, durable=False):
+        with self._lock:
+            if self._map is None or not self._mapdirty:
+                return
+            self._unshare()
+
+            # counts raised for the map go out before it
+            self._blocks.save(durable)
+            fd = os.open(str(self._path), os.O_RDWR)
+            try:
+                self._write_map(fd)
+                if durable:
+                    _fdatasync(fd)
+            finally:
+                os.close(fd)
+
+            if self._released:
+                released, self._released = self._released, []
+                self._blocks.release(released)
+                self._blocks.save(durable)
+
+    def _data_ranges(self, start, end):
+        with self._lock:
+            self._load()
+
+            ranges = []
+            bs = self._bs
+            for b in range(start // bs, min(len(self._map), (end + bs - 1) // bs)):
+                if self._map[b] == _HOLE:
+                    continue
+                lo = max(start, b * bs)
+                hi = min(end, (b + 1) * bs)
+                if ranges and ranges[-1][0] + ranges[-1][1] == lo:
+                    ranges[-1] = (ranges[-1][0], hi - ranges[-1][0])
+                elif hi > lo:
+                    ranges.append((lo, hi - lo))
+            return ranges
+
+    def scrub(self):
+        # blocks whose stored data is missing or doesn't match its digest
+        with self._lock:
+            self._load()
+
+            bad = []
+            for b, digest in enumerate(self._map):
+                if digest == _HOLE:
+                    continue
+                try:
+                    ok = _digest(self._blocks.get(digest)) == digest
+                except IOError:
+                    ok = False
+                if not ok:
+                    bad.append((b * self._bs, b * self._bs + self._blocklen(b)))
+            return bad
+
+    def erase(self):
+        with self._lock:
+            self._load()
+            used = [d for d in self._map if d != _HOLE] + self._released
+            super(DedupChunk, self).erase()
+
+            self._blocks.release(used)
+            self._blocks.save()
+            self._blocks._forget(self)
+            self._map = None
+            self._released = []
+            self._mapdirty = False
+
+    def sync(self):
+        self.flush(durable=True)
+        super(DedupChunk, self).sync()
+
+register_chunk_format(FLAG_DEDUP, DedupChunk)
+
+# reclaim(dirpath): recount the references to the blocks of the dedup chunks
+#     in dirpath from their maps, and delete the blocks nothing uses, such
+#     as those a crash left behind. No volume using dirpath may be open.
+#     Returns the number of blocks deleted.
+def reclaim(dirpath):
+    dirpath = Path(dirpath)
+    counts = collections.Counter()
+    for path in sorted(dirpath.glob('chunk.*.dat')):
+        chunk = Chunk.open(path)
+        if isinstance(chunk, DedupChunk):
+            with chunk._lock:
+                chunk._load()
+                counts.update(d for d in chunk._map if d != _HOLE)
+                chunk._blocks._forget(chunk)
+
+    return DedupStore.of(dirpath).recount(counts)
+
+__all__ = ['DEDUP_BLOCKSIZE', 'DedupChunk', 'DedupStore', 'reclaim']
@@ -0,0 +1,132 @@
+import hashlib, os, struct
+
+MERKLE_BLOCKSIZE = 64 * 1024
+
+DIGESTSIZE = 16
+
+# Sidecar file holding a chunk's leaf digests:
+#   magic, blocksize, nleaves, the st_size and st_mtime_ns of the chunk file
+#   they were computed from, and the root of the chunk's tree, then nleaves
+#   digests.
+# The leaves are only trusted while the chunk file still has that size and
+# mtime; anything else means the chunk changed behind our back. The root is
+# there so that comparing chunks takes only the header.
+_TREEHDR = struct.Struct('<4sIQQq16s')
+_MAGIC = b'HTR2'
+
+def leaf_hash(data):
+    return hashlib.blake2b(b'\x00' + bytes(data), digest_size=DIGESTSIZE).digest()
+
+def _node_hash(left, right):
+    if right is None:
+        return hashlib.blake2b(b'\x01' + left, digest_size=DIGESTSIZE).digest()
+    return hashlib.blake2b(b'\x02' + left + right, digest_size=DIGESTSIZE).digest()
+
+def stamp(path):
+    st = os.stat(str(path))
+    return st.st_size, st.st_mtime_ns
+
+def load_leaves(treepath, blocksize, want_stamp=None):
+    # Leaf digests saved in treepath, or None if there are none usable.
+    # With want_stamp, they must have been saved for that stamp.
+    try:
+        with open(str(treepath), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    if len(data) < _TREEHDR.size:
+        return None
+
+    magic, bs, nleaves, size, mtime, root = _TREEHDR.unpack_from(data)
+    if magic != _MAGIC or bs != blocksize:
+        return None
+    if len(data) != _TREEHDR.size + nleaves * DIGESTSIZE:
+        return None
+    if want_stamp is not None and (size, mtime) != want_stamp:
+        return None
+
+    return [data[_TREEHDR.size + i*DIGESTSIZE:_TREEHDR.size + (i+1)*DIGESTSIZE]
+            for i in range(nleaves)]
+
+def load_root(treepath, blocksize, want_stamp):
+    # Tree root saved in treepath for want_stamp, or None. Only the header
+    # is read.
+    try:
+        with open(str(treepath), 'rb') as f:
+            data = f.read(_TREEHDR.size)
+            filesize = os.fstat(f.fileno()).st_size
+    except FileNotFoundError:
+        return None
+
+    if len(data) < _TREEHDR.size:
+        return None
+
+    magic, bs, nleaves, size, mtime, root = _TREEHDR.unpack(data)
+    if magic != _MAGIC or bs != blocksize or (size, mtime) != want_stamp:
+        return None
+    if filesize != _TREEHDR.size + nleaves * DIGESTSIZE:
+        return None
+    return root
+
+def save_leaves(treepath, blocksize, leaves, chunkstamp, root):
+    # Best effort: the sidecar is only a cache, so a volume on a read-only
+    # directory simply rehashes every time.
+    tmp = treepath.parent / (treepath.name + '.tmp')
+    try:
+        with open(str(tmp), 'wb') as f:
+            f.write(_TREEHDR.pack(_MAGIC, blocksize, len(leaves), chunkstamp[0], chunkstamp[1], root))
+            f.write(b''.join(leaves))
+        os.replace(str(tmp), str(treepath))
+    except OSError:
+        pass
+
+class MerkleTree(object):
+    # Binary hash tree over a list of leaf digests, one per data block.
+    #
+    # The shape is fixed by *capacity*, the most leaves the tree can have,
+    # not by how many it has: node i of level l always covers leaves
+    # [i << l, (i+1) << l). Two trees of the same capacity can then be
+    # compared node by node even when one of them is shorter.
+
+    def __init__(self, leaves, capacity=None):
+        capacity = max(capacity or 0, len(leaves), 1)
+        self.levels = [list(leaves)]
+        while (1 << (len(self.levels) - 1)) < capacity:
+            below = self.levels[-1]
+            self.levels.append([_node_hash(below[i], below[i+1] if i + 1 < len(below) else None)
+                                for i in range(0, len(below), 2)])
+
+    def root(self):
+        top = self.levels[-1]
+        return top[0] if top else leaf_hash(b'')
+
+    def leaves(self):
+        return self.levels[0]
+
+    def _node(self, level, i):
+        nodes = self.levels[level]
+        return nodes[i] if i < len(nodes) else None
+
+    def diff(self, other):
+        # Sorted indexes of leaves that differ between the two trees,
+        # including leaves only one of them has. Only subtrees whose roots
+        # differ are visited.
+        if len(self.levels) != len(other.levels):
+            raise ValueError('Trees of different capacity cannot be compared')
+
+        changed = []
+        stack = [(len(self.levels) - 1, 0)]
+        while stack:
+            level, i = stack.pop()
+            if self._node(level, i) == other._node(level, i):
+                continue
+            if level == 0:
+                changed.append(i)
+            else:
+                stack.append((level - 1, 2*i + 1))
+                stack.append((level - 1, 2*i))
+
+        return sorted(changed)
+
+__all__ = ['MERKLE_BLOCKSIZE', 'MerkleTree']
@@ -0,0 +1,350 @@
+import collections, os, queue, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .ChunkStore import ChunkStore
+
+PARTSIZE = 4 * 1024 * 1024
+CACHEPARTS = 64
+READAHEAD = 4
+CONNECTIONS = 8
+
+_SIZEKEY = 'size'
+
+class _Connection(object):
+    # One "connection" to the stand-in bucket: a directory of objects named
+    # by key. Objects are only ever read (whole or a range) and replaced
+    # whole, as with an HTTP object store.
+
+    def __init__(self, rootdir, latency):
+        self._rootdir = rootdir
+        self._latency = latency
+
+    def _request(self):
+        if self._latency:
+            time.sleep(self._latency)
+
+    def _path(self, key):
+        return self._rootdir / key
+
+    def get(self, key, start=None, end=None):
+        # the object, or bytes [start, end) of it; None if there is none
+        self._request()
+        try:
+            with self._path(key).open('rb') as f:
+                if start is None:
+                    return f.read()
+                f.seek(start)
+                return f.read(end - start)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        # Replace the object, durably: readers see the old or the new one
+        self._request()
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.parent / '.{0}.put'.format(path.name)
+        with tmp.open('wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(tmp), str(path))
+
+    def delete(self, key):
+        self._request()
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix=''):
+        # keys starting with prefix; keys are <object>/<part>
+        self._request()
+        keys = []
+        for objdir in self._rootdir.iterdir():
+            if not objdir.is_dir():
+                continue
+            for part in objdir.iterdir():
+                key = '{0}/{1}'.format(objdir.name, part.name)
+                if not part.name.startswith('.') and key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+class LocalObjectStore(ChunkStore):
+    # Stand-in for an object store (S3 and the like), kept in a local
+    # directory, to run volumes against the way such a store is used:
+    # objects can be read whole or by byte range, and only written whole.
+    #
+    # Each chunk is kept as parts of *partsize* bytes, plus an object with
+    # its size, so a write to the middle of a chunk replaces just the parts
+    # it touches. Parts never written read as zeros.
+    #
+    # Requests go out over at most *connections* pooled connections, each
+    # taking *latency* seconds on top of the I/O to mimic a remote service.
+    # To hide the latency, up to *cache_parts* parts are kept in memory:
+    # reads fetch the parts they need, and *readahead* more, in parallel;
+    # writes collect in the cached parts, which go out when they are
+    # evicted, or on flush() or sync().
+
+    def __init__(self, rootdir, partsize=PARTSIZE, cache_parts=CACHEPARTS,
+                 readahead=READAHEAD, connections=CONNECTIONS, latency=0):
+        if partsize <= 0:
+            raise ValueError('partsize must be positive')
+        if cache_parts < 1:
+            raise ValueError('cache_parts must be at least 1')
+        if connections < 1:
+            raise ValueError('connections must be at least 1')
+
+        self._rootdir = Path(rootdir)
+        self._rootdir.mkdir(exist_ok=True)
+        self._partsize = partsize
+        self._cacheparts = cache_parts
+        self._readahead = readahead
+        self._latency = latency
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(connections)
+        self._executor = ThreadPoolExecutor(connections)
+
+        self._lock = threading.RLock()
+        # (name, part number) -> bytearray, least recently used first
+        self._parts = collections.OrderedDict()
+        self._dirty = set()
+        # name -> size, for objects looked at so far
+        self._sizes = {}
+        self._sizedirty = set()
+        self.requests = 0
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return _Connection(self._rootdir, self._latency)
+
+    def _release(self, conn):
+        self._idle.put(conn)
+        self._slots.release()
+
+    def _call(self, method, *args):
+        conn = self._acquire()
+        try:
+            self.requests += 1
+            return getattr(conn, method)(*args)
+        finally:
+            self._release(conn)
+
+    @staticmethod
+    def _key(name, partnum):
+        return '{0}/{1:0>8d}'.format(name, partnum)
+
+    def _check_name(self, name):
+        if not name or '/' in name or name in ('.', '..'):
+            raise ValueError('Invalid object name: {0!r}'.format(name))
+
+    def _size(self, name):
+        size = self._sizes.get(name)
+        if size is None:
+            data = self._call('get', '{0}/{1}'.format(name, _SIZEKEY))
+            if data is None:
+                raise FileNotFoundError('No such object: {0}'.format(name))
+            size = self._sizes[name] = int(data)
+        return size
+
+    def _set_size(self, name, size):
+        self._sizes[name] = size
+        self._sizedirty.add(name)
+
+    def _partlen(self, name, partnum):
+        return max(0, min(self._partsize, self._size(name) - partnum * self._partsize))
+
+    def _fetch(self, name, partnums):
+        # bring parts into the cache, several requests at a time
+        wanted = [p for p in partnums if (name, p) not in self._parts]
+        fetched = self._executor.map(lambda p: self._call('get', self._key(name, p)), wanted)
+        for partnum, data in zip(wanted, fetched):
+            part = bytearray(data or b'')
+            n = self._partlen(name, partnum)
+            # a part may be short, or longer than the object after truncate
+            if len(part) < n:
+                part.extend(bytes(n - len(part)))
+            del part[n:]
+            self._put_part(name, partnum, part)
+
+    def _put_part(self, name, partnum, part):
+        self._parts[(name, partnum)] = part
+        self._parts.move_to_end((name, partnum))
+        evicted = []
+        while len(self._parts) > self._cacheparts:
+            key, old = self._parts.popitem(last=False)
+            if key in self._dirty:
+                self._dirty.discard(key)
+                evicted.append((key, old))
+        self._write_parts(evicted)
+
+    def _part(self, name, partnum):
+        key = (name, partnum)
+        if key not in self._parts:
+            self._fetch(name, [partnum])
+        self._parts.move_to_end(key)
+        return self._parts[key]
+
+    def _write_parts(self, parts):
+        futures = [self._executor.submit(self._call, 'put', self._key(name, partnum), bytes(part))
+                   for (name, partnum), part in parts]
+        for future in futures:
+            future.result()
+
+    def list(self):
+        with self._lock:
+            names = set(key.split('/')[0] for key in self._call('list')
+                        if key.endswith('/' + _SIZEKEY))
+            names.update(self._sizes)
+            return sorted(names)
+
+    def create(self, name):
+        self._check_name(name)
+        with self._lock:
+            self._forget(name)
+            for key in self._call('list', name + '/'):
+                self._call('delete', key)
+            self._set_size(name, 0)
+            self._flush_size(name)
+
+    def open(self, name):
+        with self._lock:
+            self._size(name)
+
+    def read_at(self, name, offset, count):
+        with self._lock:
+            end = min(offset + count, self._size(name))
+            if end <= offset:
+                return b''
+
+            ps = self._partsize
+            first, last = offset // ps, (end - 1) // ps
+            ahead = min(last + self._readahead, (self._size(name) - 1) // ps)
+            self._fetch(name, range(first, ahead + 1))
+
+            pieces = []
+            for partnum in range(first, last + 1):
+                part = self._part(name, partnum)
+                lo = max(offset, partnum * ps) - partnum * ps
+                hi = min(end, (partnum + 1) * ps) - partnum * ps
+                pieces.append(bytes(part[lo:hi]))
+            return b''.join(pieces)
+
+    def write_at(self, name, offset, data):
+        with self._lock:
+            size = self._size(name)
+            end = offset + len(data)
+            if end > size:
+                self._grow(name, end)
+
+            ps = self._partsize
+            with memoryview(data) as view:
+                pos = offset
+                while pos < end:
+                    partnum = pos // ps
+                    lo = pos - partnum * ps
+                    hi = min(end, (partnum + 1) * ps) - partnum * ps
+                    if lo == 0 and hi == self._partlen(name, partnum):
+                        # replaced whole: no need to fetch it
+                        self._put_part(name, partnum, bytearray(view[pos-offset:pos-offset+hi]))
+                    else:
+                        part = self._part(name, partnum)
+                        part[lo:hi] = view[pos-offset:pos-offset+hi-lo]
+                    self._dirty.add((name, partnum))
+                    pos += hi - lo
+
+    def _grow(self, name, size):
+        # the old last part grows with zeros, if it's cached
+        oldsize = self._size(name)
+        self._set_size(name, size)
+        if oldsize % self._partsize:
+            key = (name, oldsize // self._partsize)
+            if key in self._parts:
+                part = self._parts[key]
+                part.extend(bytes(self._partlen(*key) - len(part)))
+
+    def truncate(self, name, size):
+        with self._lock:
+            oldsize = self._size(name)
+            if size >= oldsize:
+                self._grow(name, size)
+                return
+
+            ps = self._partsize
+            keep = (size + ps - 1) // ps
+            if size % ps:
+                # the new last part is cut short now, so that growing
+                # again later brings back zeros and not the old data
+                part = self._part(name, size // ps)
+                del part[size % ps:]
+                self._dirty.add((name, size // ps))
+
+            for key in [key for key in self._parts if key[0] == name and key[1] >= keep]:
+                del self._parts[key]
+                self._dirty.discard(key)
+            for key in self._call('list', name + '/'):
+                partname = key.split('/')[1]
+                if partname != _SIZEKEY and int(partname) >= keep:
+                    self._call('delete', key)
+
+            self._set_size(name, size)
+
+    def size(self, name):
+        with self._lock:
+            return self._size(name)
+
+    def _forget(self, name):
+        for key in [key for key in self._parts if key[0] == name]:
+            del self._parts[key]
+            self._dirty.discard(key)
+        self._sizes.pop(name, None)
+        self._sizedirty.discard(name)
+
+    def erase(self, name):
+        with self._lock:
+            self._size(name)
+            self._forget(name)
+            # the size goes first: a crash leaves no half-erased object
+            self._call('delete', '{0}/{1}'.format(name, _SIZEKEY))
+            for key in self._call('list', name + '/'):
+                self._call('delete', key)
+            try:
+                (self._rootdir / name).rmdir()
+            except OSError:
+                pass
+
+    def _flush_size(self, name):
+        if name in self._sizedirty:
+            self._call('put', '{0}/{1}'.format(name, _SIZEKEY), str(self._sizes[name]).encode('ascii'))
+            self._sizedirty.discard(name)
+
+    def flush(self, name):
+        with self._lock:
+            dirty = sorted(key for key in self._dirty if key[0] == name)
+            self._write_parts([(key, self._parts[key]) for key in dirty])
+            self._dirty.difference_update(dirty)
+            self._flush_size(name)
+
+    def sync(self, name=None):
+        # PUTs are durable when they return
+        if name is not None:
+            self.flush(name)
+
+    def close(self):
+        with self._lock:
+            for name in set(key[0] for key in self._dirty) | set(self._sizedirty):
+                self.flush(name)
+        self._executor.shutdown()
+
+    def __str__(self):
+        return str(self._rootdir)
+
+    def __repr__(self):
+        return 'LocalObjectStore({0!r})'.format(str(self._rootdir))
+
+__all__ = ['LocalObjectStore']
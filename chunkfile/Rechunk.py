@@ -0,0 +1,291 @@
+import argparse, collections, json, os, sys, threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .ChunkFile import (CHUNKSIZE, HEADERSIZE, IFACE_VERSION, SIGNATURE, VERSION,
+                        ChunkFileHeader, UnsupportedVersionError, _chunk_name, _chunk_number,
+                        _copy_range, _data_extents, _fsync_dir)
+
+# Offline conversion of a volume to another chunk size. The source must not
+# be in use meanwhile. Only plain chunks in a single directory are copied;
+# compressed or checksummed volumes have to be read and written through
+# ChunkFile.
+#
+# Each destination chunk is built under a hidden name from the source byte
+# ranges it overlaps, copied in the kernel with copy_file_range (holes stay
+# holes), then fsynced and renamed into place. Ranges of many chunks are
+# copied at once by a pool of threads. The plan is saved first in a hidden
+# state file, so an interrupted run picks up where it stopped: chunks with
+# their final name are done, anything else is built again. The state file
+# goes last.
+#
+# Every chunk written records its size in a chunksize header field, where
+# ChunkFile takes a volume's chunk size from. The copy keeps the source's
+# volume UUID.
+
+RECHUNK_THREADS = 8
+STATENAME = '.rechunk'
+
+def _chunk_size_of(header):
+    return int(header.fields.get('chunksize', CHUNKSIZE))
+
+def _scan(srcdir):
+    # chunk size, first chunk number, [(path, data size)] and UUID of a
+    # volume
+    found = {}
+    with os.scandir(str(srcdir)) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            chunknum = _chunk_number(entry.name)
+            if chunknum is None or not entry.is_file():
+                raise ValueError('{0} is not a chunk file named for its chunk number'.format(entry.path))
+            found[chunknum] = Path(entry.path)
+
+    if not found:
+        return None, 0, [], None
+
+    chunksize = volume = None
+    chunks = []
+    first, last = min(found), max(found)
+    for chunknum in range(first, last + 1):
+        if chunknum not in found:
+            raise IOError('Missing chunk {0:0>11d}'.format(chunknum))
+        path = found[chunknum]
+
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            buf = os.pread(fd, HEADERSIZE, 0)
+            size = os.fstat(fd).st_size - HEADERSIZE
+        finally:
+            os.close(fd)
+        if len(buf) < HEADERSIZE:
+            raise IOError('{0} is not a valid chunkfile'.format(path))
+        header = ChunkFileHeader.unpack_from(buf)
+
+        if header.chunknum != chunknum:
+            raise IOError('{0} holds chunk {1:0>11d}'.format(path, header.chunknum))
+        if header.flags():
+            raise UnsupportedVersionError('{0}: only plain chunks can be rechunked'.format(path))
+        if 'dropto' in header.fields:
+            raise IOError('{0} was dropping chunks when it stopped; open it once to finish'.format(srcdir))
+        if chunknum == first and first and 'logstart' not in header.fields:
+            raise IOError('{0} has chunks left below the start of its log; open it once to drop them'.format(srcdir))
+
+        if chunksize is None:
+            chunksize = _chunk_size_of(header)
+            volume = header.fields.get('volume')
+        elif _chunk_size_of(header) != chunksize:
+            raise IOError('{0} mixes chunk sizes'.format(srcdir))
+        chunks.append((path, size))
+
+    for path, size in chunks[:-1]:
+        if size != chunksize - HEADERSIZE:
+            raise IOError('{0} is short, and not the last chunk'.format(path))
+
+    return chunksize, first, chunks, volume
+
+def _plan(srcdir, chunksize):
+    # Destination chunks of srcdir rechunked to chunksize, as a list of
+    # (chunk number, data size, [(source path, source file offset,
+    # destination file offset, length)]), the source chunk size and the
+    # volume's UUID
+    srcsize, first, chunks, volume = _scan(srcdir)
+    if not chunks:
+        return [], srcsize, volume
+
+    srccds = srcsize - HEADERSIZE
+    dstcds = chunksize - HEADERSIZE
+    start = first * srccds
+    end = start + srccds * (len(chunks) - 1) + chunks[-1][1]
+
+    # A log that dropped chunks starts in the chunk holding its first byte,
+    # with a hole up to that byte: the start moves down to a chunk boundary
+    dstfirst = start // dstcds
+    dstlast = max(dstfirst, (end - 1) // dstcds)
+
+    targets = []
+    for dstnum in range(dstfirst, dstlast + 1):
+        base = dstnum * dstcds
+        lo = max(base, start)
+        hi = min(base + dstcds, end)
+
+        segments = []
+        pos = lo
+        while pos < hi:
+            i = pos // srccds - first
+            srcbase = (first + i) * srccds
+            n = min(hi, srcbase + srccds) - pos
+            segments.append((str(chunks[i][0]), HEADERSIZE + pos - srcbase, HEADERSIZE + pos - base, n))
+            pos += n
+
+        targets.append((dstnum, max(0, hi - base), segments))
+    return targets, srcsize, volume
+
+class _Target(object):
+    # a destination chunk being built, and its ranges still to copy
+    def __init__(self, tmp, final, remaining):
+        self.tmp = tmp
+        self.final = final
+        self.remaining = remaining
+        self.lock = threading.Lock()
+
+def _start_chunk(dstdir, chunknum, datasize, chunksize, volume, logstart):
+    final = dstdir / _chunk_name(chunknum)
+    tmp = dstdir / '.{0}.rechunk'.format(final.name)
+
+    # the chunk is synced before it is renamed into place, so its length
+    # can go in now
+    fields = {'chunksize': str(chunksize), 'generation': '0', 'length': str(datasize)}
+    if volume is not None:
+        fields['volume'] = volume
+    if logstart:
+        fields['logstart'] = '1'
+    header = ChunkFileHeader(sig=SIGNATURE, version=VERSION, iface_version=IFACE_VERSION,
+                             chunknum=chunknum, fields=fields)
+    buf = bytearray(HEADERSIZE)
+    header.pack_into(buf)
+
+    fd = os.open(str(tmp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.pwrite(fd, buf, 0)
+        os.ftruncate(fd, HEADERSIZE + datasize)
+    finally:
+        os.close(fd)
+    return tmp, final
+
+def _finish_chunk(target):
+    fd = os.open(str(target.tmp), os.O_WRONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(str(target.tmp), str(target.final))
+
+def _copy_segment(target, segment):
+    srcpath, srcofs, dstofs, count = segment
+    infd = os.open(srcpath, os.O_RDONLY)
+    try:
+        outfd = os.open(str(target.tmp), os.O_WRONLY)
+        try:
+            for offset, n in _data_extents(infd, srcofs, srcofs + count):
+                _copy_range(infd, outfd, offset, n, dstofs + offset - srcofs)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
+    with target.lock:
+        target.remaining -= 1
+        done = not target.remaining
+    if done:
+        _finish_chunk(target)
+
+def _load_state(statepath):
+    try:
+        with statepath.open() as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _save_state(statepath, state):
+    tmp = statepath.parent / (statepath.name + '.tmp')
+    with tmp.open('w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(str(tmp), str(statepath))
+    _fsync_dir(statepath.parent)
+
+# rechunk(srcdir, dstdir, chunksize[, threads]): copy the volume in srcdir
+#     to dstdir with chunks of chunksize bytes, header included. dstdir must
+#     not hold a volume, unless it is what an interrupted rechunk of the same
+#     source to the same size left. Returns the number of chunks written by
+#     this call.
+def rechunk(srcdir, dstdir, chunksize, threads=RECHUNK_THREADS):
+    srcdir = Path(srcdir)
+    dstdir = Path(dstdir)
+    if chunksize <= HEADERSIZE:
+        raise ValueError('chunksize must be more than the {0} byte header'.format(HEADERSIZE))
+    if threads < 1:
+        raise ValueError('threads must be at least 1')
+    if not srcdir.is_dir():
+        raise IOError('No such directory: {0}'.format(srcdir))
+    if dstdir.exists() and dstdir.resolve() == srcdir.resolve():
+        raise ValueError('Cannot rechunk a volume in place')
+
+    targets, srcsize, volume = _plan(srcdir, chunksize)
+
+    dstdir.mkdir(exist_ok=True)
+    statepath = dstdir / STATENAME
+    state = {'source': str(srcdir.resolve()), 'source_chunksize': srcsize, 'chunksize': chunksize,
+             'chunks': [t[0] for t in targets[:1] + targets[-1:]]}
+    saved = _load_state(statepath)
+
+    existing = set(p.name for p in dstdir.iterdir() if not p.name.startswith('.'))
+    if saved is None:
+        if existing:
+            raise IOError('{0} is not empty'.format(dstdir))
+        _save_state(statepath, state)
+    elif saved != state:
+        raise IOError('{0} holds an unfinished rechunk of something else'.format(dstdir))
+
+    for p in dstdir.glob('.*.rechunk'):
+        p.unlink()
+
+    pending = [t for t in targets if _chunk_name(t[0]) not in existing]
+    dstfirst = targets[0][0] if targets else 0
+
+    with ThreadPoolExecutor(threads) as pool:
+        inflight = collections.deque()
+        for chunknum, datasize, segments in pending:
+            tmp, final = _start_chunk(dstdir, chunknum, datasize, chunksize, volume,
+                                      chunknum == dstfirst and dstfirst != 0)
+            target = _Target(tmp, final, len(segments))
+            if not segments:
+                _finish_chunk(target)
+
+            for segment in segments:
+                inflight.append(pool.submit(_copy_segment, target, segment))
+                # bound the chunks being built at once
+                while len(inflight) > threads * 4:
+                    inflight.popleft().result()
+        while inflight:
+            inflight.popleft().result()
+
+    _fsync_dir(dstdir)
+    statepath.unlink()
+    _fsync_dir(dstdir)
+    return len(pending)
+
+def _size(text):
+    # 4096, 64K, 16M, 1G
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='chunkfile-rechunk',
+                                     description='Copy a chunkfile volume to one with another chunk size. '
+                                                 'Run it again to resume after an interruption.')
+    parser.add_argument('source', help='volume directory to copy from')
+    parser.add_argument('dest', help='directory for the new volume')
+    parser.add_argument('chunksize', type=_size, help='new chunk size, header included, e.g. 64M or 4G')
+    parser.add_argument('--threads', type=int, default=RECHUNK_THREADS,
+                        help='ranges copied at once (default: {0})'.format(RECHUNK_THREADS))
+    args = parser.parse_args(argv)
+
+    try:
+        n = rechunk(args.source, args.dest, args.chunksize, args.threads)
+    except (IOError, ValueError, UnsupportedVersionError) as e:
+        sys.stderr.write('chunkfile-rechunk: {0}\n'.format(e))
+        return 1
+    sys.stderr.write('{0} chunks written\n'.format(n))
+    return 0
+
+__all__ = ['rechunk']
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+import bisect, os, struct, zlib
+
+from .ChunkFile import ChunkFile, _fsync_dir
+
+# Each record is stored as a frame: _FRAME, then the record itself. The
+# crc32 covers the length field and the record, so a tail of zeros or a
+# half-written frame left by a crash never passes for a record.
+_FRAME = struct.Struct('<II')      # record length, crc32
+MAXRECORD = 0xffffffff
+
+# The index keeps (record number, offset) for the first record at least
+# INDEX_SPACING bytes past the previous entry, so finding a record reads at
+# most about that much beyond it.
+INDEX_SPACING = 64 * 1024
+INDEXNAME = '.records.idx'
+_ENTRY = struct.Struct('<QQ')
+
+READSIZE = 1024 * 1024
+
+def _frame(record):
+    record = bytes(record)
+    if len(record) > MAXRECORD:
+        raise ValueError('Record too long ({0} bytes)'.format(len(record)))
+
+    length = struct.pack('<I', len(record))
+    return length + struct.pack('<I', zlib.crc32(record, zlib.crc32(length))) + record
+
+class RecordChunkFile(object):
+    # Variable-length records appended to a ChunkFile and fetched by number.
+    #
+    # A sparse index of record numbers to offsets is kept in memory and in
+    # a hidden file in the (first) volume directory. The index may lag the
+    # data; the records after its last entry are found by scanning the
+    # frames when the file is opened, and a lost index is rebuilt the same
+    # way. Scanning stops at the first frame that doesn't check out; when
+    # open for writing, everything from there on is cut off as the remains
+    # of an interrupted append.
+    #
+    # mode is 'rb', 'ab' or 'wb' (optionally with '+'); other keyword
+    # arguments go to ChunkFile.open(). Records in a log volume that
+    # dropped its oldest chunks can no longer be fetched. A volume in a
+    # ChunkStore keeps no index file; it is rebuilt every open.
+
+    def __init__(self, dirpath, mode='ab', **kwargs):
+        if not mode or mode[0] not in 'rwa' or 'b' not in mode:
+            raise ValueError("mode must be 'rb', 'ab' or 'wb', not {0!r}".format(mode))
+
+        self._writable = mode[0] != 'r' or '+' in mode
+        self._cf = ChunkFile.open(dirpath, mode[0] + '+b' if self._writable else 'rb', **kwargs)
+        self._mode = mode
+        # volumes in a ChunkStore have nowhere to keep the index
+        self._idxpath = None if self._cf._store is not None else self._cf._dirpath / INDEXNAME
+
+        # index entries: record numbers and offsets, in step
+        self._idxrec = []
+        self._idxoff = []
+        # entries not yet in the index file; None to rewrite all of it
+        self._unsaved = []
+
+        try:
+            if mode[0] == 'w':
+                self._unsaved = None
+            else:
+                self._load_index()
+
+            self._cf.seek(0, os.SEEK_END)
+            self._end = self._cf.tell()
+            self._recover()
+        except Exception:
+            self._cf.close()
+            raise
+
+    @staticmethod
+    def open(dirpath, mode='ab', **kwargs):
+        return RecordChunkFile(dirpath, mode, **kwargs)
+
+    def _load_index(self):
+        if self._idxpath is None:
+            self._unsaved = None
+            return
+
+        try:
+            with self._idxpath.open('rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._unsaved = None
+            return
+
+        for pos in range(0, len(data) - _ENTRY.size + 1, _ENTRY.size):
+            recno, offset = _ENTRY.unpack_from(data, pos)
+            if self._idxoff and (offset <= self._idxoff[-1] or recno <= self._idxrec[-1]):
+                break
+            self._idxrec.append(recno)
+            self._idxoff.append(offset)
+
+        if len(data) != len(self._idxrec) * _ENTRY.size:
+            self._unsaved = None
+
+    def _add_entry(self, recno, offset):
+        if not self._idxoff or offset - self._idxoff[-1] >= INDEX_SPACING:
+            self._idxrec.append(recno)
+            self._idxoff.append(offset)
+            if self._unsaved is not None:
+                self._unsaved.append((recno, offset))
+
+    def _drop_entries(self, keep):
+        del self._idxrec[keep:]
+        del self._idxoff[keep:]
+        self._unsaved = None
+
+    def _recover(self):
+        # Count the records after the last index entry, indexing them
+        # along the way, and find where the last good frame ends.
+        keep = bisect.bisect_left(self._idxoff, self._end)
+        if keep < len(self._idxoff):
+            self._drop_entries(keep)
+
+        while True:
+            if self._idxrec:
+                recno, offset = self._idxrec[-1], self._idxoff[-1]
+            elif self._cf.start == 0:
+                recno, offset = 0, 0
+            else:
+                raise IOError('Record index of {0} is gone, and the log no longer starts at record 0'.format(self._cf.name))
+
+            pos = offset
+            for frameofs, record in self._frames(offset):
+                self._add_entry(recno, frameofs)
+                recno += 1
+                pos = frameofs + _FRAME.size + len(record)
+
+            # an entry pointing at garbage means the index doesn't belong
+            # to this data; start over without it
+            if pos == offset and pos < self._end and self._idxrec:
+                self._drop_entries(0)
+                continue
+            break
+
+        self._count = recno
+        if pos < self._end:
+            if self._writable:
+                self._cf.truncate(pos)
+            self._end = pos
+
+    def _frames(self, offset):
+        # (offset, record) for each good frame from offset up to the end
+        buf = b''
+        base = offset
+        while offset + _FRAME.size <= self._end:
+            rel = offset - base
+            if len(buf) - rel < _FRAME.size:
+                buf, base, rel = self._read_at(offset, READSIZE), offset, 0
+
+            length, crc = _FRAME.unpack_from(buf, rel)
+            total = _FRAME.size + length
+            if offset + total > self._end:
+                return
+            if len(buf) - rel < total:
+                buf, base, rel = self._read_at(offset, max(READSIZE, total)), offset, 0
+
+            record = buf[rel+_FRAME.size:rel+total]
+            if zlib.crc32(record, zlib.crc32(buf[rel:rel+4])) != crc:
+                return
+
+            yield offset, record
+            offset += total
+
+    def _read_at(self, offset, count):
+        self._cf.seek(offset)
+        return self._cf.read(min(count, self._end - offset))
+
+    def _check_open(self):
+        if self._cf.closed:
+            raise ValueError('I/O operation on closed file')
+
+    def _check_writable(self):
+        self._check_open()
+        if not self._writable:
+            raise IOError('File not open for writing')
+
+    # append(record): add a record; returns its offset in the volume
+    def append(self, record):
+        return self.append_many([record])[0]
+
+    # append_many(records): add several records with a single write to the
+    #     volume; returns their offsets
+    def append_many(self, records):
+        self._check_writable()
+
+        frames = [_frame(record) for record in records]
+        offsets = []
+        pos = self._end
+        for frame in frames:
+            self._add_entry(self._count + len(offsets), pos)
+            offsets.append(pos)
+            pos += len(frame)
+
+        self._cf.seek(self._end)
+        self._cf.write(b''.join(frames))
+        self._end = pos
+        self._count += len(frames)
+        return offsets
+
+    def _trim_index(self):
+        # entries before the start of a log are useless
+        start = self._cf.start
+        if self._idxoff and self._idxoff[0] < start:
+            keep = bisect.bisect_left(self._idxoff, start)
+            del self._idxrec[:keep]
+            del self._idxoff[:keep]
+            self._unsaved = None
+
+    def _scan_from(self, n):
+        self._trim_index()
+        i = bisect.bisect_right(self._idxrec, n) - 1
+        if i < 0:
+            raise IndexError('Record {0} was dropped from the log'.format(n))
+
+        recno = self._idxrec[i]
+        for offset, record in self._frames(self._idxoff[i]):
+            if recno >= n:
+                yield recno, record
+            recno += 1
+
+        if recno < self._count:
+            raise IOError('Record {0} of {1} is corrupt'.format(recno, self._cf.name))
+
+    # get(n): record number n; negative numbers count from the end
+    def get(self, n):
+        self._check_open()
+
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError('Record number out of range')
+
+        for recno, record in self._scan_from(n):
+            return record
+
+    # records([start[, stop]]): iterate over records start up to stop
+    def records(self, start=0, stop=None):
+        self._check_open()
+
+        if stop is None or stop > self._count:
+            stop = self._count
+        if start >= stop:
+            return
+
+        for recno, record in self._scan_from(start):
+            if recno >= stop:
+                return
+            yield record
+
+    def __iter__(self):
+        return self.records()
+
+    def __len__(self):
+        return self._count
+
+    def _save_index(self, durable=False):
+        if not self._writable or self._unsaved == [] or self._idxpath is None:
+            return
+
+        if self._unsaved is None:
+            entries = zip(self._idxrec, self._idxoff)
+            tmp = self._idxpath.parent / (INDEXNAME + '.tmp')
+            with tmp.open('wb') as f:
+                f.write(b''.join(_ENTRY.pack(*entry) for entry in entries))
+                if durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(str(tmp), str(self._idxpath))
+            if durable:
+                _fsync_dir(self._idxpath.parent)
+        else:
+            with self._idxpath.open('ab') as f:
+                f.write(b''.join(_ENTRY.pack(*entry) for entry in self._unsaved))
+                if durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+        self._unsaved = []
+
+    # flush(): write out the records and the index
+    def flush(self):
+        self._check_open()
+        self._cf.flush()
+        self._save_index()
+
+    # sync(): make the records durable, and the index with them
+    def sync(self):
+        self._check_open()
+        self._cf.sync()
+        self._save_index(durable=True)
+
+    def close(self):
+        if not self._cf.closed:
+            try:
+                self._cf.flush()
+                self._save_index()
+            finally:
+                self._cf.close()
+
+    @property
+    def closed(self):
+        return self._cf.closed
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def name(self):
+        return self._cf.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+__all__ = ['RecordChunkFile']
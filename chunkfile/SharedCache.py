@@ -0,0 +1,310 @@
+import hashlib, os, struct, tempfile, threading
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # Python before 3.8
+    resource_tracker = shared_memory = None
+
+from .BlockCache import BLOCKSIZE, CACHESIZE, _caches
+from .ChunkFile import _lock_range, _unlock_range, fcntl
+
+# A block cache every process on the host can attach to, held in one
+# multiprocessing.shared_memory segment, so hot data is cached once per host
+# instead of once per process.
+#
+# The segment holds a table of generation counters and a set-associative
+# table of fixed-size blocks. Blocks are keyed by (volume, chunk, block);
+# a chunk's key hashes to one generation counter, which every write,
+# truncate and erase of the chunk bumps. A block is only good while the
+# counter still reads what it did before the block was read from disk.
+#
+# Lookups take no locks. Each slot carries a sequence number that is odd
+# while the slot is being filled; a reader copies the block out and only
+# keeps it if the number was even and hasn't moved. Filling slots and
+# bumping counters take one of NSTRIPES fcntl locks on a lock file, by hash,
+# plus a thread lock for threads of the same process.
+#
+# Invalidation only reaches processes that have the cache attached: every
+# process writing to cached volumes must attach it too, even if it never
+# reads through it.
+
+MAGIC = b'CFSHMC01'
+WAYS = 4
+NGENERATIONS = 4096
+NSTRIPES = 64
+
+# magic, blocksize, sets, ways, generation counters
+_HEADER = struct.Struct('<8sQQQQ')
+_HEADERSPACE = 64
+_GEN = struct.Struct('<Q')
+# sequence, volume hash (0 when empty), chunknum, block index, generation,
+# data length, recently used
+_SLOT = struct.Struct('<QQqqQQQ')
+# the last field alone, which readers set without a lock
+_USED = struct.Struct('<Q')
+_USEDOFFSET = _SLOT.size - _USED.size
+
+def _align(n, to=4096):
+    return (n + to - 1) // to * to
+
+def _attach_segment(name):
+    # Attach without the resource tracker, which would unlink the segment
+    # when this process exits
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+class SharedBlockCache(object):
+    # Cross-process counterpart of BlockCache, usable anywhere one is, such
+    # as ChunkFile.open(..., cache=SharedBlockCache.attach()) or through
+    # BlockCache.set_default(). Volumes are keyed by real path, the same in
+    # every process.
+    #
+    # The segment called *name* is created with room for *capacity* bytes in
+    # blocks of *blocksize* if it doesn't exist yet; otherwise its own sizes
+    # are used. It outlives the processes using it until unlink().
+
+    crossprocess = True
+
+    _attached = {}
+    _attached_lock = threading.Lock()
+
+    def __init__(self, name='chunkfile-cache', blocksize=BLOCKSIZE, capacity=CACHESIZE):
+        if shared_memory is None:
+            raise NotImplementedError('the shared block cache needs multiprocessing.shared_memory, new in Python 3.8')
+        if fcntl is None:
+            raise NotImplementedError('the shared block cache needs fcntl locks, which this platform lacks')
+        if blocksize <= 0:
+            raise ValueError('blocksize must be positive')
+        if capacity < blocksize:
+            raise ValueError('capacity must hold at least one block')
+
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        lockpath = os.path.join(tempfile.gettempdir(), '{0}.lock'.format(name))
+        self._lockpath = lockpath
+        self._lockfd = os.open(lockpath, os.O_RDWR | os.O_CREAT, 0o666)
+        self._locks = [threading.Lock() for _ in range(2 * NSTRIPES)]
+        self._volhashes = {}
+
+        try:
+            self._shm = self._open(name, blocksize, capacity)
+        except BaseException:
+            os.close(self._lockfd)
+            raise
+        self._buf = self._shm.buf
+
+        magic, self.blocksize, self._nsets, self._ways, self._ngens = _HEADER.unpack_from(self._buf, 0)
+        self.capacity = self.blocksize * self._nsets * self._ways
+        self._gens = _HEADERSPACE
+        self._slots = self._gens + _GEN.size * self._ngens
+        self._data = _align(self._slots + _SLOT.size * self._nsets * self._ways)
+
+        _caches.add(self)
+
+    def _open(self, name, blocksize, capacity):
+        nsets = max(1, capacity // blocksize // WAYS)
+        size = _align(_align(_HEADERSPACE + _GEN.size * NGENERATIONS + _SLOT.size * nsets * WAYS)
+                      + blocksize * nsets * WAYS)
+
+        # The creator fills in the header under the first lock, magic last;
+        # anyone attaching meanwhile waits for it
+        self._lock(0)
+        try:
+            try:
+                shm = shared_memory.SharedMemory(name, create=True, size=size)
+                try:
+                    resource_tracker.unregister(shm._name, 'shared_memory')
+                except Exception:
+                    pass
+                _HEADER.pack_into(shm.buf, 0, b'\0' * 8, blocksize, nsets, WAYS, NGENERATIONS)
+                shm.buf[:8] = MAGIC
+                return shm
+            except FileExistsError:
+                shm = _attach_segment(name)
+        finally:
+            self._unlock(0)
+
+        if bytes(shm.buf[:8]) != MAGIC:
+            shm.close()
+            raise IOError('shared memory segment {0} is not a chunkfile cache'.format(name))
+        return shm
+
+    @classmethod
+    def attach(cls, name='chunkfile-cache', blocksize=BLOCKSIZE, capacity=CACHESIZE):
+        # The process's one SharedBlockCache for the segment *name*
+        with cls._attached_lock:
+            cache = cls._attached.get(name)
+            if cache is None or cache._shm is None:
+                cache = cls._attached[name] = cls(name, blocksize, capacity)
+            return cache
+
+    def _lock(self, stripe):
+        self._locks[stripe].acquire()
+        try:
+            _lock_range(self._lockfd, True, stripe, 1)
+        except BaseException:
+            self._locks[stripe].release()
+            raise
+
+    def _unlock(self, stripe):
+        _unlock_range(self._lockfd, stripe, 1)
+        self._locks[stripe].release()
+
+    def _volhash(self, volume):
+        h = self._volhashes.get(volume)
+        if h is None:
+            digest = hashlib.blake2b(volume.encode('utf-8', 'surrogateescape'), digest_size=8).digest()
+            # never 0, which marks an empty slot
+            h = self._volhashes[volume] = struct.unpack('<Q', digest)[0] | 1
+        return h
+
+    def _gen_offset(self, volhash, chunknum):
+        # Small ints and tuples of them hash the same in every process
+        return self._gens + _GEN.size * (hash((volhash, chunknum)) % self._ngens)
+
+    def _set_of(self, volhash, chunknum, block):
+        return hash((volhash, chunknum, block)) % self._nsets
+
+    def epoch(self, key):
+        volume, chunknum = key[:2]
+        return _GEN.unpack_from(self._buf, self._gen_offset(self._volhash(volume), chunknum))[0]
+
+    def get(self, key):
+        volume, chunknum, block = key
+        volhash = self._volhash(volume)
+        gen = _GEN.unpack_from(self._buf, self._gen_offset(volhash, chunknum))[0]
+
+        first = self._set_of(volhash, chunknum, block) * self._ways
+        for slot in range(first, first + self._ways):
+            pos = self._slots + _SLOT.size * slot
+            seq, h, c, b, g, length, used = _SLOT.unpack_from(self._buf, pos)
+            if seq & 1 or h != volhash or c != chunknum or b != block or g != gen:
+                continue
+
+            start = self._data + self.blocksize * slot
+            data = bytes(self._buf[start:start + length])
+            if _SLOT.unpack_from(self._buf, pos)[0] != seq:
+                # refilled under us
+                break
+
+            if not used:
+                _USED.pack_into(self._buf, pos + _USEDOFFSET, 1)
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        return None
+
+    def put(self, key, data, epoch):
+        volume, chunknum, block = key
+        volhash = self._volhash(volume)
+        genpos = self._gen_offset(volhash, chunknum)
+        setnum = self._set_of(volhash, chunknum, block)
+        first = setnum * self._ways
+        data = data[:self.blocksize]
+
+        stripe = setnum % NSTRIPES
+        self._lock(stripe)
+        try:
+            if _GEN.unpack_from(self._buf, genpos)[0] != epoch:
+                return
+
+            # A slot holding this block, or an empty one, or else the first
+            # not used since the hand passed it (second chance)
+            victim = None
+            slots = [(slot, _SLOT.unpack_from(self._buf, self._slots + _SLOT.size * slot))
+                     for slot in range(first, first + self._ways)]
+            for slot, fields in slots:
+                if fields[1:4] == (volhash, chunknum, block) or not fields[1]:
+                    victim = slot
+                    break
+            if victim is None:
+                for slot, fields in slots:
+                    if not fields[6]:
+                        victim = slot
+                        break
+                    _USED.pack_into(self._buf, self._slots + _SLOT.size * slot + _USEDOFFSET, 0)
+                if victim is None:
+                    victim = first
+                self.evictions += 1
+
+            pos = self._slots + _SLOT.size * victim
+            seq = _SLOT.unpack_from(self._buf, pos)[0]
+            _SLOT.pack_into(self._buf, pos, seq + 1, 0, 0, 0, 0, 0, 0)
+            start = self._data + self.blocksize * victim
+            self._buf[start:start + len(data)] = data
+            _SLOT.pack_into(self._buf, pos, seq + 2, volhash, chunknum, block, epoch, len(data), 0)
+        finally:
+            self._unlock(stripe)
+
+    def invalidate(self, volume, chunknum, offset=0, length=None):
+        # Every block of the chunk goes, whatever the range
+        genpos = self._gen_offset(self._volhash(volume), chunknum)
+        stripe = NSTRIPES + (genpos // _GEN.size) % NSTRIPES
+        self._lock(stripe)
+        try:
+            _GEN.pack_into(self._buf, genpos, _GEN.unpack_from(self._buf, genpos)[0] + 1)
+        finally:
+            self._unlock(stripe)
+
+    def clear(self):
+        for stripe in range(NSTRIPES):
+            self._lock(stripe)
+            try:
+                for setnum in range(stripe, self._nsets, NSTRIPES):
+                    for slot in range(setnum * self._ways, (setnum + 1) * self._ways):
+                        pos = self._slots + _SLOT.size * slot
+                        seq = _SLOT.unpack_from(self._buf, pos)[0]
+                        _SLOT.pack_into(self._buf, pos, seq + 2, 0, 0, 0, 0, 0, 0)
+            finally:
+                self._unlock(stripe)
+
+    def stats(self):
+        # hits, misses and evictions are this process's; bytes is what the
+        # segment holds, stale blocks included
+        nbytes = 0
+        for slot in range(self._nsets * self._ways):
+            fields = _SLOT.unpack_from(self._buf, self._slots + _SLOT.size * slot)
+            if fields[1]:
+                nbytes += fields[5]
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': nbytes,
+                'capacity': self.capacity,
+                'blocksize': self.blocksize}
+
+    def close(self):
+        # Detach this process; the segment stays for the others
+        if self._shm is None:
+            return
+        _caches.discard(self)
+        self._buf = None
+        self._shm.close()
+        self._shm = None
+        os.close(self._lockfd)
+
+    def unlink(self):
+        # Remove the segment and its lock file. Processes still attached keep
+        # theirs until they close it.
+        try:
+            # tracked, as unlink() untracks it
+            shm = shared_memory.SharedMemory(self.name)
+        except FileNotFoundError:
+            pass
+        else:
+            shm.close()
+            shm.unlink()
+        try:
+            os.unlink(self._lockpath)
+        except FileNotFoundError:
+            pass
+
+__all__ = ['SharedBlockCache']
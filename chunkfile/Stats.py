@@ -0,0 +1,126 @@
+import threading, time
+
+# I/O metrics for ChunkFiles opened with metrics=True (or after
+# enable_metrics()). Each volume counts into a Stats of its own; the process
+# total is every open volume's Stats plus those of volumes already closed.
+#
+# Updates are plain attribute increments on slotted objects, with no locks
+# and no allocation, so metrics can stay on in production. Chunks worked on
+# in parallel (parallelism=) may now and then lose an increment to a race.
+
+# Latencies are in nanoseconds, in buckets by bit length: bucket i holds
+# latencies below 2**i and at least 2**(i-1). The last bucket, from about
+# 39 hours, takes everything longer.
+NBUCKETS = 48
+
+# operations timed by ChunkFile, each with a histogram
+OPERATIONS = ('read', 'write', 'seek', 'truncate', 'flush', 'sync')
+
+COUNTERS = ('reads', 'writes', 'seeks', 'truncates', 'flushes', 'syncs',
+            'chunk_opens', 'chunk_creates', 'chunk_erases',
+            'bytes_read', 'bytes_written', 'boundary_crossings',
+            'cache_hits', 'cache_misses')
+
+try:
+    now = time.perf_counter_ns
+except AttributeError:
+    # Python before 3.7
+    def now():
+        return int(time.perf_counter() * 1000000000)
+
+class LatencyHistogram(object):
+    __slots__ = ('count', 'total_ns', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.buckets = [0] * NBUCKETS
+
+    def record(self, ns):
+        self.count += 1
+        self.total_ns += ns
+        self.buckets[min(ns.bit_length(), NBUCKETS - 1)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_ns += other.total_ns
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+
+    def percentile(self, p):
+        # Upper bound, in ns, of the bucket holding the p-th percentile
+        # (0 < p <= 100); None with nothing recorded
+        if not self.count:
+            return None
+        wanted = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= wanted:
+                return 2 ** i
+        return 2 ** (NBUCKETS - 1)
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total_ns': self.total_ns,
+                # upper bound in ns -> count, for buckets in use
+                'buckets': dict((2 ** i, n) for i, n in enumerate(self.buckets) if n),
+                'p50_ns': self.percentile(50),
+                'p99_ns': self.percentile(99)}
+
+class Stats(object):
+    __slots__ = COUNTERS + tuple(op + '_latency' for op in OPERATIONS)
+
+    def __init__(self):
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        for op in OPERATIONS:
+            setattr(self, op + '_latency', LatencyHistogram())
+
+    def merge(self, other):
+        for name in COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for op in OPERATIONS:
+            getattr(self, op + '_latency').merge(getattr(other, op + '_latency'))
+
+    def as_dict(self):
+        d = dict((name, getattr(self, name)) for name in COUNTERS)
+        d['latency'] = dict((op, getattr(self, op + '_latency').as_dict()) for op in OPERATIONS)
+        return d
+
+_lock = threading.Lock()
+# Stats of open volumes, and the sum of those of closed ones
+_live = set()
+_retired = Stats()
+_enabled = False
+
+def enable_metrics(enabled=True):
+    # Collect metrics for volumes opened from now on without metrics=
+    global _enabled
+    _enabled = enabled
+
+def metrics_enabled():
+    return _enabled
+
+def register(stats):
+    with _lock:
+        _live.add(stats)
+
+def retire(stats):
+    # a volume is done with stats: fold them into the total
+    with _lock:
+        if stats in _live:
+            _live.discard(stats)
+            _retired.merge(stats)
+
+def process_stats():
+    # Metrics summed over every volume in the process that collected them,
+    # open or closed, as for ChunkFile.stats()
+    with _lock:
+        total = Stats()
+        total.merge(_retired)
+        for stats in _live:
+            total.merge(stats)
+    return total.as_dict()
+
+__all__ = ['Stats', 'LatencyHistogram', 'enable_metrics', 'metrics_enabled', 'process_stats']
@@ -0,0 +1,114 @@
+import collections, contextlib, json, os, threading
+
+from .Stats import now
+
+# Tracing: hooks installed here are called with a TraceEvent for every
+# ChunkFile read, write and truncate, and for every read, write, truncate,
+# open, create and erase of the chunks under them. Hooks run inline, on the
+# thread that did the operation, after it returns; keep them quick.
+#
+# hooks is replaced whole on every change, never modified, so the I/O
+# paths can test it and walk it without a lock. With no hooks installed a
+# traced operation costs one look at it.
+hooks = ()
+_lock = threading.Lock()
+
+class TraceEvent(object):
+    # op is 'ChunkFile.read', 'Chunk.write' and so on. path is the volume's
+    # name for ChunkFile operations, with chunknum None, or the chunk's
+    # path. Times are time.perf_counter_ns() nanoseconds.
+    __slots__ = ('op', 'path', 'chunknum', 'offset', 'length', 'start_ns', 'duration_ns', 'thread')
+
+    def __init__(self, op, path, chunknum, offset, length, start_ns, duration_ns, thread):
+        self.op = op
+        self.path = path
+        self.chunknum = chunknum
+        self.offset = offset
+        self.length = length
+        self.start_ns = start_ns
+        self.duration_ns = duration_ns
+        self.thread = thread
+
+    def __repr__(self):
+        return 'TraceEvent({0!r}, {1!r}, chunknum={2}, offset={3}, length={4}, duration_ns={5})'.format(
+            self.op, self.path, self.chunknum, self.offset, self.length, self.duration_ns)
+
+def add_trace_hook(hook):
+    global hooks
+    with _lock:
+        hooks = hooks + (hook,)
+
+def remove_trace_hook(hook):
+    global hooks
+    with _lock:
+        i = hooks.index(hook)
+        hooks = hooks[:i] + hooks[i+1:]
+
+@contextlib.contextmanager
+def tracing(hook):
+    # with tracing(hook): ... -- hook gets the events of the block (and of
+    # anything other threads do meanwhile)
+    add_trace_hook(hook)
+    try:
+        yield hook
+    finally:
+        remove_trace_hook(hook)
+
+def emit(traced, op, path, chunknum, offset, length, start_ns):
+    # Called by the I/O paths with the hooks they saw at the start
+    end = now()
+    event = TraceEvent(op, str(path), chunknum, offset, length, start_ns, end - start_ns,
+                       threading.get_ident())
+    for hook in traced:
+        hook(event)
+
+class TraceRecorder(object):
+    # Hook keeping the events of operations taking at least threshold_ns
+    # (all of them by default), the most recent *maxevents* of them.
+    # Others are only counted.
+
+    def __init__(self, threshold_ns=0, maxevents=100000):
+        self.threshold_ns = threshold_ns
+        self.events = collections.deque(maxlen=maxevents)
+        self.seen = 0
+
+    def __call__(self, event):
+        self.seen += 1
+        if event.duration_ns >= self.threshold_ns:
+            self.events.append(event)
+
+    def write_chrome_trace(self, f):
+        write_chrome_trace(self.events, f)
+
+class SlowOpSampler(TraceRecorder):
+    # TraceRecorder for the slow operations only: threshold in milliseconds
+    def __init__(self, threshold_ms, maxevents=10000):
+        super(SlowOpSampler, self).__init__(int(threshold_ms * 1000000), maxevents)
+
+def write_chrome_trace(events, f):
+    # Write events in the Chrome trace event format, for chrome://tracing,
+    # Perfetto and the like. f is a path or a text file.
+    if isinstance(f, (str, os.PathLike)):
+        with open(str(f), 'w') as out:
+            write_chrome_trace(events, out)
+        return
+
+    pid = os.getpid()
+    trace = []
+    for event in events:
+        args = {'path': event.path, 'offset': event.offset, 'length': event.length}
+        if event.chunknum is not None:
+            args['chunknum'] = event.chunknum
+        trace.append({'name': event.op,
+                      'cat': event.op.split('.')[0],
+                      'ph': 'X',
+                      'ts': event.start_ns / 1000.0,
+                      'dur': event.duration_ns / 1000.0,
+                      'pid': pid,
+                      'tid': event.thread,
+                      'args': args})
+
+    json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+__all__ = ['TraceEvent', 'TraceRecorder', 'SlowOpSampler', 'add_trace_hook', 'remove_trace_hook',
+           'tracing', 'write_chrome_trace']
@@ -0,0 +1,178 @@
+import asyncio, ctypes, ctypes.util, errno, os, select, struct, time
+
+# Waiting for a volume to change, for ChunkFile.follow(): inotify on Linux,
+# through ctypes, and polling with a backoff anywhere else. wait() returns
+# what may have changed: FILE (the watched tail chunk), DIRS (a chunk was
+# created, removed or renamed), or POLL (anything; go and look), or None
+# once the timeout passed.
+
+FILE = 'file'
+DIRS = 'dirs'
+POLL = 'poll'
+
+# polling backs off from the first interval to the last while nothing changes
+POLL_MIN = 0.001
+POLL_MAX = 0.05
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+def _inotify():
+    # libc, if it has inotify; else None
+    global _libc
+    if _libc is None:
+        _libc = False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1
+            libc.inotify_add_watch
+            libc.inotify_rm_watch
+            _libc = libc
+        except (OSError, AttributeError):
+            pass
+    return _libc or None
+
+class InotifyWatcher(object):
+    def __init__(self, dirpaths):
+        libc = _inotify()
+        if libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        try:
+            self._dirwds = set(self._add(d, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+                               for d in dirpaths)
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._filewd = None
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+
+    def _add(self, path, mask):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(str(path)), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), str(path))
+        return wd
+
+    def watch_file(self, path):
+        # Watch path, instead of the file watched so far
+        if self._filewd is not None and self._filewd not in self._dirwds:
+            self._libc.inotify_rm_watch(self._fd, self._filewd)
+        self._filewd = None
+        if path is not None:
+            try:
+                self._filewd = self._add(path, IN_MODIFY | IN_CLOSE_WRITE | IN_DELETE_SELF)
+            except FileNotFoundError:
+                # gone already; the directory watch tells what replaced it
+                pass
+
+    def _drain(self):
+        kinds = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return kinds
+            pos = 0
+            while pos + _EVENT.size <= len(buf):
+                wd, mask, cookie, namelen = _EVENT.unpack_from(buf, pos)
+                pos += _EVENT.size + namelen
+                if wd in self._dirwds:
+                    kinds.add(DIRS)
+                elif not mask & IN_IGNORED:
+                    kinds.add(FILE)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            left = None if deadline is None else max(0, deadline - time.monotonic())
+            if not self._poll.poll(None if left is None else left * 1000):
+                return None
+            kinds = self._drain()
+            if kinds:
+                return kinds
+
+    async def wait_async(self, timeout=None):
+        # the running loop; get_running_loop() is new in Python 3.7
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            kinds = self._drain()
+            if kinds:
+                return kinds
+
+            ready = loop.create_future()
+            loop.add_reader(self._fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                left = None if deadline is None else max(0, deadline - loop.time())
+                await asyncio.wait_for(ready, left)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                loop.remove_reader(self._fd)
+
+    def data_seen(self):
+        pass
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class PollWatcher(object):
+    def __init__(self, dirpaths=None):
+        self._interval = POLL_MIN
+
+    def watch_file(self, path):
+        pass
+
+    def _next_interval(self, timeout):
+        interval = self._interval
+        self._interval = min(POLL_MAX, self._interval * 2)
+        return interval if timeout is None else min(interval, timeout)
+
+    def wait(self, timeout=None):
+        if timeout is not None and timeout <= 0:
+            return None
+        time.sleep(self._next_interval(timeout))
+        return set([POLL])
+
+    async def wait_async(self, timeout=None):
+        if timeout is not None and timeout <= 0:
+            return None
+        await asyncio.sleep(self._next_interval(timeout))
+        return set([POLL])
+
+    def data_seen(self):
+        # something arrived: look again soon
+        self._interval = POLL_MIN
+
+    def close(self):
+        pass
+
+def watcher(dirpaths, poll=False):
+    # InotifyWatcher on the directories where possible, else a PollWatcher
+    if not poll and _inotify() is not None:
+        try:
+            return InotifyWatcher(dirpaths)
+        except OSError:
+            pass
+    return PollWatcher(dirpaths)
@@ -1 +1,14 @@
 from .ChunkFile import *
+from .BlockCache import *
+from .CompressedChunk import *
+from .ChecksummedChunk import *
+from .DedupChunk import *
+from .MerkleTree import *
+from .ChunkStore import *
+from .ObjectStore import *
+from .RecordChunkFile import *
+from .Rechunk import *
+from .Copy import *
+from .Stats import *
+from .Trace import *
+from .SharedCache import *
@@ -17,18 +17,19 @@ setup(
 		'Intended Audience :: Developers',
 		'License :: Free for non-commercial use',
 		'Operating System :: POSIX :: Linux',
-		'Programming Language :: Python :: 2.6',
-		'Programming Language :: Python :: 2.7',
-		'Programming Language :: Python :: 3.3',
-		'Programming Language :: Python :: 3.4',
-		'Programming Language :: Python :: 3.5',
+		'Programming Language :: Python :: 3',
+		'Programming Language :: Python :: 3 :: Only',
 		'Programming Language :: Python :: 3.6',
 		'Topic :: Software Development :: Libraries',
 		'Topic :: System :: Filesystems',
 	],
 	keywords='chunk file filesystem',
 	packages=['chunkfile'],
-	install_requires=['pathlib'],
+	python_requires='>=3.6',
+	install_requires=[],
 	extras_require={},
 	package_data={},
+	entry_points={
+		'console_scripts': ['chunkfile-rechunk = chunkfile.Rechunk:main'],
+	},
 )
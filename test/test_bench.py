@@ -0,0 +1,36 @@
+import io, json, shutil, tempfile, unittest
+from pathlib import Path
+
+import bench
+from chunkfile import *
+
+class TestBench(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testSmallRun(self):
+        report = bench.run(self.tmpdir, chunksize=HEADERSIZE + 64 * 1024, size=256 * 1024, repeat=1,
+                           only=['open', 'boundary', 'truncate'])
+
+        names = set(result['name'] for result in report['results'])
+        self.assertEqual(names, set(['open', 'boundary_read', 'truncate']))
+        opens = [result['params']['chunks'] for result in report['results'] if result['name'] == 'open']
+        self.assertEqual(opens, [1, 4])
+
+        out = io.StringIO()
+        bench.dump(report, out)
+        self.assertEqual(json.loads(out.getvalue())['chunksize'], HEADERSIZE + 64 * 1024)
+
+        # scratch space is cleaned up, and the chunk size put back
+        self.assertEqual(list(self.tmpdir.iterdir()), [])
+        f = ChunkFile.open(self.tmpdir / 'vol', 'wb')
+        f.truncate(64 * 1024 + 1)
+        self.assertEqual(len(f._chunks), 1)
+        f.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class TestBlockCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.cache = BlockCache(blocksize=4096, capacity=4096 * 64)
+
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(bytes(bytearray(range(256))) * 64)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def read(self, offset, n):
+        f = ChunkFile.open(self.tmpdir, 'rb', cache=self.cache)
+        f.seek(offset)
+        data = f.read(n)
+        f.close()
+        return data
+
+    def testSharedAcrossInstances(self):
+        data = self.read(100, 5000)
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(self.cache.hits, 0)
+
+        self.assertEqual(self.read(100, 5000), data)
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(self.cache.hits, 2)
+
+        self.assertEqual(data, (bytes(bytearray(range(256))) * 64)[100:5100])
+
+    def testWriteInvalidates(self):
+        self.read(0, 10)
+
+        f = ChunkFile.open(self.tmpdir, 'r+b')
+        f.seek(5)
+        f.write(b'XYZ')
+        f.close()
+
+        self.assertEqual(self.read(0, 10), b'\x00\x01\x02\x03\x04XYZ\x08\x09')
+        self.assertEqual(self.cache.hits, 0)
+
+    def testWriteOtherBlockKeepsCached(self):
+        self.read(0, 10)
+
+        f = ChunkFile.open(self.tmpdir, 'r+b')
+        f.seek(8192)
+        f.write(b'XYZ')
+        f.close()
+
+        self.read(0, 10)
+        self.assertEqual(self.cache.hits, 1)
+
+    def testTruncateInvalidates(self):
+        self.read(0, 10)
+
+        f = ChunkFile.open(self.tmpdir, 'r+b')
+        f.truncate(3)
+        f.close()
+
+        self.assertEqual(self.read(0, 10), b'\x00\x01\x02')
+
+    def testEraseInvalidates(self):
+        self.read(0, 10)
+
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.close()
+
+        self.assertEqual(self.read(0, 10), b'')
+
+    def testShortBlockExtended(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(b'abc')
+        f.close()
+
+        self.assertEqual(self.read(0, 10), b'abc')
+
+        # lands in a later block, but zero-fills the cached one
+        f = ChunkFile.open(self.tmpdir, 'r+b')
+        f.seek(10000)
+        f.write(b'x')
+        f.close()
+
+        self.assertEqual(self.read(0, 10), b'abc' + b'\x00' * 7)
+
+    def testReadPastEndKeepsShortBlock(self):
+        cache = BlockCache(blocksize=4096, capacity=4096 * 4096)
+        with ChunkFile.open(self.tmpdir, 'w+b', cache=cache) as f:
+            f.write(b'a' * 100)
+            f.seek(0)
+            self.assertEqual(f.read(100), b'a' * 100)
+            f.seek(300000)
+            self.assertEqual(f.read(10), b'')
+
+            # extends the chunk past the short block read first
+            f.seek(200000)
+            f.write(b'b' * 10)
+            f.seek(0)
+            self.assertEqual(f.read(300000), b'a' * 100 + bytes(199900) + b'b' * 10)
+
+    def testLargeReadBypasses(self):
+        self.read(0, 4096 * 16)
+        self.assertEqual(self.cache.misses, 0)
+        self.assertEqual(self.cache.hits, 0)
+
+    def testLRUEviction(self):
+        cache = BlockCache(blocksize=10, capacity=30)
+        for i in range(4):
+            cache.put(('v', 0, i), b'x' * 10, cache.epoch())
+
+        self.assertIsNone(cache.get(('v', 0, 0)))
+        self.assertIsNotNone(cache.get(('v', 0, 3)))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['bytes'], 30)
+
+    def testARCKeepsFrequent(self):
+        cache = BlockCache(blocksize=10, capacity=40, policy='arc')
+        hot = ('v', 0, 'hot')
+        cache.put(hot, b'h' * 10, cache.epoch())
+        cache.get(hot)
+
+        # a one-pass scan shouldn't push out a block used twice
+        for i in range(20):
+            cache.put(('v', 1, i), b's' * 10, cache.epoch())
+
+        self.assertEqual(cache.get(hot), b'h' * 10)
+        self.assertLessEqual(cache.stats()['bytes'], 40)
+
+    def testStaleFillRefused(self):
+        cache = BlockCache(blocksize=10, capacity=100)
+        epoch = cache.epoch()
+        cache.invalidate('v', 0)
+        cache.put(('v', 0, 0), b'old', epoch)
+        self.assertIsNone(cache.get(('v', 0, 0)))
+
+    def testBadPolicy(self):
+        self.assertRaises(ValueError, BlockCache, policy='fifo')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class TestChecksummedChunks(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.voldir = self.tmpdir / 'vol'
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def corrupt(self, chunknum, offset, dirpath=None):
+        path = (dirpath or self.voldir) / 'chunk.{0:0>11d}.dat'.format(chunknum)
+        with path.open('r+b') as f:
+            f.seek(HEADERSIZE + offset)
+            byte = f.read(1)
+            f.seek(HEADERSIZE + offset)
+            f.write(bytes([byte[0] ^ 0xff]))
+
+    def testRoundTrip(self):
+        data = os.urandom(10000)
+        f = ChunkFile.open(self.voldir, 'wb', checksum='crc32', checksum_blocksize=1024)
+        f.write(data)
+        f.seek(500)
+        f.write(b'x' * 2000)
+        f.close()
+
+        expected = data[:500] + b'x' * 2000 + data[2500:]
+        f = ChunkFile.open(self.voldir, 'rb', verify_reads=True)
+        self.assertEqual(f.read(), expected)
+        self.assertEqual(f.verify(parallelism=1), [])
+        f.close()
+
+        self.assertTrue((self.voldir / '.chunk.00000000000.dat.sum').exists())
+
+    def testVerifyFindsCorruption(self):
+        f = ChunkFile.open(self.voldir, 'wb', checksum='crc32', checksum_blocksize=1024)
+        f.write(os.urandom(10000))
+        f.close()
+
+        self.corrupt(0, 3000)
+        self.corrupt(0, 4000)
+        self.corrupt(0, 9999)
+
+        f = ChunkFile.open(self.voldir, 'rb')
+        self.assertEqual(f.verify(parallelism=1), [(2048, 4096), (9216, 10000)])
+
+        # unverified reads still return the (bad) data
+        f.seek(0)
+        self.assertEqual(len(f.read()), 10000)
+        f.close()
+
+    def testVerifyReads(self):
+        f = ChunkFile.open(self.voldir, 'wb', checksum='crc32', checksum_blocksize=1024)
+        f.write(os.urandom(10000))
+        f.close()
+
+        self.corrupt(0, 5000)
+
+        f = ChunkFile.open(self.voldir, 'rb', verify_reads=True)
+        self.assertEqual(len(f.read(4096)), 4096)
+        self.assertRaises(ChecksumError, f.read, 10)
+
+        f.seek(4096)
+        buf = bytearray(100)
+        self.assertRaises(ChecksumError, f.readinto, buf)
+        f.close()
+
+    def testTruncateAndExtend(self):
+        f = ChunkFile.open(self.voldir, 'w+b', checksum='crc32', checksum_blocksize=1024)
+        f.write(b'a' * 5000)
+        f.truncate(1500)
+        f.truncate(4000)
+        f.seek(7000)
+        f.write(b'b' * 10)
+        self.assertEqual(f.verify(parallelism=1), [])
+
+        f.seek(0)
+        self.assertEqual(f.read(), b'a' * 1500 + bytes(5500) + b'b' * 10)
+        f.close()
+
+    def testVerifyAcrossChunksInParallel(self):
+        f = ChunkFile.open(self.voldir, 'wb', checksum='crc32')
+        f.seek(CHUNKDATASIZE * 2 + 100)
+        f.write(b'end')
+        f.seek(CHUNKDATASIZE - 3)
+        f.write(b'spans')
+        f.close()
+
+        self.corrupt(1, 0)
+
+        f = ChunkFile.open(self.voldir, 'rb')
+        bad = f.verify(parallelism=2)
+        self.assertEqual(bad, [(CHUNKDATASIZE, CHUNKDATASIZE + CHECKSUM_BLOCKSIZE)])
+        f.close()
+
+    def testCompressedChunksVerify(self):
+        f = ChunkFile.open(self.voldir, 'wb', compression='zlib', compress_blocksize=1024)
+        f.write(os.urandom(3000))
+        f.close()
+
+        self.assertEqual(ChunkFile.open(self.voldir, 'rb').verify(parallelism=1), [])
+
+    def testMoveCarriesSums(self):
+        slowdir = self.tmpdir / 'slow'
+        f = ChunkFile.open(self.voldir, 'wb', checksum='crc32', slow_tier=slowdir)
+        f.seek(CHUNKDATASIZE)
+        f.write(b'tail')
+        self.assertEqual(f.migrate(), 1)
+        self.assertEqual(f.verify(parallelism=1), [])
+        f.close()
+
+        self.assertTrue((slowdir / '.chunk.00000000000.dat.sum').exists())
+        self.assertFalse((self.voldir / '.chunk.00000000000.dat.sum').exists())
+
+    def testOptions(self):
+        self.assertRaises(ValueError, ChunkFile.open, self.voldir, 'wb', checksum='md5')
+        self.assertRaises(ValueError, ChunkFile.open, self.voldir, 'wb', checksum='crc32', compression='zlib')
+
+if __name__ == '__main__':
+    unittest.main()
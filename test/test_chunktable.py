@@ -0,0 +1,80 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class TestChunkTable(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def chunknums(self):
+        return sorted(int(p.name[6:17]) for p in self.tmpdir.glob('chunk.*.dat'))
+
+    def testChunksAreMadeOnUse(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.truncate(CHUNKDATASIZE * 5 + 10)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(len(f._chunks), 6)
+        self.assertEqual(sorted(f._chunks._loaded), [0])
+
+        f.seek(0, os.SEEK_END)
+        self.assertEqual(f.tell(), CHUNKDATASIZE * 5 + 10)
+        f.seek(CHUNKDATASIZE * 3)
+        self.assertEqual(f.read(4), bytes(4))
+        self.assertEqual(sorted(f._chunks._loaded), [0, 3, 5])
+        f.close()
+
+    def testSlots(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(b'x')
+        chunk = f._chunks[0]
+        self.assertFalse(hasattr(chunk, '__dict__'))
+        self.assertFalse(hasattr(chunk._header, '__dict__'))
+        f.close()
+
+    def testWrongChunkInFile(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.truncate(CHUNKDATASIZE + 10)
+        f.close()
+
+        # chunk 1's file holds another chunk 0
+        (self.tmpdir / 'chunk.00000000001.dat').unlink()
+        with (self.tmpdir / 'chunk.00000000000.dat').open('rb') as src:
+            with (self.tmpdir / 'chunk.00000000001.dat').open('wb') as dst:
+                dst.write(src.read(HEADERSIZE))
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        f.seek(CHUNKDATASIZE)
+        self.assertRaises(IOError, f.read, 1)
+        f.close()
+
+    def testInterruptedDrop(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', retain_chunks=4)
+        f.truncate(CHUNKDATASIZE * 3 + 10)
+        f.close()
+
+        # as if a drop of chunks 0 and 1 stopped after erasing chunk 1
+        f = ChunkFile.open(self.tmpdir, 'r+b')
+        f._chunks[2].update_header(logstart='1')
+        f._chunks[0].update_header(dropto='2')
+        f.close()
+        (self.tmpdir / 'chunk.00000000001.dat').unlink()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.start, CHUNKDATASIZE * 2)
+        f.seek(0, os.SEEK_END)
+        self.assertEqual(f.tell(), CHUNKDATASIZE * 3 + 10)
+        f.close()
+        self.assertEqual(self.chunknums(), [0, 2, 3])
+
+        ChunkFile.open(self.tmpdir, 'ab').close()
+        self.assertEqual(self.chunknums(), [2, 3])
+
+if __name__ == '__main__':
+    unittest.main()
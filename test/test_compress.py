@@ -0,0 +1,163 @@
+import os, random, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+from chunkfile.ChunkFile import ChunkFileHeader, FLAG_COMPRESSED
+
+class TestChunkFileCompress(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def open(self, mode, **kwargs):
+        kwargs.setdefault('compression', 'zlib')
+        kwargs.setdefault('compress_blocksize', 4096)
+        return ChunkFile.open(self.tmpdir, mode, **kwargs)
+
+    def chunkpath(self, n=0):
+        return self.tmpdir / 'chunk.{0:0>11d}.dat'.format(n)
+
+    def allocated(self, n=0):
+        # index slots are sized for a full chunk but mostly left as holes
+        return self.chunkpath(n).stat().st_blocks * 512
+
+    def testRoundTrip(self):
+        rnd = random.Random(1)
+        model = bytearray()
+
+        f = self.open('w+b')
+        for _ in range(200):
+            offset = rnd.randrange(0, 50000)
+            data = bytes(rnd.randrange(4)) * rnd.randrange(1, 9000)
+            f.seek(offset)
+            f.write(data)
+
+            if len(model) < offset + len(data):
+                model.extend(bytes(offset + len(data) - len(model)))
+            model[offset:offset+len(data)] = data
+
+        f.seek(0)
+        self.assertEqual(f.read(), bytes(model))
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), bytes(model))
+        for _ in range(50):
+            offset = rnd.randrange(0, len(model))
+            f.seek(offset)
+            self.assertEqual(f.read(100), bytes(model[offset:offset+100]))
+        f.close()
+
+    def testCompresses(self):
+        f = self.open('wb')
+        f.write(b'telemetry ' * 100000)
+        f.close()
+
+        self.assertLess(self.allocated(), 200000)
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        f.seek(0, os.SEEK_END)
+        self.assertEqual(f.tell(), 1000000)
+        f.close()
+
+    def testHeaderFlag(self):
+        f = self.open('wb')
+        f.write(b'x')
+        f.close()
+
+        with self.chunkpath().open('rb') as fh:
+            header = ChunkFileHeader.unpack_from(fh.read(HEADERSIZE))
+        self.assertTrue(header.flags() & FLAG_COMPRESSED)
+        self.assertEqual(header.fields['codec'], 'zlib')
+
+    def testIncompressible(self):
+        data = os.urandom(20000)
+
+        f = self.open('wb')
+        f.write(data)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), data)
+        f.close()
+
+    def testReadTouchesOnlyNeededBlocks(self):
+        f = self.open('wb')
+        f.write(b'abcd' * 10000)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        chunk = f._chunks[0]
+        calls = []
+        decompress = chunk._decompress
+        def counting(data):
+            calls.append(1)
+            return decompress(data)
+        chunk._decompress = counting
+
+        f.seek(4096 * 5 + 10)
+        self.assertEqual(f.read(8), b'cdabcdab')
+        self.assertEqual(len(calls), 1)
+        f.close()
+
+    def testTruncate(self):
+        f = self.open('w+b')
+        f.write(b'y' * 10000)
+        f.truncate(5000)
+        f.truncate(9000)
+        f.seek(0)
+        self.assertEqual(f.read(), b'y' * 5000 + b'\x00' * 4000)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), b'y' * 5000 + b'\x00' * 4000)
+        f.close()
+
+    def testTornIndex(self):
+        f = self.open('wb')
+        f.write(b'first')
+        f.flush()
+        f.seek(0)
+        f.write(b'SECOND')
+        f.close()
+
+        # wreck the newest index slot; the previous one still describes
+        # the data as of the first flush
+        chunk = ChunkFile.open(self.tmpdir, 'rb')._chunks[0]
+        chunk._load()
+        slotofs = HEADERSIZE + (chunk._seq % 2) * chunk._slotsize
+        with self.chunkpath().open('r+b') as fh:
+            fh.seek(slotofs + 8)
+            fh.write(b'\xff' * 8)
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), b'first')
+        f.close()
+
+    def testCompaction(self):
+        f = self.open('wb')
+        for i in range(200):
+            f.seek(0)
+            f.write(os.urandom(4096 * 4))
+            f.flush()
+        f.close()
+
+        self.assertLess(self.allocated(), 4096 * 40)
+
+    def testLzma(self):
+        f = self.open('wb', compression='lzma')
+        f.write(b'lzma data ' * 1000)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), b'lzma data ' * 1000)
+        f.close()
+
+    def testBadCodec(self):
+        self.assertRaises(ValueError, self.open, 'wb', compression='rot13')
+
+if __name__ == '__main__':
+    unittest.main()
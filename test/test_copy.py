@@ -0,0 +1,123 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+import chunkfile
+from chunkfile import *
+
+class TestCopy(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def make(self, name, pieces, **kwargs):
+        f = ChunkFile.open(self.tmpdir / name, 'wb', **kwargs)
+        for offset, data in pieces:
+            f.seek(offset)
+            f.write(data)
+        f.close()
+        return self.tmpdir / name
+
+    def read(self, dirpath, offset, n):
+        f = ChunkFile.open(dirpath, 'rb')
+        f.seek(offset)
+        data = f.read(n)
+        f.close()
+        return data
+
+    def size(self, dirpath):
+        f = ChunkFile.open(dirpath, 'rb')
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.close()
+        return size
+
+    def testCopy(self):
+        src = self.make('src', [(0, b'head'), (CHUNKDATASIZE + 10, b'tail')], checksum='crc32')
+        dst = self.tmpdir / 'dst'
+        self.assertEqual(chunkfile.copy(src, dst), 2)
+
+        self.assertEqual(self.read(dst, 0, 4), b'head')
+        self.assertEqual(self.read(dst, CHUNKDATASIZE + 10, 10), b'tail')
+        # holes stay holes
+        self.assertLess((dst / 'chunk.00000000000.dat').stat().st_blocks * 512, 1024 * 1024)
+
+        f = ChunkFile.open(dst, 'rb')
+        self.assertEqual(f.verify(), [])
+        f.close()
+
+        self.assertRaises(IOError, chunkfile.copy, src, dst)
+
+    def testConcatAligned(self):
+        a = self.make('a', [(CHUNKDATASIZE - 1, b'A')])
+        b = self.make('b', [(0, b'bb'), (CHUNKDATASIZE + 5, b'B')], checksum='crc32')
+        c = self.tmpdir / 'c'
+
+        self.assertEqual(concat(c, a, b), 2 * CHUNKDATASIZE + 6)
+        self.assertEqual(sorted(p.name for p in c.iterdir() if not p.name.startswith('.')),
+                         ['chunk.00000000000.dat', 'chunk.00000000001.dat', 'chunk.00000000002.dat'])
+        self.assertEqual(self.read(c, CHUNKDATASIZE - 1, 3), b'Abb')
+        self.assertEqual(self.read(c, 2 * CHUNKDATASIZE + 5, 10), b'B')
+
+        f = ChunkFile.open(c, 'rb')
+        self.assertEqual(f.verify(), [])
+        self.assertEqual([f._chunks[i].chunknum() for i in range(3)], [0, 1, 2])
+        f.close()
+
+        # the sources are untouched
+        self.assertEqual(self.read(b, 0, 2), b'bb')
+
+    def testConcatMisaligned(self):
+        a = self.make('a', [(0, b'0123456789')])
+        b = self.make('b', [(CHUNKDATASIZE - 3, b'xyzXYZ')])
+
+        self.assertEqual(concat(a, b), CHUNKDATASIZE + 13)
+        self.assertEqual(self.read(a, 0, 12), b'0123456789' + bytes(2))
+        self.assertEqual(self.read(a, CHUNKDATASIZE + 7, 10), b'xyzXYZ')
+        self.assertEqual(self.size(b), CHUNKDATASIZE + 3)
+
+    def testConcatMove(self):
+        a = self.make('a', [(0, b'a' * 100)])
+        b = self.make('b', [(CHUNKDATASIZE - 2, b'bbbb')])
+        c = self.make('c', [(0, b'c')])
+        d = self.tmpdir / 'd'
+
+        # b's chunks are moved in, a and c copied after them
+        self.assertEqual(concat(d, b, a, c, move=True), CHUNKDATASIZE + 103)
+        self.assertEqual(self.read(d, CHUNKDATASIZE - 2, 200), b'bbbb' + b'a' * 100 + b'c')
+
+        for src in [a, b, c]:
+            self.assertEqual(self.size(src), 0)
+
+    def testConcatMoveInterrupted(self):
+        a = self.make('a', [(0, b'a' * 100), (CHUNKDATASIZE, b'A')])
+        d = self.tmpdir / 'd'
+
+        # the crash comes as the second chunk is being put in place
+        rename = os.rename
+        renamed = []
+        def crash(src, dst):
+            if str(src).endswith('.concat'):
+                if renamed:
+                    raise OSError('power cut')
+                renamed.append(dst)
+            rename(src, dst)
+
+        os.rename = crash
+        try:
+            self.assertRaises(OSError, concat, d, a, move=True)
+        finally:
+            os.rename = rename
+
+        # nothing has left the source
+        self.assertEqual(self.read(a, 0, 100), b'a' * 100)
+        self.assertEqual(self.read(a, CHUNKDATASIZE, 10), b'A')
+
+        self.assertEqual(concat(self.tmpdir / 'e', a, move=True), CHUNKDATASIZE + 1)
+        self.assertEqual(self.read(self.tmpdir / 'e', CHUNKDATASIZE, 10), b'A')
+        self.assertEqual(self.size(a), 0)
+
+if __name__ == '__main__':
+    unittest.main()
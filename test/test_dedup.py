@@ -0,0 +1,160 @@
+import importlib, os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+BS = 4096
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.blocks = [os.urandom(BS) for _ in range(4)]
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def open(self, mode='ab', **kwargs):
+        return ChunkFile.open(self.tmpdir, mode, dedup=True, dedup_blocksize=BS, **kwargs)
+
+    def stored(self):
+        # block files on disk
+        return sum(1 for p in (self.tmpdir / '.dedup').glob('*/*') if not p.name.startswith('.'))
+
+    def testRepeatedBlocksStoredOnce(self):
+        data = b''.join(self.blocks[i % 4] for i in range(100))
+        with self.open('wb') as f:
+            f.write(data)
+
+        self.assertEqual(self.stored(), 4)
+        self.assertEqual(DedupStore.of(self.tmpdir).stats(), {'blocks': 4, 'references': 100})
+        self.assertLess((self.tmpdir / 'chunk.00000000000.dat').stat().st_blocks * 512, len(data))
+
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.read(), data)
+            f.seek(BS * 7 + 100)
+            self.assertEqual(f.read(BS), data[BS*7+100:BS*8+100])
+
+    def testZerosAreHoles(self):
+        with self.open('wb') as f:
+            f.write(bytes(BS * 10))
+            f.write(b'end')
+
+        self.assertEqual(self.stored(), 1)
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.read(), bytes(BS * 10) + b'end')
+
+    def testPartialOverwrite(self):
+        with self.open('wb') as f:
+            f.write(self.blocks[0] * 3)
+        with self.open('r+b') as f:
+            f.seek(BS + 10)
+            f.write(b'changed')
+
+        expected = bytearray(self.blocks[0] * 3)
+        expected[BS+10:BS+17] = b'changed'
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.read(), bytes(expected))
+        self.assertEqual(self.stored(), 2)
+
+    def testTruncateReclaims(self):
+        with self.open('wb') as f:
+            f.write(b''.join(self.blocks))
+        self.assertEqual(self.stored(), 4)
+
+        with self.open('r+b') as f:
+            f.truncate(BS + 100)
+        self.assertEqual(self.stored(), 2)
+
+        with self.open('r+b') as f:
+            f.truncate(BS * 3)
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.read(), self.blocks[0] + self.blocks[1][:100] + bytes(BS * 2 - 100))
+
+        with self.open('r+b') as f:
+            f.truncate(0)
+        self.assertEqual(self.stored(), 0)
+
+    def testEraseReleasesBlocks(self):
+        with self.open('wb') as f:
+            f.seek(CHUNKDATASIZE - BS)
+            f.write(self.blocks[0] * 2)
+        self.assertEqual(len(list(self.tmpdir.glob('chunk.*.dat'))), 2)
+        self.assertEqual(DedupStore.of(self.tmpdir).stats()['references'], 2)
+
+        with self.open('r+b') as f:
+            f.truncate(CHUNKDATASIZE)
+        self.assertEqual(len(list(self.tmpdir.glob('chunk.*.dat'))), 1)
+        self.assertEqual(DedupStore.of(self.tmpdir).stats()['references'], 1)
+        self.assertEqual(self.stored(), 1)
+
+    def testSharedAcrossChunks(self):
+        with self.open('wb') as f:
+            f.write(self.blocks[1])
+            f.seek(CHUNKDATASIZE)
+            f.write(self.blocks[1])
+        self.assertEqual(self.stored(), 1)
+
+        with self.open('r+b') as f:
+            f.write(self.blocks[2])
+        self.assertEqual(self.stored(), 2)
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            f.seek(CHUNKDATASIZE)
+            self.assertEqual(f.read(), self.blocks[1])
+
+    def testMapCache(self):
+        module = importlib.import_module('chunkfile.DedupChunk')
+        saved = module.MAPCACHE
+        module.MAPCACHE = 1
+        try:
+            with self.open('w+b') as f:
+                for i in range(3):
+                    f.seek(CHUNKDATASIZE * i)
+                    f.write(self.blocks[i])
+                f.flush()
+                for i in range(3):
+                    f.seek(CHUNKDATASIZE * i)
+                    self.assertEqual(f.read(BS), self.blocks[i])
+                self.assertEqual(sum(1 for chunk in f._chunks if chunk._map is not None), 1)
+        finally:
+            module.MAPCACHE = saved
+
+    def testVerifyFindsDamage(self):
+        with self.open('wb') as f:
+            f.write(self.blocks[0] + self.blocks[1])
+
+        store = self.tmpdir / '.dedup'
+        digest = [p for p in store.glob('*/*')][0]
+        with digest.open('r+b') as out:
+            out.write(b'X')
+
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(len(f.verify(parallelism=1)), 1)
+
+    def testReclaim(self):
+        with self.open('wb') as f:
+            f.write(self.blocks[0])
+
+        leaked = self.tmpdir / '.dedup' / 'ab' / ('ab' * 32)
+        leaked.parent.mkdir(exist_ok=True)
+        leaked.write_bytes(b'orphan')
+        self.assertEqual(reclaim(self.tmpdir), 1)
+        self.assertFalse(leaked.exists())
+        self.assertEqual(DedupStore.of(self.tmpdir).stats(), {'blocks': 1, 'references': 1})
+
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.read(), self.blocks[0])
+
+    def testBadOptions(self):
+        self.assertRaises(ValueError, self.open, 'wb', compression='zlib')
+        self.assertRaises(ValueError, self.open, 'wb', shared=True)
+        self.assertRaises(ValueError, ChunkFile.open, self.tmpdir, 'wb', dedup=True, dedup_blocksize=0)
+
+    def testNoSnapshotOrCopy(self):
+        with self.open('wb') as f:
+            f.write(self.blocks[0])
+            self.assertRaises(NotImplementedError, f.snapshot, str(self.tmpdir) + '.snap')
+        self.assertRaises(NotImplementedError, copy, self.tmpdir, str(self.tmpdir) + '.copy')
+
+if __name__ == '__main__':
+    unittest.main()
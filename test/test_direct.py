@@ -0,0 +1,117 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+@unittest.skipUnless(hasattr(os, 'O_DIRECT'), 'O_DIRECT not available')
+class TestChunkFileDirect(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testAlignedRoundTrip(self):
+        data = os.urandom(DIRECTALIGN * 8)
+
+        f = ChunkFile.open(self.tmpdir, 'wb', direct=True)
+        f.write(data)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb', direct=True)
+        self.assertEqual(f.read(), data)
+        f.close()
+
+    def testUnalignedRoundTrip(self):
+        data = os.urandom(DIRECTALIGN * 3 + 123)
+
+        f = ChunkFile.open(self.tmpdir, 'wb', direct=True)
+        f.write(b'abc')
+        f.write(data)
+        f.seek(DIRECTALIGN - 1)
+        f.write(b'XYZ')
+        f.close()
+
+        expected = bytearray(b'abc' + data)
+        expected[DIRECTALIGN-1:DIRECTALIGN+2] = b'XYZ'
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), bytes(expected))
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb', direct=True)
+        f.seek(5)
+        self.assertEqual(f.read(DIRECTALIGN * 2 + 7), bytes(expected[5:DIRECTALIGN*2+12]))
+        self.assertEqual(f.tell(), DIRECTALIGN * 2 + 12)
+        f.close()
+
+    def testReadInto(self):
+        data = os.urandom(10000)
+
+        f = ChunkFile.open(self.tmpdir, 'wb', direct=True)
+        f.write(data)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb', direct=True)
+        f.seek(100)
+        buf = bytearray(20000)
+        self.assertEqual(f.readinto(buf), len(data) - 100)
+        self.assertEqual(bytes(buf[:len(data)-100]), data[100:])
+        self.assertEqual(f.tell(), len(data))
+        self.assertEqual(f.readinto(buf), 0)
+        f.close()
+
+    def testReadLong(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', direct=True)
+        f.write(b'short')
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb', direct=True)
+        self.assertEqual(f.read(CHUNKSIZE * 4), b'short')
+        f.close()
+
+    def testReadCrossChunk(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', direct=True)
+        f.truncate(CHUNKDATASIZE + 10)
+        f.seek(CHUNKDATASIZE - 10)
+        f.write(b'a' * 10 + b'b' * 10)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb', direct=True)
+        f.seek(CHUNKDATASIZE - 10)
+        self.assertEqual(f.read(), b'a' * 10 + b'b' * 10)
+        f.close()
+
+class TestChunkFileReadInto(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testReadInto(self):
+        f = ChunkFile.open(self.tmpdir, 'w+b')
+        f.write(b'abcdefghij')
+        f.seek(2)
+
+        buf = bytearray(4)
+        self.assertEqual(f.readinto(buf), 4)
+        self.assertEqual(buf, b'cdef')
+        self.assertEqual(f.tell(), 6)
+        f.close()
+
+    def testReadIntoClosed(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.close()
+
+        self.assertRaises(ValueError, f.readinto, bytearray(1))
+
+    def testReadIntoW(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        self.assertRaises(IOError, f.readinto, bytearray(1))
+        f.close()
+
+if __name__ == '__main__':
+    unittest.main()
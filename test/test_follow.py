@@ -0,0 +1,80 @@
+import asyncio, shutil, tempfile, threading, time, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class TestFollow(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+        # the tail is 10 bytes short of the end of chunk 0
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.truncate(CHUNKDATASIZE - 10)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def writer(self, pieces):
+        def run():
+            f = ChunkFile.open(self.tmpdir, 'ab')
+            for piece in pieces:
+                time.sleep(0.02)
+                f.write(piece)
+                f.flush()
+            f.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def pieces(self):
+        # the second runs into a new chunk, the third is all in it
+        return [b'a' * 5, b'b' * 20, b'c' * 7]
+
+    def check_follow(self, poll):
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        f.seek(0, 2)
+        thread = self.writer(self.pieces())
+        got = b''.join(f.follow(blocksize=8, idle_timeout=0.5, poll=poll))
+        thread.join()
+
+        self.assertEqual(got, b''.join(self.pieces()))
+        self.assertEqual(f.tell(), CHUNKDATASIZE + 22)
+        f.close()
+
+    def testInotify(self):
+        self.check_follow(False)
+
+    def testPoll(self):
+        self.check_follow(True)
+
+    def testAsync(self):
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        f.seek(0, 2)
+
+        async def collect():
+            got = []
+            async for data in f.afollow(idle_timeout=0.5):
+                got.append(data)
+            return b''.join(got)
+
+        thread = self.writer(self.pieces())
+        loop = asyncio.new_event_loop()
+        try:
+            got = loop.run_until_complete(collect())
+        finally:
+            loop.close()
+        thread.join()
+        self.assertEqual(got, b''.join(self.pieces()))
+        f.close()
+
+    def testIdle(self):
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        f.seek(CHUNKDATASIZE - 15)
+        self.assertEqual(list(f.follow(idle_timeout=0)), [bytes(5)])
+        self.assertRaises(IOError, ChunkFile.open(self.tmpdir / 'w', 'wb').follow)
+        f.close()
+
+if __name__ == '__main__':
+    unittest.main()
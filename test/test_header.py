@@ -0,0 +1,159 @@
+import shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+from chunkfile.ChunkFile import ChunkFileHeader
+
+class TestChunkFileHeader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def chunkpath(self, n=0, dirpath=None):
+        return (dirpath or self.tmpdir) / 'chunk.{0:0>11d}.dat'.format(n)
+
+    def header(self, n=0):
+        with self.chunkpath(n).open('rb') as fh:
+            return ChunkFileHeader.unpack_from(fh.read(HEADERSIZE))
+
+    def testNewChunks(self):
+        with ChunkFile.open(self.tmpdir, 'wb') as f:
+            f.write(b'x')
+            f.seek(CHUNKDATASIZE)
+            f.write(b'y')
+            volume = f.volume_id
+
+        self.assertEqual(len(volume), 32)
+        for n in range(2):
+            header = self.header(n)
+            self.assertEqual(header.iface_version, IFACE_VERSION)
+            self.assertEqual(header.fields['chunksize'], str(CHUNKSIZE))
+            self.assertEqual(header.fields['volume'], volume)
+            self.assertEqual(header.fields['generation'], str(n + 1))
+        self.assertEqual(self.header(0).fields['length'], str(CHUNKDATASIZE))
+        self.assertEqual(self.header(1).fields['length'], '1')
+
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.volume_id, volume)
+
+    def testTruncateMakesNewVolume(self):
+        with ChunkFile.open(self.tmpdir, 'wb') as f:
+            f.write(b'x')
+            volume = f.volume_id
+        with ChunkFile.open(self.tmpdir, 'wb') as f:
+            f.write(b'x')
+            self.assertNotEqual(f.volume_id, volume)
+
+    def testStrayChunk(self):
+        other = Path(tempfile.mkdtemp())
+        try:
+            with ChunkFile.open(self.tmpdir, 'wb') as f:
+                f.write(b'x')
+            with ChunkFile.open(other, 'wb') as f:
+                f.seek(CHUNKDATASIZE)
+                f.write(b'y')
+            shutil.copy(str(self.chunkpath(1, other)), str(self.chunkpath(1)))
+        finally:
+            shutil.rmtree(str(other))
+
+        def read():
+            with ChunkFile.open(self.tmpdir, 'rb') as f:
+                f.seek(CHUNKDATASIZE)
+                return f.read()
+        self.assertRaises(IOError, read)
+
+    def testVersion1Readable(self):
+        with self.chunkpath().open('wb') as fh:
+            buf = bytearray(HEADERSIZE)
+            ChunkFileHeader(SIGNATURE, VERSION, 1, 0).pack_into(buf)
+            fh.write(buf)
+            fh.write(b'old data')
+
+        with ChunkFile.open(self.tmpdir, 'r+b') as f:
+            self.assertEqual(f.read(), b'old data')
+            self.assertIsNone(f.volume_id)
+            f.write(b'!')
+            f.seek(CHUNKDATASIZE)
+            f.write(b'new')
+
+        self.assertEqual(self.header(0).iface_version, 1)
+        self.assertNotIn('volume', self.header(1).fields)
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.read(9), b'old data!')
+
+    def testLengthRecordedAtFlush(self):
+        with ChunkFile.open(self.tmpdir, 'wb') as f:
+            f.write(b'abc' * 10000)
+            self.assertNotIn('length', self.header().fields)
+            f.flush()
+            self.assertEqual(self.header().fields['length'], '30000')
+
+            # overwrites leave it alone
+            f.seek(10)
+            f.write(b'xyz')
+            self.assertEqual(self.header().fields['length'], '30000')
+            f.seek(0, 2)
+            f.write(b'more')
+            self.assertNotIn('length', self.header().fields)
+        self.assertEqual(self.header().fields['length'], '30004')
+
+        # Sizes come from the header. Data past the length, as a crash
+        # between syncs can leave, isn't seen, and goes before the next
+        # change.
+        with self.chunkpath().open('ab') as fh:
+            fh.write(b'junk')
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            f.seek(0, 2)
+            self.assertEqual(f.tell(), 30004)
+        with ChunkFile.open(self.tmpdir, 'ab') as f:
+            f.write(b'!')
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.read()[-5:], b'more!')
+
+    def testCompressedLength(self):
+        with ChunkFile.open(self.tmpdir, 'wb', compression='zlib') as f:
+            f.write(b'abc' * 10000)
+            f.flush()
+            self.assertEqual(self.header().fields['length'], '30000')
+
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            f.seek(0, 2)
+            self.assertEqual(f.tell(), 30000)
+            # from the header, without reading the index
+            self.assertFalse(f._chunks[0]._loaded)
+
+        with ChunkFile.open(self.tmpdir, 'r+b', compression='zlib') as f:
+            f.seek(0, 2)
+            f.write(b'more')
+            self.assertNotIn('length', self.header().fields)
+        self.assertEqual(self.header().fields['length'], '30004')
+
+        with ChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(len(f.read()), 30004)
+
+    def testGeneration(self):
+        with ChunkFile.open(self.tmpdir, 'wb') as f:
+            f.write(b'x')
+            self.assertEqual(f.generation, 1)
+            f.write(b'y')
+            f.truncate(CHUNKDATASIZE + 5)
+            self.assertEqual(f.generation, 2)
+            f.truncate(CHUNKDATASIZE + 1)
+            self.assertEqual(f.generation, 2)
+            f.truncate(5)
+            self.assertEqual(f.generation, 3)
+
+        # the tail chunk has the volume's
+        self.assertEqual(self.header(0).fields['generation'], '3')
+        with ChunkFile.open(self.tmpdir, 'r+b') as f:
+            self.assertEqual(f.generation, 3)
+            f.truncate(CHUNKDATASIZE + 1)
+            self.assertEqual(f.generation, 4)
+        self.assertEqual(self.header(0).fields['generation'], '3')
+        self.assertEqual(self.header(1).fields['generation'], '4')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+from chunkfile.ChunkFile import Chunk
+
+class TestChunkFileLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def chunknums(self):
+        return sorted(int(p.name.split('.')[1]) for p in self.tmpdir.glob('chunk.*'))
+
+    def testRetainChunks(self):
+        f = ChunkFile.open(self.tmpdir, 'w+b', retain_chunks=2)
+        f.write(b'first')
+        f.seek(CHUNKDATASIZE * 3)
+        f.write(b'last')
+
+        self.assertEqual(self.chunknums(), [2, 3])
+        self.assertEqual(f.start, CHUNKDATASIZE * 2)
+
+        f.seek(0)
+        self.assertRaises(IOError, f.read, 5)
+        self.assertRaises(IOError, f.write, b'x')
+
+        f.seek(CHUNKDATASIZE * 3)
+        self.assertEqual(f.read(), b'last')
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.start, CHUNKDATASIZE * 2)
+        f.seek(0, os.SEEK_END)
+        self.assertEqual(f.tell(), CHUNKDATASIZE * 3 + 4)
+        f.seek(CHUNKDATASIZE * 2)
+        self.assertEqual(f.read(4), bytes(4))
+        f.close()
+
+    def testRetainBytes(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', retain_bytes=CHUNKDATASIZE + 10)
+        f.seek(CHUNKDATASIZE * 2 + 5)
+        f.write(b'x')
+        # the newest CHUNKDATASIZE + 10 bytes still reach into chunk 0
+        self.assertEqual(self.chunknums(), [0, 1, 2])
+
+        f.seek(CHUNKDATASIZE * 3)
+        f.write(b'z')
+        self.assertEqual(self.chunknums(), [1, 2, 3])
+        f.close()
+
+    def testAppendKeepsOffsets(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', retain_chunks=1)
+        f.seek(CHUNKDATASIZE - 2)
+        f.write(b'ab')
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'ab', retain_chunks=1)
+        f.write(b'cd')
+        self.assertEqual(f.tell(), CHUNKDATASIZE + 2)
+        f.close()
+
+        self.assertEqual(self.chunknums(), [1])
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        f.seek(CHUNKDATASIZE)
+        self.assertEqual(f.read(), b'cd')
+        f.close()
+
+    def testInterruptedDrop(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', retain_chunks=1)
+        f.seek(CHUNKDATASIZE * 2)
+        f.write(b'x')
+        f.close()
+
+        # chunk 1 came back as if the crash hit before it was unlinked
+        Chunk.create(self.tmpdir, 1)
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.start, CHUNKDATASIZE * 2)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'ab')
+        f.close()
+        self.assertEqual(self.chunknums(), [2])
+
+    def testTruncate(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', retain_chunks=1)
+        f.seek(CHUNKDATASIZE + 10)
+        f.write(b'x')
+
+        self.assertRaises(IOError, f.truncate, 5)
+        f.truncate(CHUNKDATASIZE)
+        self.assertEqual(self.chunknums(), [1])
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.start, CHUNKDATASIZE)
+        f.seek(0, os.SEEK_END)
+        self.assertEqual(f.tell(), CHUNKDATASIZE)
+        f.close()
+
+    def testTruncateGrows(self):
+        f = ChunkFile.open(self.tmpdir, 'w+b', retain_chunks=2)
+        f.write(b'abc')
+        f.truncate(CHUNKDATASIZE * 4 + 10)
+        self.assertEqual(self.chunknums(), [3, 4])
+        self.assertEqual(f.start, CHUNKDATASIZE * 3)
+        f.seek(CHUNKDATASIZE * 4)
+        self.assertEqual(f.read(), bytes(10))
+        f.close()
+
+    def testRewriteStartsOver(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', retain_chunks=1)
+        f.seek(CHUNKDATASIZE)
+        f.write(b'x')
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        self.assertEqual(f.start, 0)
+        f.write(b'new')
+        f.close()
+        self.assertEqual(self.chunknums(), [0])
+
+    def testSyncToMirrorsStart(self):
+        dest = self.tmpdir / 'mirror'
+        f = ChunkFile.open(self.tmpdir / 'log', 'w+b', retain_chunks=1)
+        f.seek(CHUNKDATASIZE)
+        f.write(b'kept')
+        f.sync_to(dest)
+        f.close()
+
+        f = ChunkFile.open(dest, 'rb')
+        self.assertEqual(f.start, CHUNKDATASIZE)
+        f.seek(CHUNKDATASIZE)
+        self.assertEqual(f.read(), b'kept')
+        f.close()
+
+    def testInvalidCaps(self):
+        self.assertRaises(ValueError, ChunkFile.open, self.tmpdir, 'wb', retain_chunks=0)
+        self.assertRaises(ValueError, ChunkFile.open, self.tmpdir, 'wb', retain_bytes=-1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import operator, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+# map_chunks() functions run in worker processes, so they live up here
+
+def count_nonzero(offset, data):
+    return len(data) - data.count(0)
+
+def find_marker(offset, data):
+    # offsets of b'MARK' starting in this chunk
+    found = []
+    i = data.find(b'MARK')
+    while 0 <= i < CHUNKDATASIZE:
+        found.append(offset + i)
+        i = data.find(b'MARK', i + 1)
+    return found
+
+def chunk_info(offset, data):
+    return offset, len(data)
+
+class TestMapChunks(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(b'MARK')
+        f.seek(CHUNKDATASIZE - 2)
+        f.write(b'MARK')
+        f.write(b'tail')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testInProcess(self):
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.map_chunks(chunk_info, processes=1, overlap=10),
+                         [(0, CHUNKDATASIZE + 6), (CHUNKDATASIZE, 6)])
+        # the cursor doesn't move
+        self.assertEqual(f.tell(), 0)
+        f.close()
+
+    def testWorkers(self):
+        f = ChunkFile.open(self.tmpdir, 'ab')
+        f.write(b'MARK')
+
+        # only with the overlap is the marker across the boundary found
+        self.assertEqual(f.map_chunks(find_marker, operator.add, processes=2),
+                         [0, CHUNKDATASIZE + 6])
+        self.assertEqual(f.map_chunks(find_marker, operator.add, processes=2, overlap=3),
+                         [0, CHUNKDATASIZE - 2, CHUNKDATASIZE + 6])
+        f.close()
+
+    def testEmpty(self):
+        f = ChunkFile.open(self.tmpdir, 'w+b')
+        self.assertEqual(f.map_chunks(count_nonzero), [])
+        self.assertIsNone(f.map_chunks(count_nonzero, operator.add))
+        self.assertRaises(ValueError, f.map_chunks, count_nonzero, overlap=-1)
+        f.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+from chunkfile.ChunkFile import Chunk
+
+class TestMerkle(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.src = self.tmpdir / 'src'
+        self.dst = self.tmpdir / 'dst'
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def read_all(self, dirpath):
+        f = ChunkFile.open(dirpath, 'rb')
+        data = f.read()
+        f.close()
+        return data
+
+    def testTreeDiff(self):
+        leaves = [bytes([i]) * 16 for i in range(10)]
+        a = MerkleTree(leaves, 16)
+        changed = list(leaves)
+        changed[3] = b'x' * 16
+        changed[9] = b'y' * 16
+
+        self.assertEqual(a.diff(MerkleTree(leaves, 16)), [])
+        self.assertEqual(a.diff(MerkleTree(changed, 16)), [3, 9])
+        self.assertEqual(a.diff(MerkleTree(leaves[:8], 16)), [8, 9])
+        self.assertRaises(ValueError, a.diff, MerkleTree(leaves, 32))
+
+    def testRootTracksChanges(self):
+        f = ChunkFile.open(self.src, 'w+b')
+        f.write(os.urandom(300000))
+        root = f.merkle_root()
+        self.assertEqual(f.merkle_root(), root)
+
+        f.seek(1000)
+        f.write(b'x')
+        changed = f.merkle_root()
+        self.assertNotEqual(changed, root)
+        f.close()
+
+        # a fresh open trusts the saved leaves
+        f = ChunkFile.open(self.src, 'rb')
+        self.assertEqual(f.merkle_root(), changed)
+        f.close()
+
+    def testOutsideChangeNoticed(self):
+        f = ChunkFile.open(self.src, 'wb')
+        f.write(b'a' * 100000)
+        root = f.merkle_root()
+        f.close()
+
+        path = self.src / 'chunk.00000000000.dat'
+        with path.open('r+b') as f:
+            f.seek(HEADERSIZE + 5)
+            f.write(b'b')
+        st = path.stat()
+        os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+
+        f = ChunkFile.open(self.src, 'rb')
+        self.assertNotEqual(f.merkle_root(), root)
+        f.close()
+
+    def testDiff(self):
+        data = os.urandom(1000000)
+        for dirpath in (self.src, self.dst):
+            f = ChunkFile.open(dirpath, 'wb')
+            f.write(data)
+            f.close()
+
+        f = ChunkFile.open(self.dst, 'r+b')
+        f.seek(70000)
+        f.write(b'changed')
+        f.seek(999999)
+        f.write(b'longer')
+        f.close()
+
+        f = ChunkFile.open(self.src, 'rb')
+        self.assertEqual(f.diff(self.dst), [(65536, 131072), (983040, 1000005)])
+        f.close()
+
+    def testDiffComparesRootsFirst(self):
+        for dirpath in (self.src, self.dst):
+            f = ChunkFile.open(dirpath, 'wb')
+            for i in range(3):
+                f.seek(CHUNKDATASIZE * i)
+                f.write(b'chunk %d' % i)
+            f.merkle_root()
+            f.close()
+
+        f = ChunkFile.open(self.dst, 'r+b')
+        f.seek(CHUNKDATASIZE + 3)
+        f.write(b'changed')
+        f.close()
+
+        # only the changed chunk's tree is loaded; the others are compared
+        # by the roots in their sidecars
+        loaded = []
+        merkle_tree = Chunk.merkle_tree
+        def counting(chunk):
+            loaded.append(chunk.chunknum())
+            return merkle_tree(chunk)
+        Chunk.merkle_tree = counting
+        try:
+            f = ChunkFile.open(self.src, 'rb')
+            self.assertEqual(f.diff(self.dst), [(CHUNKDATASIZE, CHUNKDATASIZE + MERKLE_BLOCKSIZE)])
+            f.close()
+        finally:
+            Chunk.merkle_tree = merkle_tree
+        self.assertEqual(set(loaded), set([1]))
+
+    def testSyncTo(self):
+        f = ChunkFile.open(self.src, 'w+b')
+        f.seek(CHUNKDATASIZE - 10)
+        f.write(b'across the boundary')
+        # whole blocks are copied; the last one in a chunk is short
+        self.assertEqual(f.sync_to(self.dst), CHUNKDATASIZE % MERKLE_BLOCKSIZE + 9)
+        self.assertEqual(f.sync_to(self.dst), 0)
+
+        f.seek(5)
+        f.write(b'head')
+        self.assertEqual(f.sync_to(self.dst), MERKLE_BLOCKSIZE)
+        self.assertEqual(f.diff(self.dst), [])
+
+        f.truncate(100)
+        f.sync_to(self.dst)
+        f.close()
+
+        self.assertEqual(self.read_all(self.dst), self.read_all(self.src))
+
+    def testSidecarsFollowChunks(self):
+        f = ChunkFile.open(self.src, 'wb', slow_tier=self.dst)
+        f.write(b'head')
+        f.seek(CHUNKDATASIZE)
+        f.write(b'tail')
+        root = f.merkle_root()
+        f.migrate()
+        self.assertTrue((self.dst / '.chunk.00000000000.dat.tree').exists())
+        self.assertFalse((self.src / '.chunk.00000000000.dat.tree').exists())
+        self.assertEqual(f.merkle_root(), root)
+
+        f.truncate(0)
+        f.close()
+        self.assertEqual(list(self.dst.iterdir()), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import importlib, os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+from chunkfile.ChunkFile import Chunk, UnsupportedVersionError
+
+_rechunk = importlib.import_module('chunkfile.Rechunk')
+
+SMALL = HEADERSIZE + 1024 * 1024
+
+class TestRechunk(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.src = self.tmpdir / 'src'
+        self.data = os.urandom(3 * 1024 * 1024 + 100)
+
+        f = ChunkFile.open(self.src, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def chunks(self, dirpath):
+        return sorted(p.name for p in dirpath.iterdir())
+
+    def testRoundTrip(self):
+        small = self.tmpdir / 'small'
+        self.assertEqual(rechunk(self.src, small, SMALL), 4)
+        self.assertEqual(self.chunks(small), ['chunk.0000000000{0}.dat'.format(i) for i in range(4)])
+        self.assertEqual((small / 'chunk.00000000003.dat').stat().st_size, HEADERSIZE + 100)
+
+        f = ChunkFile.open(small, 'rb')
+        self.assertEqual(f.chunk_size, SMALL)
+        self.assertEqual(f.read(), self.data)
+        f.seek(SMALL - HEADERSIZE - 10)
+        self.assertEqual(f.read(20), self.data[SMALL-HEADERSIZE-10:SMALL-HEADERSIZE+10])
+        f.close()
+
+        back = self.tmpdir / 'back'
+        self.assertEqual(rechunk(small, back, CHUNKSIZE, threads=1), 1)
+        f = ChunkFile.open(back, 'rb')
+        self.assertEqual(f.read(), self.data)
+        f.close()
+
+    def testWriteRechunked(self):
+        small = self.tmpdir / 'small'
+        rechunk(self.src, small, SMALL)
+
+        # new chunks get the volume's chunk size, whatever their format
+        f = ChunkFile.open(small, 'ab', compression='zlib')
+        f.write(b'x' * (SMALL - HEADERSIZE))
+        f.close()
+        self.assertEqual(len(self.chunks(small)), 5)
+
+        f = ChunkFile.open(small, 'rb')
+        self.assertEqual(f.read(), self.data + b'x' * (SMALL - HEADERSIZE))
+        volume = f.volume_id
+        f.close()
+
+        # a chunk of another size doesn't belong
+        Chunk.create(small, 5, header={'volume': volume})
+        f = ChunkFile.open(small, 'rb')
+        f.seek(5 * (SMALL - HEADERSIZE))
+        self.assertRaisesRegex(IOError, 'bytes', f.read)
+        f.close()
+
+    def testLog(self):
+        f = ChunkFile.open(self.src, 'wb', retain_chunks=1)
+        f.seek(2 * CHUNKDATASIZE)
+        f.write(b'tail')
+        f.close()
+
+        small = self.tmpdir / 'small'
+        rechunk(self.src, small, SMALL)
+        back = self.tmpdir / 'back'
+        rechunk(small, back, CHUNKSIZE)
+
+        # the start moves down to a boundary of the small chunks, then of
+        # the big ones
+        f = ChunkFile.open(back, 'rb')
+        self.assertEqual(f.start, CHUNKDATASIZE)
+        f.seek(2 * CHUNKDATASIZE)
+        self.assertEqual(f.read(), b'tail')
+        f.close()
+
+    def testResume(self):
+        dst = self.tmpdir / 'dst'
+        finish = _rechunk._finish_chunk
+        finished = []
+
+        def fail_third(target):
+            if len(finished) == 2:
+                raise OSError('disk on fire')
+            finish(target)
+            finished.append(target)
+
+        _rechunk._finish_chunk = fail_third
+        try:
+            self.assertRaises(OSError, rechunk, self.src, dst, SMALL, threads=1)
+        finally:
+            _rechunk._finish_chunk = finish
+        self.assertIn('.rechunk', self.chunks(dst))
+
+        # another size can't take over
+        self.assertRaises(IOError, rechunk, self.src, dst, 2 * SMALL)
+
+        self.assertEqual(rechunk(self.src, dst, SMALL), 2)
+        self.assertEqual(self.chunks(dst), ['chunk.0000000000{0}.dat'.format(i) for i in range(4)])
+
+        back = self.tmpdir / 'back'
+        rechunk(dst, back, CHUNKSIZE)
+        f = ChunkFile.open(back, 'rb')
+        self.assertEqual(f.read(), self.data)
+        f.close()
+
+    def testErrors(self):
+        self.assertRaises(ValueError, rechunk, self.src, self.tmpdir / 'dst', HEADERSIZE)
+        self.assertRaises(ValueError, rechunk, self.src, self.src, SMALL)
+
+        # not over an existing volume
+        ChunkFile.open(self.tmpdir / 'other', 'wb').write(b'x')
+        self.assertRaises(IOError, rechunk, self.src, self.tmpdir / 'other', SMALL)
+
+        f = ChunkFile.open(self.tmpdir / 'zipped', 'wb', compression='zlib')
+        f.write(b'data')
+        f.close()
+        self.assertRaises(UnsupportedVersionError, rechunk, self.tmpdir / 'zipped', self.tmpdir / 'dst', SMALL)
+
+    def testCommandLine(self):
+        self.assertEqual(_rechunk.main([str(self.src), str(self.tmpdir / 'dst'), '1M']), 0)
+        self.assertEqual(len(self.chunks(self.tmpdir / 'dst')), 4)
+        self.assertEqual(_rechunk.main([str(self.src), str(self.tmpdir / 'dst'), '1M']), 1)
+
+if __name__ == '__main__':
+    unittest.main()
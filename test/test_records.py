@@ -0,0 +1,142 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+from unittest import mock
+
+from chunkfile import *
+from chunkfile.RecordChunkFile import INDEXNAME
+
+class TestRecordChunkFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.records = [os.urandom(n) for n in (0, 1, 100, 5000, 70000, 3)] * 20
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def fill(self):
+        with RecordChunkFile.open(self.tmpdir, 'wb') as f:
+            offsets = f.append_many(self.records[:50])
+            for record in self.records[50:]:
+                offsets.append(f.append(record))
+        return offsets
+
+    def testAppendAndGet(self):
+        offsets = self.fill()
+        self.assertEqual(offsets[0], 0)
+        self.assertEqual(offsets[1], 8)
+
+        with RecordChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(len(f), len(self.records))
+            for n in (0, 1, 57, 119, -1):
+                self.assertEqual(f.get(n), self.records[n])
+            self.assertRaises(IndexError, f.get, len(self.records))
+
+            self.assertEqual(list(f.records(10, 20)), self.records[10:20])
+            self.assertEqual(list(f), self.records)
+
+        cf = ChunkFile.open(self.tmpdir, 'rb')
+        cf.seek(offsets[3] + 8)
+        self.assertEqual(cf.read(5000), self.records[3])
+        cf.close()
+
+    def testIndexIsSparse(self):
+        self.fill()
+        size = (self.tmpdir / '.records.idx').stat().st_size
+        self.assertGreater(size, 0)
+        self.assertLess(size // 16, len(self.records) // 2)
+
+    def testReopenAppends(self):
+        self.fill()
+        with RecordChunkFile.open(self.tmpdir, 'ab') as f:
+            f.append(b'one more')
+            self.assertEqual(len(f), len(self.records) + 1)
+
+        with RecordChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.get(-1), b'one more')
+            self.assertEqual(f.get(-2), self.records[-1])
+
+    def testSyncWritesIndexBeforeFsync(self):
+        # size of each index file when it was fsynced
+        synced = []
+        realfsync = os.fsync
+        def fsync(fd):
+            name = os.readlink('/proc/self/fd/{0}'.format(fd))
+            if INDEXNAME in name:
+                synced.append(os.fstat(fd).st_size)
+            realfsync(fd)
+
+        with RecordChunkFile.open(self.tmpdir, 'wb') as f:
+            with mock.patch('os.fsync', fsync):
+                f.append_many(self.records)
+                f.sync()
+                f.append_many(self.records)
+                f.sync()
+            size = (self.tmpdir / INDEXNAME).stat().st_size
+
+        self.assertEqual(len(synced), 2)
+        self.assertGreater(synced[0], 0)
+        self.assertEqual(synced[1], size)
+
+    def testIndexRebuilt(self):
+        self.fill()
+        (self.tmpdir / '.records.idx').unlink()
+
+        with RecordChunkFile.open(self.tmpdir, 'ab') as f:
+            self.assertEqual(f.get(100), self.records[100])
+        self.assertTrue((self.tmpdir / '.records.idx').exists())
+
+        # an index that doesn't match the data is thrown away too
+        with (self.tmpdir / '.records.idx').open('wb') as idx:
+            idx.write(b'\x05' * 32)
+        with RecordChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(list(f), self.records)
+
+    def testTornAppend(self):
+        self.fill()
+        cf = ChunkFile.open(self.tmpdir, 'ab')
+        cf.write(b'\x10\x00\x00\x00half a frame')
+        cf.close()
+
+        with RecordChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(len(f), len(self.records))
+
+        with RecordChunkFile.open(self.tmpdir, 'ab') as f:
+            f.append(b'after')
+        with RecordChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.get(-1), b'after')
+            self.assertEqual(len(f), len(self.records) + 1)
+
+    def corrupt(self, offset):
+        cf = ChunkFile.open(self.tmpdir, 'r+b')
+        cf.seek(offset)
+        cf.write(b'\xff')
+        cf.close()
+
+    def testCorruptRecord(self):
+        offsets = self.fill()
+        self.corrupt(offsets[33] + 8)
+
+        with RecordChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(f.get(32), self.records[32])
+            self.assertRaises(IOError, f.get, 33)
+            self.assertEqual(len(f), len(self.records))
+
+    def testCorruptLastRecord(self):
+        offsets = self.fill()
+        self.corrupt(offsets[-1] + 8)
+
+        with RecordChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertEqual(len(f), len(self.records) - 1)
+
+    def testModes(self):
+        self.assertRaises(ValueError, RecordChunkFile.open, self.tmpdir, 'r')
+        self.fill()
+        with RecordChunkFile.open(self.tmpdir, 'rb') as f:
+            self.assertRaises(IOError, f.append, b'x')
+        f = RecordChunkFile.open(self.tmpdir, 'rb')
+        f.close()
+        self.assertRaises(ValueError, f.get, 0)
+
+if __name__ == '__main__':
+    unittest.main()
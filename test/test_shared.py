@@ -0,0 +1,105 @@
+import multiprocessing, os, shutil, struct, tempfile, threading, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+RECORD = struct.Struct('<II56x')
+
+def _appender(voldir, tag, count):
+    f = ChunkFile.open(voldir, 'ab', shared=True)
+    for i in range(count):
+        f.write(RECORD.pack(tag, i))
+    f.close()
+
+class TestSharedVolumes(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.voldir = self.tmpdir / 'vol'
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testConcurrentAppends(self):
+        # start close to the end of a chunk so appends race across it
+        f = ChunkFile.open(self.voldir, 'wb', shared=True)
+        f.truncate(CHUNKDATASIZE - 100 * RECORD.size - 8)
+        f.close()
+
+        ctx = multiprocessing.get_context('spawn')
+        procs = [ctx.Process(target=_appender, args=(str(self.voldir), tag, 200)) for tag in range(1, 5)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join(60)
+            self.assertEqual(p.exitcode, 0)
+
+        f = ChunkFile.open(self.voldir, 'rb', shared=True)
+        start = CHUNKDATASIZE - 100 * RECORD.size - 8
+        f.seek(start)
+        data = f.read()
+        f.close()
+
+        self.assertEqual(len(data), 4 * 200 * RECORD.size)
+        seen = {}
+        for pos in range(0, len(data), RECORD.size):
+            tag, i = RECORD.unpack_from(data, pos)
+            seen.setdefault(tag, []).append(i)
+        self.assertEqual(sorted(seen), [1, 2, 3, 4])
+        for tag in seen:
+            self.assertEqual(seen[tag], list(range(200)))
+
+    def testReaderSeesNewChunks(self):
+        writer = ChunkFile.open(self.voldir, 'ab', shared=True)
+        writer.write(b'a' * 10)
+        reader = ChunkFile.open(self.voldir, 'rb', shared=True)
+
+        writer.truncate(CHUNKDATASIZE)
+        writer.write(b'tail')
+        writer.flush()
+
+        reader.seek(0, os.SEEK_END)
+        self.assertEqual(reader.tell(), CHUNKDATASIZE + 4)
+        reader.seek(CHUNKDATASIZE)
+        self.assertEqual(reader.read(), b'tail')
+
+        writer.truncate(5)
+        reader.seek(0)
+        self.assertEqual(reader.read(), b'a' * 5)
+
+        reader.refresh()
+        reader.close()
+        writer.close()
+
+    def testWritesWaitForLocks(self):
+        f = ChunkFile.open(self.voldir, 'w+b', shared=True)
+        f.write(b'x' * 100)
+        f.flush()
+
+        chunk = f._chunks[0]
+        fd = chunk._lock_data(0, 100, True)
+        done = threading.Event()
+
+        def write():
+            g = ChunkFile.open(self.voldir, 'r+b', shared=True)
+            g.write(b'y' * 10)
+            g.close()
+            done.set()
+
+        t = threading.Thread(target=write)
+        t.start()
+        self.assertFalse(done.wait(0.2))
+        os.close(fd)
+        t.join(10)
+        self.assertTrue(done.is_set())
+
+        f.seek(0)
+        self.assertEqual(f.read(), b'y' * 10 + b'x' * 90)
+        f.close()
+
+    def testOptions(self):
+        self.assertRaises(ValueError, ChunkFile.open, self.voldir, 'wb', shared=True, compression='zlib')
+        self.assertRaises(ValueError, ChunkFile.open, self.voldir, 'wb', shared=True, cache=True)
+
+if __name__ == '__main__':
+    unittest.main()
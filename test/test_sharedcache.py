@@ -0,0 +1,133 @@
+import multiprocessing, os, shutil, sys, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+# these run in other processes, so they live up here
+
+def read_through(name, dirpath, offset, n):
+    cache = SharedBlockCache.attach(name)
+    f = ChunkFile.open(dirpath, 'rb', cache=cache)
+    f.seek(offset)
+    data = f.read(n)
+    f.close()
+    stats = cache.stats()
+    cache.close()
+    return data, stats['hits'], stats['misses']
+
+def write_at(name, dirpath, offset, data):
+    cache = SharedBlockCache.attach(name)
+    f = ChunkFile.open(dirpath, 'r+b')
+    f.seek(offset)
+    f.write(data)
+    f.close()
+    cache.close()
+
+@unittest.skipUnless(sys.version_info >= (3, 8), 'multiprocessing.shared_memory not available')
+class TestSharedBlockCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.name = 'chunkfile-test-{0}'.format(os.getpid())
+        self.cache = SharedBlockCache(self.name, blocksize=4096, capacity=4096 * 64)
+        self.data = bytes(bytearray(range(256))) * 64
+
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def tearDown(self):
+        self.cache.close()
+        self.cache.unlink()
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def read(self, offset, n, cache=None):
+        f = ChunkFile.open(self.tmpdir, 'rb', cache=cache or self.cache)
+        f.seek(offset)
+        data = f.read(n)
+        f.close()
+        return data
+
+    def run_elsewhere(self, func, *args):
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(1) as pool:
+            return pool.apply(func, (self.name,) + args)
+
+    def testHitsWithinProcess(self):
+        self.assertEqual(self.read(100, 5000), self.data[100:5100])
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+        self.assertEqual(self.read(100, 5000), self.data[100:5100])
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+        self.assertEqual(self.cache.stats()['bytes'], 8192)
+
+    def testSecondAttachSeesBlocks(self):
+        self.read(0, 10)
+        other = SharedBlockCache(self.name)
+        try:
+            self.assertEqual(other.blocksize, 4096)
+            self.assertEqual(other.capacity, 4096 * 64)
+            self.assertEqual(self.read(0, 10, cache=other), self.data[:10])
+            self.assertEqual((other.hits, other.misses), (1, 0))
+        finally:
+            other.close()
+
+    def testHitsAcrossProcesses(self):
+        self.read(0, 8192)
+        data, hits, misses = self.run_elsewhere(read_through, str(self.tmpdir), 10, 8000)
+        self.assertEqual(data, self.data[10:8010])
+        self.assertEqual((hits, misses), (2, 0))
+
+    def testWriteInvalidates(self):
+        self.read(0, 10)
+
+        f = ChunkFile.open(self.tmpdir, 'r+b')
+        f.seek(5)
+        f.write(b'XYZ')
+        f.close()
+
+        self.assertEqual(self.read(0, 10), b'\x00\x01\x02\x03\x04XYZ\x08\x09')
+        self.assertEqual(self.cache.hits, 0)
+
+    def testWriteInOtherProcessInvalidates(self):
+        self.read(0, 10)
+        self.run_elsewhere(write_at, str(self.tmpdir), 5, b'XYZ')
+        self.assertEqual(self.read(0, 10), b'\x00\x01\x02\x03\x04XYZ\x08\x09')
+
+    def testTruncateInvalidates(self):
+        self.read(0, 8192)
+
+        f = ChunkFile.open(self.tmpdir, 'r+b')
+        f.truncate(5000)
+        f.close()
+
+        self.assertEqual(self.read(0, 8192), self.data[:5000])
+
+    def testEviction(self):
+        f = ChunkFile.open(self.tmpdir, 'r+b')
+        f.seek(0)
+        f.write(os.urandom(4096 * 200))
+        f.close()
+
+        for offset in range(0, 4096 * 200, 4096):
+            self.read(offset, 10)
+        self.assertGreater(self.cache.evictions, 0)
+        self.assertLessEqual(self.cache.stats()['bytes'], self.cache.capacity)
+
+    def testClear(self):
+        self.read(0, 10)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+        self.read(0, 10)
+        self.assertEqual(self.cache.hits, 0)
+
+    def testSharedVolume(self):
+        f = ChunkFile.open(self.tmpdir, 'rb', shared=True, cache=self.cache)
+        self.assertEqual(f.read(10), self.data[:10])
+        f.close()
+
+        self.assertRaises(ValueError, ChunkFile.open, self.tmpdir, 'rb', shared=True,
+                          cache=BlockCache())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.voldir = self.tmpdir / 'vol'
+        self.snapdir = self.tmpdir / 'snap'
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def read_all(self, dirpath):
+        f = ChunkFile.open(dirpath, 'rb')
+        data = f.read()
+        f.close()
+        return data
+
+    def testSnapshotIsFrozen(self):
+        f = ChunkFile.open(self.voldir, 'w+b')
+        f.write(b'a' * 100)
+        f.seek(CHUNKDATASIZE)
+        f.write(b'b' * 100)
+        f.snapshot(self.snapdir)
+
+        f.seek(10)
+        f.write(b'changed')
+        f.truncate(CHUNKDATASIZE + 50)
+        f.close()
+
+        f = ChunkFile.open(self.snapdir, 'rb')
+        self.assertEqual(f.read(100), b'a' * 100)
+        f.seek(CHUNKDATASIZE)
+        self.assertEqual(f.read(), b'b' * 100)
+        f.close()
+
+        f = ChunkFile.open(self.voldir, 'rb')
+        self.assertEqual(f.read(20), b'a' * 10 + b'changed' + b'aaa')
+        f.seek(CHUNKDATASIZE)
+        self.assertEqual(f.read(), b'b' * 50)
+        f.close()
+
+    def testSharingBrokenOnlyOnce(self):
+        f = ChunkFile.open(self.voldir, 'wb')
+        f.write(b'x' * 10)
+        f.snapshot(self.snapdir)
+
+        f.write(b'y')
+        chunk = self.voldir / 'chunk.00000000000.dat'
+        self.assertEqual(chunk.stat().st_nlink, 1)
+        ino = chunk.stat().st_ino
+
+        f.write(b'z')
+        self.assertEqual(chunk.stat().st_ino, ino)
+        f.close()
+
+        self.assertEqual(self.read_all(self.voldir), b'x' * 10 + b'yz')
+        self.assertEqual(self.read_all(self.snapdir), b'x' * 10)
+
+    def testWriteToSnapshotLeavesVolume(self):
+        f = ChunkFile.open(self.voldir, 'wb')
+        f.write(b'original')
+        f.snapshot(self.snapdir)
+        f.close()
+
+        f = ChunkFile.open(self.snapdir, 'ab')
+        f.write(b'+more')
+        f.close()
+
+        self.assertEqual(self.read_all(self.voldir), b'original')
+        self.assertEqual(self.read_all(self.snapdir), b'original+more')
+
+    def testCompressedAndChecksummed(self):
+        for i, options in enumerate([{'compression': 'zlib'}, {'checksum': 'crc32'}]):
+            voldir = self.tmpdir / 'vol{0}'.format(i)
+            snapdir = self.tmpdir / 'snap{0}'.format(i)
+
+            f = ChunkFile.open(voldir, 'w+b', **options)
+            f.write(b'q' * 5000)
+            f.snapshot(snapdir)
+            f.seek(0)
+            f.write(b'r' * 5000)
+            f.close()
+
+            self.assertEqual(self.read_all(snapdir), b'q' * 5000)
+            self.assertEqual(self.read_all(voldir), b'r' * 5000)
+            self.assertEqual(ChunkFile.open(snapdir, 'rb').verify(parallelism=1), [])
+
+    def testStriped(self):
+        dirs = [self.tmpdir / 'a', self.tmpdir / 'b']
+        snaps = [self.tmpdir / 'sa', self.tmpdir / 'sb']
+        f = ChunkFile.open(dirs, 'wb')
+        f.seek(CHUNKDATASIZE)
+        f.write(b'tail')
+        f.snapshot(snaps)
+        f.close()
+
+        self.assertTrue((snaps[1] / 'chunk.00000000001.dat').exists())
+        f = ChunkFile.open(snaps, 'rb')
+        f.seek(CHUNKDATASIZE)
+        self.assertEqual(f.read(), b'tail')
+        f.close()
+
+    def testNonEmptyDest(self):
+        self.snapdir.mkdir()
+        (self.snapdir / 'stuff').touch()
+
+        f = ChunkFile.open(self.voldir, 'wb')
+        self.assertRaises(IOError, f.snapshot, self.snapdir)
+        self.assertRaises(ValueError, f.snapshot, [self.snapdir, self.voldir])
+        f.close()
+
+if __name__ == '__main__':
+    unittest.main()
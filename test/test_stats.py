@@ -0,0 +1,101 @@
+import shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        enable_metrics(False)
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testOffByDefault(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(b'data')
+        self.assertIsNone(f.stats())
+        f.close()
+
+    def testCounters(self):
+        f = ChunkFile.open(self.tmpdir, 'w+b', metrics=True)
+        f.seek(CHUNKDATASIZE - 10)
+        f.write(b'x' * 20)
+        f.seek(CHUNKDATASIZE - 5)
+        self.assertEqual(f.read(10), b'x' * 10)
+        f.readinto(bytearray(3))
+        f.truncate(100)
+        f.flush()
+        f.sync()
+
+        stats = f.stats()
+        self.assertEqual(stats['writes'], 1)
+        self.assertEqual(stats['bytes_written'], 20)
+        self.assertEqual(stats['reads'], 2)
+        self.assertEqual(stats['bytes_read'], 13)
+        self.assertEqual(stats['seeks'], 2)
+        # the one at open, to empty the volume
+        self.assertEqual(stats['truncates'], 2)
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['syncs'], 1)
+        self.assertEqual(stats['chunk_creates'], 2)
+        self.assertEqual(stats['chunk_erases'], 1)
+        self.assertEqual(stats['boundary_crossings'], 2)
+
+        latency = stats['latency']['read']
+        self.assertEqual(latency['count'], 2)
+        self.assertEqual(sum(latency['buckets'].values()), 2)
+        self.assertGreater(latency['total_ns'], 0)
+        self.assertLessEqual(latency['p50_ns'], latency['p99_ns'])
+        f.close()
+
+    def testChunkOpensAndCache(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.truncate(3 * CHUNKDATASIZE)
+        f.close()
+
+        cache = BlockCache(blocksize=4096, capacity=4096 * 16)
+        f = ChunkFile.open(self.tmpdir, 'rb', metrics=True, cache=cache)
+        f.seek(CHUNKDATASIZE + 100)
+        f.read(10)
+        f.seek(CHUNKDATASIZE + 200)
+        f.read(10)
+
+        stats = f.stats()
+        # the lowest chunk, to find where the volume starts, and the one read
+        self.assertEqual(stats['chunk_opens'], 2)
+        self.assertEqual(stats['cache_misses'], 1)
+        self.assertEqual(stats['cache_hits'], 1)
+        f.close()
+
+    def testProcessTotals(self):
+        before = process_stats()
+        enable_metrics()
+
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(b'abc')
+        g = ChunkFile.open(self.tmpdir, 'rb')
+        g.read()
+        f.close()
+
+        total = process_stats()
+        self.assertEqual(total['writes'] - before['writes'], 1)
+        self.assertEqual(total['bytes_read'] - before['bytes_read'], 3)
+        self.assertEqual(total['latency']['write']['count'] - before['latency']['write']['count'], 1)
+
+        # still counted once closed, or dropped without closing
+        del g
+        self.assertEqual(process_stats()['reads'] - before['reads'], 1)
+
+    def testHistogram(self):
+        h = LatencyHistogram()
+        self.assertIsNone(h.percentile(50))
+        for ns in [0, 1, 3, 1000, 1023, 10 ** 6]:
+            h.record(ns)
+        self.assertEqual(h.as_dict()['buckets'], {1: 1, 2: 1, 4: 1, 1024: 2, 2 ** 20: 1})
+        self.assertEqual(h.percentile(50), 4)
+        self.assertEqual(h.percentile(100), 2 ** 20)
+
+if __name__ == '__main__':
+    unittest.main()
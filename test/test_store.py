@@ -0,0 +1,129 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class StoreTests(object):
+    # run against each kind of store by the classes below
+
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.store = self.make_store()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testRoundTrip(self):
+        data = os.urandom(10000)
+        f = ChunkFile.open(self.store, 'wb')
+        f.write(data)
+        f.seek(5000)
+        f.write(b'x' * 100)
+        f.close()
+
+        f = ChunkFile.open(self.store, 'rb')
+        self.assertEqual(f.read(), data[:5000] + b'x' * 100 + data[5100:])
+        f.close()
+        self.assertEqual(self.store.list(), ['chunk.00000000000.dat'])
+
+    def testTruncate(self):
+        f = ChunkFile.open(self.store, 'w+b')
+        f.write(b'a' * 3000)
+        f.truncate(1000)
+        f.truncate(2000)
+        f.seek(2500)
+        f.write(b'b')
+        f.seek(0)
+        self.assertEqual(f.read(), b'a' * 1000 + bytes(1500) + b'b')
+        f.close()
+
+    def testAppendAndRecords(self):
+        f = RecordChunkFile.open(self.store, 'ab')
+        f.append_many([b'one', b'two', b'three'])
+        f.close()
+
+        f = RecordChunkFile.open(self.store, 'ab')
+        f.append(b'four')
+        self.assertEqual(list(f), [b'one', b'two', b'three', b'four'])
+        f.close()
+
+    def testSyncToDirectory(self):
+        f = ChunkFile.open(self.store, 'wb', durability='on_close')
+        f.write(os.urandom(5000))
+        f.close()
+
+        f = ChunkFile.open(self.store, 'rb')
+        self.assertEqual(f.sync_to(self.tmpdir / 'copy'), 5000)
+        g = ChunkFile.open(self.tmpdir / 'copy', 'rb')
+        self.assertEqual(f.merkle_root(), g.merkle_root())
+        self.assertEqual(f.verify(), [])
+        g.close()
+        f.close()
+
+class TestMemoryStore(StoreTests, unittest.TestCase):
+    def make_store(self):
+        return MemoryStore()
+
+    def testOptions(self):
+        self.assertRaises(ValueError, ChunkFile.open, self.store, 'wb', compression='zlib')
+        self.assertRaises(ValueError, ChunkFile.open, self.store, 'wb', slow_tier=self.tmpdir)
+        self.assertRaises(NotImplementedError, ChunkFile.open(self.store, 'wb').snapshot, self.tmpdir / 'snap')
+
+class TestDirectoryStore(StoreTests, unittest.TestCase):
+    def make_store(self):
+        (self.tmpdir / 'vol').mkdir()
+        return DirectoryStore(self.tmpdir / 'vol')
+
+    def testSameAsDirectory(self):
+        f = ChunkFile.open(self.store, 'wb', checksum='crc32')
+        f.write(b'data')
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir / 'vol', 'rb')
+        self.assertEqual(f.read(), b'data')
+        f.close()
+
+class TestLocalObjectStore(StoreTests, unittest.TestCase):
+    def make_store(self):
+        return LocalObjectStore(self.tmpdir / 'bucket', partsize=1024, cache_parts=4, readahead=2)
+
+    def testAcrossChunks(self):
+        f = ChunkFile.open(self.store, 'wb')
+        f.seek(CHUNKDATASIZE - 5)
+        f.write(b'0123456789')
+        f.close()
+        self.store.close()
+
+        # only the parts written are stored: four for each header, and
+        # one on each side of the boundary
+        parts = list((self.tmpdir / 'bucket').glob('*/0*'))
+        self.assertEqual(len(parts), 10)
+
+        self.store = self.make_store()
+        f = ChunkFile.open(self.store, 'rb')
+        f.seek(CHUNKDATASIZE - 10)
+        self.assertEqual(f.read(), bytes(5) + b'0123456789')
+        f.close()
+
+    def testWritesAreBuffered(self):
+        f = ChunkFile.open(self.store, 'wb')
+        f.write(b'x' * 100)
+        before = self.store.requests
+        for i in range(50):
+            f.write(b'y')
+        self.assertEqual(self.store.requests, before)
+
+        f.flush()
+        self.assertGreater(self.store.requests, before)
+        f.close()
+
+        self.store.close()
+        self.store = self.make_store()
+        f = ChunkFile.open(self.store, 'rb')
+        self.assertEqual(f.read(), b'x' * 100 + b'y' * 50)
+        f.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class TestChunkFileStripe(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.dirs = [self.tmpdir / 'd0', self.tmpdir / 'd1', self.tmpdir / 'd2']
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def names(self, dirpath):
+        return sorted(p.name for p in dirpath.glob('*'))
+
+    def testRoundRobin(self):
+        f = ChunkFile.open(self.dirs, 'wb')
+        f.truncate(CHUNKDATASIZE * 3 + 10)
+        f.close()
+
+        self.assertEqual(self.names(self.dirs[0]), ['chunk.00000000000.dat', 'chunk.00000000003.dat'])
+        self.assertEqual(self.names(self.dirs[1]), ['chunk.00000000001.dat'])
+        self.assertEqual(self.names(self.dirs[2]), ['chunk.00000000002.dat'])
+
+    def testReadAcrossDirectories(self):
+        marks = [os.urandom(64) for _ in range(3)]
+
+        f = ChunkFile.open(self.dirs, 'wb')
+        for i, mark in enumerate(marks):
+            f.seek((i + 1) * CHUNKDATASIZE - 32)
+            f.write(mark)
+        f.close()
+
+        f = ChunkFile.open(self.dirs, 'rb')
+        f.seek(0, os.SEEK_END)
+        self.assertEqual(f.tell(), 3 * CHUNKDATASIZE + 32)
+
+        for i, mark in enumerate(marks):
+            f.seek((i + 1) * CHUNKDATASIZE - 32)
+            self.assertEqual(f.read(64), mark)
+
+        f.seek(CHUNKDATASIZE - 32)
+        buf = bytearray(CHUNKDATASIZE + 64)
+        self.assertEqual(f.readinto(buf), CHUNKDATASIZE + 64)
+        self.assertEqual(bytes(buf[:64]), marks[0])
+        self.assertEqual(bytes(buf[-64:]), marks[1])
+        f.close()
+
+    def testWriteAcrossDirectories(self):
+        data = os.urandom(1000)
+
+        f = ChunkFile.open(self.dirs, 'w+b', parallelism=4)
+        f.seek(CHUNKDATASIZE * 2 - 500)
+        f.write(data)
+        f.seek(CHUNKDATASIZE * 2 - 500)
+        self.assertEqual(f.read(), data)
+        f.close()
+
+        self.assertEqual(len(self.names(self.dirs[2])), 1)
+
+    def testPlacement(self):
+        def lastdir(chunknum, dirpaths):
+            return dirpaths[-1]
+
+        f = ChunkFile.open(self.dirs, 'wb', placement=lastdir)
+        f.truncate(CHUNKDATASIZE + 10)
+        f.close()
+
+        self.assertEqual(self.names(self.dirs[0]), [])
+        self.assertEqual(len(self.names(self.dirs[2])), 2)
+
+        f = ChunkFile.open(self.dirs, 'rb')
+        f.seek(0, os.SEEK_END)
+        self.assertEqual(f.tell(), CHUNKDATASIZE + 10)
+        f.close()
+
+    def testMissingDirectory(self):
+        f = ChunkFile.open(self.dirs[:2], 'wb')
+        f.close()
+
+        self.assertRaises(IOError, ChunkFile.open, self.dirs, 'rb')
+
+    def testMissingChunk(self):
+        f = ChunkFile.open(self.dirs, 'wb')
+        f.truncate(CHUNKDATASIZE * 2 + 10)
+        f.close()
+
+        self.assertRaises(IOError, ChunkFile.open, self.dirs[1:], 'rb')
+
+    def testNoDirectories(self):
+        self.assertRaises(ValueError, ChunkFile.open, [], 'wb')
+
+class TestChunkFileWritePastEnd(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testGapIsZeroFilled(self):
+        f = ChunkFile.open(self.tmpdir, 'w+b')
+        f.write(b'abc')
+        f.seek(CHUNKDATASIZE * 2 + 5)
+        f.write(b'xyz')
+
+        f.seek(CHUNKDATASIZE - 3)
+        self.assertEqual(f.read(6), b'\x00' * 6)
+
+        f.seek(CHUNKDATASIZE * 2)
+        self.assertEqual(f.read(), b'\x00' * 5 + b'xyz')
+        f.close()
+
+if __name__ == '__main__':
+    unittest.main()
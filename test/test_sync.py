@@ -0,0 +1,117 @@
+import shutil, tempfile, time, unittest
+from pathlib import Path
+from unittest import mock
+
+from chunkfile import *
+from chunkfile.ChunkFile import Chunk
+
+class TestChunkFileSync(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.synced = []
+
+        realsync = Chunk.sync
+        def sync(chunk):
+            self.synced.append(chunk.chunknum())
+            realsync(chunk)
+
+        patcher = mock.patch.object(Chunk, 'sync', sync)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testSyncOnlyDirty(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.truncate(CHUNKDATASIZE * 3)
+        f.sync()
+        self.assertEqual(sorted(self.synced), [0, 1, 2])
+
+        del self.synced[:]
+        f.sync()
+        self.assertEqual(self.synced, [])
+
+        f.seek(CHUNKDATASIZE + 5)
+        f.write(b'xyz')
+        f.sync()
+        self.assertEqual(self.synced, [1])
+        f.close()
+
+    def testSyncSkipsUnchangedTruncate(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.truncate(CHUNKDATASIZE * 2 + 10)
+        f.sync()
+
+        del self.synced[:]
+        f.truncate(CHUNKDATASIZE * 2 + 5)
+        f.sync()
+        self.assertEqual(self.synced, [2])
+        f.close()
+
+    def testSyncErasedChunk(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(b'x')
+        f.truncate(0)
+        f.sync()
+        self.assertEqual(self.synced, [])
+        f.close()
+
+    def testSyncClosed(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.close()
+
+        self.assertRaises(ValueError, f.sync)
+
+    def testDefaultNone(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(b'abc')
+        f.close()
+        self.assertEqual(self.synced, [])
+
+    def testOnClose(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', durability='on_close')
+        f.write(b'abc')
+        f.write(b'def')
+        self.assertEqual(self.synced, [])
+        f.close()
+        self.assertEqual(self.synced, [0])
+
+    def testEveryWrite(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', durability='every_write')
+        f.write(b'abc')
+        self.assertEqual(self.synced, [0])
+        f.write(b'def')
+        self.assertEqual(self.synced, [0, 0])
+        f.close()
+
+    def testGroupCommitBytes(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', durability=GroupCommit(nbytes=10))
+        f.write(b'abc')
+        time.sleep(0.05)
+        self.assertEqual(self.synced, [])
+
+        f.write(b'x' * 10)
+        deadline = time.time() + 5
+        while not self.synced and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.synced, [0])
+        f.close()
+
+    def testGroupCommitMs(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', durability=GroupCommit(ms=20))
+        f.write(b'abc')
+
+        deadline = time.time() + 5
+        while not self.synced and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.synced, [0])
+        f.close()
+
+    def testInvalidPolicy(self):
+        self.assertRaises(ValueError, ChunkFile.open, self.tmpdir, 'wb', durability='sometimes')
+        self.assertRaises(ValueError, GroupCommit)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class TestChunkFileTier(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.fast = self.tmpdir / 'fast'
+        self.slow = self.tmpdir / 'slow'
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def names(self, dirpath):
+        return sorted(p.name for p in dirpath.glob('*'))
+
+    def fill(self, f, nchunks):
+        for n in range(nchunks):
+            f.seek(n * CHUNKDATASIZE)
+            f.write(str(n).encode('ascii') * 10)
+
+    def testHotChunks(self):
+        f = ChunkFile.open(self.fast, 'wb', slow_tier=self.slow, hot_chunks=2)
+        self.fill(f, 4)
+        f.close()
+
+        self.assertEqual(self.names(self.fast), ['chunk.00000000002.dat', 'chunk.00000000003.dat'])
+        self.assertEqual(self.names(self.slow), ['chunk.00000000000.dat', 'chunk.00000000001.dat'])
+
+        f = ChunkFile.open(self.fast, 'rb', slow_tier=self.slow)
+        for n in range(4):
+            f.seek(n * CHUNKDATASIZE)
+            self.assertEqual(f.read(10), str(n).encode('ascii') * 10)
+        f.close()
+
+    def testMigrateByRecency(self):
+        f = ChunkFile.open(self.fast, 'w+b', slow_tier=self.slow)
+        self.fill(f, 3)
+
+        f.seek(0)
+        f.read(1)
+
+        self.assertEqual(f.migrate(max_hot=2), 1)
+        self.assertEqual(self.names(self.slow), ['chunk.00000000001.dat'])
+
+        f.seek(CHUNKDATASIZE)
+        self.assertEqual(f.read(10), b'1' * 10)
+        f.seek(CHUNKDATASIZE + 10)
+        f.write(b'after')
+        f.close()
+
+        f = ChunkFile.open(self.fast, 'rb', slow_tier=self.slow)
+        f.seek(CHUNKDATASIZE)
+        self.assertEqual(f.read(15), b'1' * 10 + b'after')
+        f.close()
+
+    def testMigrateIdle(self):
+        f = ChunkFile.open(self.fast, 'w+b', slow_tier=self.slow)
+        self.fill(f, 3)
+
+        self.assertEqual(f.migrate(idle=3600), 0)
+        self.assertEqual(f.migrate(idle=0), 2)
+        self.assertEqual(self.names(self.fast), ['chunk.00000000002.dat'])
+        f.close()
+
+    def testMigrateAll(self):
+        f = ChunkFile.open(self.fast, 'wb', slow_tier=self.slow)
+        self.fill(f, 3)
+        self.assertEqual(f.migrate(), 2)
+        self.assertEqual(f.migrate(), 0)
+        f.close()
+
+    def testInterruptedMigration(self):
+        f = ChunkFile.open(self.fast, 'wb', slow_tier=self.slow)
+        self.fill(f, 2)
+        f.close()
+
+        # copy renamed into place, original not yet removed
+        name = 'chunk.00000000000.dat'
+        shutil.copyfile(str(self.fast / name), str(self.slow / name))
+        # copy not yet renamed
+        shutil.copyfile(str(self.fast / name), str(self.slow / ('.' + name + '.migrating')))
+
+        f = ChunkFile.open(self.fast, 'rb', slow_tier=self.slow)
+        self.assertEqual(f.read(10), b'0' * 10)
+        f.close()
+        self.assertTrue((self.slow / name).exists())
+
+        f = ChunkFile.open(self.fast, 'ab', slow_tier=self.slow)
+        f.close()
+        self.assertFalse((self.slow / name).exists())
+
+    def testNoSlowTier(self):
+        f = ChunkFile.open(self.fast, 'wb')
+        self.assertRaises(ValueError, f.migrate)
+        f.close()
+
+        self.assertRaises(ValueError, ChunkFile.open, self.fast, 'wb', hot_chunks=1)
+
+if __name__ == '__main__':
+    unittest.main()
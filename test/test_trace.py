@@ -0,0 +1,96 @@
+import io, json, shutil, tempfile, unittest
+from pathlib import Path
+
+from chunkfile import *
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testEvents(self):
+        events = []
+        with tracing(events.append):
+            f = ChunkFile.open(self.tmpdir, 'w+b')
+            f.seek(CHUNKDATASIZE - 2)
+            f.write(b'abcd')
+            f.seek(CHUNKDATASIZE - 1)
+            f.read(2)
+            f.truncate(10)
+            f.close()
+
+        ops = [(e.op, e.chunknum, e.offset, e.length) for e in events]
+        self.assertEqual(ops, [
+            ('ChunkFile.truncate', None, 0, 0),
+            ('Chunk.create', 0, 0, 0),
+            ('Chunk.truncate', 0, CHUNKDATASIZE, 0),
+            ('Chunk.create', 1, 0, 0),
+            ('Chunk.write', 0, CHUNKDATASIZE - 2, 2),
+            ('Chunk.write', 1, 0, 2),
+            ('ChunkFile.write', None, CHUNKDATASIZE - 2, 4),
+            ('Chunk.read', 0, CHUNKDATASIZE - 1, 1),
+            ('Chunk.read', 1, 0, 1),
+            ('ChunkFile.read', None, CHUNKDATASIZE - 1, 2),
+            ('Chunk.truncate', 0, 10, 0),
+            ('Chunk.erase', 1, 0, 0),
+            ('ChunkFile.truncate', None, 10, 0),
+        ])
+        self.assertEqual(events[-1].path, str(self.tmpdir))
+        self.assertEqual(events[-2].path, str(self.tmpdir / 'chunk.00000000001.dat'))
+        self.assertTrue(all(e.duration_ns >= 0 for e in events))
+
+        # gone once the block ends
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        f.read()
+        f.close()
+        self.assertEqual(len(events), len(ops))
+
+    def testChunkOpen(self):
+        f = ChunkFile.open(self.tmpdir, 'wb')
+        f.write(b'data')
+        f.close()
+
+        recorder = TraceRecorder()
+        add_trace_hook(recorder)
+        try:
+            ChunkFile.open(self.tmpdir, 'rb').close()
+        finally:
+            remove_trace_hook(recorder)
+        self.assertEqual([e.op for e in recorder.events], ['Chunk.open'])
+        self.assertEqual(recorder.seen, 1)
+
+    def testSlowOpSampler(self):
+        sampler = SlowOpSampler(threshold_ms=60 * 1000)
+        with tracing(sampler):
+            f = ChunkFile.open(self.tmpdir, 'wb')
+            f.write(b'data')
+            f.close()
+        self.assertGreater(sampler.seen, 0)
+        self.assertEqual(list(sampler.events), [])
+
+    def testChromeTrace(self):
+        recorder = TraceRecorder()
+        with tracing(recorder):
+            f = ChunkFile.open(self.tmpdir, 'wb')
+            f.write(b'data')
+            f.close()
+
+        out = io.StringIO()
+        recorder.write_chrome_trace(out)
+        trace = json.loads(out.getvalue())['traceEvents']
+        self.assertEqual(len(trace), len(recorder.events))
+        write = [e for e in trace if e['name'] == 'Chunk.write'][0]
+        self.assertEqual(write['ph'], 'X')
+        self.assertEqual(write['cat'], 'Chunk')
+        self.assertEqual(write['args'], {'path': str(self.tmpdir / 'chunk.00000000000.dat'),
+                                         'chunknum': 0, 'offset': 0, 'length': 4})
+
+        write_chrome_trace(recorder.events, self.tmpdir / 'trace.json')
+        with (self.tmpdir / 'trace.json').open() as f:
+            self.assertEqual(json.load(f)['traceEvents'], trace)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import os, shutil, tempfile, threading, unittest
+from pathlib import Path
+from unittest import mock
+
+from chunkfile import *
+from chunkfile.ChunkFile import Chunk
+
+class TestChunkFileWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmpdir))
+
+
+    def testRoundTrip(self):
+        f = ChunkFile.open(self.tmpdir, 'w+b', write_behind=1024 * 1024, writers=3)
+        f.truncate(CHUNKDATASIZE * 2)
+        f.seek(CHUNKDATASIZE - 1000)
+
+        blocks = [os.urandom(700) for _ in range(10)]
+        for block in blocks:
+            f.write(block)
+        self.assertEqual(f.tell(), CHUNKDATASIZE - 1000 + 7000)
+
+        f.seek(CHUNKDATASIZE - 1000)
+        self.assertEqual(f.read(7000), b''.join(blocks))
+        f.close()
+
+    def testOverwriteOrder(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', write_behind=1024 * 1024, writers=2)
+        for i in range(100):
+            f.seek(0)
+            f.write(str(i).encode('ascii') * 3)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), b'999999')
+        f.close()
+
+    def testAppend(self):
+        f = ChunkFile.open(self.tmpdir, 'ab', write_behind=64)
+        for i in range(50):
+            f.write(b'%02d' % i)
+        self.assertEqual(f.tell(), 100)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), b''.join(b'%02d' % i for i in range(50)))
+        f.close()
+
+    def testBackpressure(self):
+        gate = threading.Event()
+        realwrite = Chunk.write
+        def write(chunk, offset, data):
+            gate.wait()
+            realwrite(chunk, offset, data)
+
+        with mock.patch.object(Chunk, 'write', write):
+            f = ChunkFile.open(self.tmpdir, 'wb', write_behind=10)
+            f.write(b'x' * 8)
+
+            t = threading.Thread(target=f.write, args=(b'y' * 8,))
+            t.start()
+            t.join(0.1)
+            self.assertTrue(t.is_alive())
+
+            gate.set()
+            t.join(5)
+            self.assertFalse(t.is_alive())
+            f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), b'x' * 8 + b'y' * 8)
+        f.close()
+
+    def testOversizedWrite(self):
+        f = ChunkFile.open(self.tmpdir, 'wb', write_behind=10)
+        f.write(b'z' * 100)
+        f.close()
+
+        f = ChunkFile.open(self.tmpdir, 'rb')
+        self.assertEqual(f.read(), b'z' * 100)
+        f.close()
+
+    def testErrorOnFlush(self):
+        def write(chunk, offset, data):
+            raise IOError('disk on fire')
+
+        with mock.patch.object(Chunk, 'write', write):
+            f = ChunkFile.open(self.tmpdir, 'wb', write_behind=1024)
+            f.write(b'abc')
+            self.assertRaises(IOError, f.flush)
+            f.flush()
+            f.close()
+
+    def testErrorOnClose(self):
+        def write(chunk, offset, data):
+            raise IOError('disk on fire')
+
+        with mock.patch.object(Chunk, 'write', write):
+            f = ChunkFile.open(self.tmpdir, 'wb', write_behind=1024)
+            f.write(b'abc')
+            self.assertRaises(IOError, f.close)
+            self.assertTrue(f.closed)
+
+    def testInvalidBudget(self):
+        self.assertRaises(ValueError, ChunkFile.open, self.tmpdir, 'wb', write_behind=0)
+        self.assertRaises(ValueError, ChunkFile.open, self.tmpdir, 'wb', write_behind=10, writers=0)
+
+if __name__ == '__main__':
+    unittest.main()